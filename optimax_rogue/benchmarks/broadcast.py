@@ -0,0 +1,136 @@
+"""Measures how long the server spends per tick sending the tick to everyone as the
+number of spectators grows. Since every distinct packet is serialized once and the
+bytes are shared, the time per tick should stay roughly flat. For comparison this
+also measures serializing the same packets separately for every connection, which
+is what the server used to do, with the same packets and bundles sent to each.
+
+Only serialization and queueing is measured; nothing is actually written to the
+sockets.
+
+python -m optimax_rogue.benchmarks.broadcast --spectators 1 10 100 500
+"""
+import argparse
+import random
+import socket
+import time
+import typing
+
+import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.serializer as ser
+import optimax_rogue.networking.shared as nshared
+from optimax_rogue.networking.server import Server, PlayerConnection, SpectatorConnection
+from optimax_rogue.logic.updater import Updater, UpdateResult, DungeonDespawningStrategy
+from optimax_rogue.logic.worldgen import EmptyDungeonGenerator, TogetherGameStartGenerator
+from optimax_rogue.logic.moves import Move
+
+def _drain(conn: nshared.Connection) -> int:
+    """Empties the send queue of the given connection, returning how many bytes were
+    in it"""
+    total = 0
+    while not conn.send_queue.empty():
+        total += len(conn.send_queue.get_nowait())
+    return total
+
+def _create_server(sock: socket.socket, num_specs: int, features: typing.Iterable[str]) -> Server:
+    dgen = EmptyDungeonGenerator(60, 10)
+    game_state = TogetherGameStartGenerator(dgen).setup_game()
+    player1 = PlayerConnection(sock, 'bench', 1)
+    player2 = PlayerConnection(sock, 'bench', 2)
+    spectators = [SpectatorConnection(sock, 'bench') for _ in range(num_specs)]
+    for conn in [player1, player2] + spectators:
+        conn.features = frozenset(features)
+    updater = Updater(dgen, DungeonDespawningStrategy.Unreachable)
+    return Server(game_state, updater, 0, None, player1, player2, spectators)
+
+def bench_shared(sock: socket.socket, num_specs: int, ticks: int,
+                 features: typing.Iterable[str]) -> typing.Tuple[float, float]:
+    """Runs the server for the given number of ticks with the given number of spectators.
+
+    Returns:
+        secs_per_tick (float): the average time spent per tick
+        bytes_per_tick (float): the average number of bytes queued per tick
+    """
+    server = _create_server(sock, num_specs, features)
+    conns = [server.player1_conn, server.player2_conn] + server.spectators
+    elapsed = 0.0
+    total_bytes = 0
+    for _ in range(ticks):
+        server.game_state.on_tick()
+        server.player1_conn.move = random.choice(list(Move))
+        server.player2_conn.move = random.choice(list(Move))
+        start = time.perf_counter()
+        result = server._tick() # pylint: disable=protected-access
+        elapsed += time.perf_counter() - start
+        total_bytes += sum(_drain(conn) for conn in conns)
+        if result != UpdateResult.InProgress:
+            server = _create_server(sock, num_specs, features)
+            conns = [server.player1_conn, server.player2_conn] + server.spectators
+    return elapsed / ticks, total_bytes / ticks
+
+def _send_tick_unshared(conn: nshared.Connection, tick_packets: typing.List[packets.Packet],
+                        result: UpdateResult) -> None:
+    """Sends the tick to the connection the way broadcast_tick would, except that every
+    packet is serialized just for this connection"""
+    if nshared.FEATURE_TICK_BUNDLES in conn.features:
+        conn.send(packets.TickBundlePacket(tick_packets, result))
+        return
+    conn.send(packets.TickStartPacket())
+    for packet in tick_packets:
+        conn.send(packet)
+    conn.send(packets.TickEndPacket(result))
+
+def bench_unshared(sock: socket.socket, num_specs: int, ticks: int,
+                   features: typing.Iterable[str]) -> float:
+    """Like bench_shared, except every connection serializes every packet itself.
+    Returns the average seconds per tick"""
+    server = _create_server(sock, num_specs, features)
+    conns = [server.player1_conn, server.player2_conn] + server.spectators
+    elapsed = 0.0
+    for _ in range(ticks):
+        server.game_state.on_tick()
+        move1 = random.choice(list(Move))
+        move2 = random.choice(list(Move))
+        start = time.perf_counter()
+        result, upds = server.updater.update(server.game_state, move1, move2)
+        p1_packets, p2_packets, spec_packets = [], [], []
+        for upd in upds:
+            server._broadcast_update(upd, p1_packets, p2_packets, spec_packets) # pylint: disable=protected-access
+        _send_tick_unshared(server.player1_conn, p1_packets, result)
+        _send_tick_unshared(server.player2_conn, p2_packets, result)
+        for spec in server.spectators:
+            _send_tick_unshared(spec, spec_packets, result)
+        elapsed += time.perf_counter() - start
+        for conn in conns:
+            _drain(conn)
+        if result != UpdateResult.InProgress:
+            server = _create_server(sock, num_specs, features)
+            conns = [server.player1_conn, server.player2_conn] + server.spectators
+    return elapsed / ticks
+
+def main():
+    """Main entry"""
+    parser = argparse.ArgumentParser(description='Benchmark the per-tick broadcast')
+    parser.add_argument('--spectators', type=int, nargs='+', default=[1, 10, 50, 100, 250, 500],
+                        help='the spectator counts to measure')
+    parser.add_argument('--ticks', type=int, default=200, help='ticks per measurement')
+    parser.add_argument('--serializer', type=str, choices=tuple(ser.SERIALIZERS.keys()),
+                        default='json', help='the serializer to use')
+    parser.add_argument('--features', type=str, nargs='*',
+                        default=sorted(nshared.SUPPORTED_FEATURES),
+                        help='the features negotiated for every connection')
+    args = parser.parse_args()
+
+    ser.set_serializer(args.serializer)
+    sock1, sock2 = socket.socketpair()
+    with sock1, sock2:
+        print(f'{"spectators":>10} {"shared ms/tick":>15} {"unshared ms/tick":>17} {"kB/tick":>9}')
+        for num_specs in args.spectators:
+            random.seed(num_specs)
+            shared, nbytes = bench_shared(sock1, num_specs, args.ticks, args.features)
+            random.seed(num_specs)
+            unshared = bench_unshared(sock1, num_specs, args.ticks, args.features)
+            print(f'{num_specs:>10} {shared * 1000:>15.3f} {unshared * 1000:>17.3f} '
+                  + f'{nbytes / 1024:>9.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""Measures how long it takes to serialize and deserialize every registered Serializable
+and how many bytes it takes, for each codec (a serializer along with the protocol
+features that change how things are written). This includes each update, each packet
+including the GUI packets, and game states of several sizes.
+
+The results can be written as JSON and compared against an earlier run to catch
+regressions:
+
+python -m optimax_rogue.benchmarks.codecs --output before.json
+python -m optimax_rogue.benchmarks.codecs --baseline before.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+import typing
+
+import numpy as np
+
+import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.serializer as ser
+import optimax_rogue.networking.shared as nshared
+import optimax_rogue.networking.handshake as handshake
+import optimax_rogue.logic.updates as updates
+import optimax_rogue.logic.worldgen as worldgen
+import optimax_rogue.server.pregame as pregame
+import optimax_rogue_bots.gui.packets as gui_packets
+from optimax_rogue.game.state import GameState
+from optimax_rogue.game.world import World
+from optimax_rogue.game.entities import Entity
+from optimax_rogue.game.modifiers import AttackResult, AttackEventArgs, DefendEventArgs, CombatFlag
+from optimax_rogue.logic.updater import UpdateResult
+from optimax_rogue.logic.moves import Move
+
+CODECS = {
+    'json': ('json', False, frozenset()),
+    'json-features': ('json', True, nshared.SUPPORTED_FEATURES),
+    'binary': ('binary', False, frozenset()),
+    'binary-features': ('binary', True, nshared.SUPPORTED_FEATURES),
+}
+"""For each codec, (serializer, type_ids, options) as passed to the serializer"""
+
+GAME_STATE_SIZES = ('60x10x1:2', '60x10x10:100', '200x200x10:500', '1000x1000x1:2')
+"""The default game states to measure as WIDTHxHEIGHTxDEPTHS:ENTITIES"""
+
+def _parse_size(size: str) -> typing.Tuple[int, int, int, int]:
+    """Parses a WIDTHxHEIGHTxDEPTHS:ENTITIES game state size"""
+    dims, num_ents = size.split(':')
+    width, height, depths = (int(dim) for dim in dims.split('x'))
+    return width, height, depths, int(num_ents)
+
+def make_game_state(width: int, height: int, depths: int, num_ents: int) -> GameState:
+    """Creates a spectator game state with the given number of empty dungeons of
+    the given size and the given number of entities spread across them"""
+    dgen = worldgen.EmptyDungeonGenerator(width, height)
+    dungeons = dict((depth, dgen.spawn_dungeon(depth)) for depth in range(depths))
+    if num_ents > depths * (width - 2) * (height - 2):
+        raise ValueError(f'{num_ents} entities do not fit in {depths} {width}x{height} dungeons')
+    ents = []
+    for i in range(num_ents):
+        depth, pos = i % depths, i // depths
+        posx, posy = 1 + pos % (width - 2), 1 + pos // (width - 2)
+        ents.append(Entity(i + 1, depth, posx, posy, 10 - i % 7, 10, 2, 1, [], dict()))
+    return GameState(False, 37, 1, 2, World(dungeons), ents)
+
+def size_name(width: int, height: int, depths: int, num_ents: int) -> str:
+    """Returns the name used for a game state of the given size"""
+    return f'{width}x{height}x{depths}:{num_ents}'
+
+def samples(game_state_sizes: typing.Iterable[str]) -> typing.List[typing.Tuple[str, ser.Serializable]]:
+    """Returns (name, instance) for every registered Serializable we know how to
+    create, along with game states of the given sizes"""
+    np.random.seed(0)
+    dgen = worldgen.EmptyDungeonGenerator(60, 10)
+    small_state = make_game_state(60, 10, 1, 2)
+    ent = small_state.entities[0]
+    ares = AttackResult(3, {CombatFlag.Block})
+    pos_upd = updates.EntityPositionUpdate(4, 1, 0, 0, 17, 4)
+    combat_upd = updates.EntityCombatUpdate(5, 1, 2, 2, {CombatFlag.Ambush}, (), ())
+
+    res = [
+        ('AttackResult', ares),
+        ('AttackEventArgs', AttackEventArgs(2, ares)),
+        ('DefendEventArgs', DefendEventArgs(1, ares)),
+        ('SerializableDict', ser.SerializableDict({'name': 'bench', 'values': [1, 2, 3]})),
+        ('Entity', ent),
+        ('Dungeon[60x10]', dgen.spawn_dungeon(0)),
+        ('Dungeon[200x200]', worldgen.EmptyDungeonGenerator(200, 200).spawn_dungeon(0)),
+        ('World[60x10x10]', World(dict((depth, dgen.spawn_dungeon(depth)) for depth in range(10)))),
+        ('EmptyDungeonGenerator', dgen),
+        ('TogetherGameStartGenerator', worldgen.TogetherGameStartGenerator(dgen)),
+        ('SeparatedGameStartGenerator', worldgen.SeparatedGameStartGenerator(dgen, 0, 5)),
+
+        ('EntityEventUpdate', updates.EntityEventUpdate(1, 1, 'parent_attack',
+                                                        AttackEventArgs(2, ares), (ares,))),
+        ('EntityCombatUpdate', combat_upd),
+        ('EntitySpawnUpdate', updates.EntitySpawnUpdate(2, ent)),
+        ('EntityDeathUpdate', updates.EntityDeathUpdate(3, 2)),
+        ('EntityPositionUpdate', pos_upd),
+        ('EntityHealthUpdate', updates.EntityHealthUpdate(6, 1, 2, -3, {'poison'})),
+        ('EntityModifierRemovedUpdate', updates.EntityModifierRemovedUpdate(7, 1, 0)),
+        ('DungeonCreatedUpdate', updates.DungeonCreatedUpdate(8, 1, dgen.spawn_dungeon(1))),
+
+        ('SyncPacket', packets.SyncPacket(small_state, 1)),
+        ('MovePacket', packets.MovePacket(1, Move.Left, 37)),
+        ('UpdatePacket', packets.UpdatePacket(pos_upd)),
+        ('TickStartPacket', packets.TickStartPacket()),
+        ('TickEndPacket', packets.TickEndPacket(UpdateResult.InProgress)),
+        ('TickBundlePacket', packets.TickBundlePacket(
+            [packets.UpdatePacket(pos_upd), packets.UpdatePacket(combat_upd),
+             packets.UpdatePacket(updates.EntityPositionUpdate(9, 2, 0, 0, 18, 4))],
+            UpdateResult.InProgress)),
+        ('IdentifyPacket', handshake.IdentifyPacket(b'secret', sorted(nshared.SUPPORTED_FEATURES))),
+        ('IdentifyResultPacket', handshake.IdentifyResultPacket(
+            1, sorted(nshared.SUPPORTED_FEATURES), ser.type_table())),
+        ('LobbyChangePacket', pregame.LobbyChangePacket(pregame.PregameUpdateResult.Ready)),
+
+        ('SetBotPitchPacket', gui_packets.SetBotPitchPacket('bench', 'a bot for benchmarking')),
+        ('SetHighlightStylePacket', gui_packets.SetHighlightStylePacket(
+            gui_packets.HighlightStyle.StateAction)),
+        ('SetScaleStylePacket', gui_packets.SetScaleStylePacket(
+            gui_packets.ScaleStyle.TemperatureSoftArgMax, 0.5)),
+        ('SetSupportedMovesPacket', gui_packets.SetSupportedMovesPacket(list(Move))),
+        ('FinishConfigurationPacket', gui_packets.FinishConfigurationPacket()),
+        ('StateActionValuesRequestPacket', gui_packets.StateActionValuesRequestPacket()),
+        ('StateActionValuesResultPacket', gui_packets.StateActionValuesResultPacket(
+            dict((move, 0.25 * int(move)) for move in Move), 37)),
+        ('MoveSelectedPacket', gui_packets.MoveSelectedPacket(Move.Up)),
+        ('MoveSuggestionRequestPacket', gui_packets.MoveSuggestionRequestPacket()),
+        ('MoveSuggestionResultPacket', gui_packets.MoveSuggestionResultPacket(Move.Down, 37)),
+    ]
+    for size in game_state_sizes:
+        dims = _parse_size(size)
+        res.append((f'GameState[{size_name(*dims)}]', make_game_state(*dims)))
+    return res
+
+def unsampled(samps: typing.Iterable[typing.Tuple[str, ser.Serializable]]) -> typing.List[str]:
+    """Returns the identifiers of the registered types that none of the samples are"""
+    sampled = set(type(obj) for _, obj in samps)
+    return sorted(iden for iden, typ in ser.IDENS_TO_TYPE.items() if typ not in sampled)
+
+def _time(func: typing.Callable, repeat: int, min_time: float) -> float:
+    """Returns the best average seconds per call over the given number of repeats,
+    each of which calls the function enough times to take at least min_time"""
+    timer = timeit.Timer(func)
+    number = 1
+    elapsed = timer.timeit(number)
+    while elapsed < min_time:
+        number *= 2 if elapsed * 10 > min_time else 10
+        elapsed = timer.timeit(number)
+    return min([elapsed] + timer.repeat(repeat - 1, number)) / number
+
+def bench_sample(obj: ser.Serializable, codec: str, repeat: int, min_time: float) -> dict:
+    """Measures the given object with the given codec, returning the result entry"""
+    serializer, type_ids, options = CODECS[codec]
+    ser.set_serializer(serializer)
+    serd = ser.serialize(obj, type_ids=type_ids, options=options)
+    decoded = ser.deserialize(serd)
+    if type(decoded) is not type(obj):
+        raise ValueError(f'{codec} decoded {type(obj)} as {type(decoded)}')
+    if ser.serialize(decoded, type_ids=type_ids, options=options) != serd:
+        raise ValueError(f'{codec} did not round trip {type(obj)}')
+
+    encode_secs = _time(lambda: ser.serialize(obj, type_ids=type_ids, options=options),
+                        repeat, min_time)
+    decode_secs = _time(lambda: ser.deserialize(serd), repeat, min_time)
+    return {
+        'bytes': len(serd),
+        'encode_us': encode_secs * 1e6,
+        'decode_us': decode_secs * 1e6,
+        'encode_mb_s': len(serd) / encode_secs / 1e6,
+        'decode_mb_s': len(serd) / decode_secs / 1e6,
+    }
+
+def compare(baseline: dict, results: typing.List[dict], tolerance: float) -> typing.List[str]:
+    """Returns a description of each result which is slower or bigger than the same
+    one in the baseline by more than the given fraction"""
+    old = dict(((res['name'], res['codec']), res) for res in baseline['results'])
+    regressions = []
+    for res in results:
+        prev = old.get((res['name'], res['codec']))
+        if prev is None:
+            continue
+        if res['bytes'] > prev['bytes']:
+            regressions.append(f'{res["name"]} {res["codec"]}: bytes {prev["bytes"]} -> {res["bytes"]}')
+        for key in ('encode_us', 'decode_us'):
+            if res[key] > prev[key] * (1 + tolerance):
+                regressions.append(f'{res["name"]} {res["codec"]}: {key} '
+                                   + f'{prev[key]:.2f} -> {res[key]:.2f}')
+    return regressions
+
+def main():
+    """Main entry"""
+    parser = argparse.ArgumentParser(description='Benchmark serializing every registered type')
+    parser.add_argument('--codecs', type=str, nargs='+', choices=tuple(CODECS.keys()),
+                        default=list(CODECS.keys()), help='the codecs to measure')
+    parser.add_argument('--game-states', type=str, nargs='*', default=list(GAME_STATE_SIZES),
+                        help='the game states to measure as WIDTHxHEIGHTxDEPTHS:ENTITIES')
+    parser.add_argument('--filter', type=str, default='',
+                        help='only measure samples whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3, help='repeats per measurement, the best is kept')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='minimum seconds for each repeat')
+    parser.add_argument('--output', type=str, help='where to write the results as json')
+    parser.add_argument('--baseline', type=str,
+                        help='results from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='how much slower than the baseline is considered a regression')
+    args = parser.parse_args()
+
+    samps = samples(args.game_states)
+    results = []
+    print(f'{"name":>32} {"codec":>16} {"bytes":>9} {"enc us":>10} {"dec us":>10} '
+          + f'{"enc MB/s":>9} {"dec MB/s":>9}')
+    for name, obj in samps:
+        if args.filter not in name:
+            continue
+        for codec in args.codecs:
+            res = bench_sample(obj, codec, args.repeat, args.min_time)
+            res['name'] = name
+            res['type'] = type(obj).identifier()
+            res['codec'] = codec
+            results.append(res)
+            print(f'{name:>32} {codec:>16} {res["bytes"]:>9} {res["encode_us"]:>10.2f} '
+                  + f'{res["decode_us"]:>10.2f} {res["encode_mb_s"]:>9.2f} {res["decode_mb_s"]:>9.2f}')
+
+    missing = unsampled(samps)
+    if missing:
+        print(f'registered types without a sample: {", ".join(missing)}')
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump({
+                'meta': {
+                    'time': time.time(),
+                    'python': sys.version,
+                    'platform': platform.platform(),
+                    'numpy': np.__version__,
+                },
+                'codecs': dict((name, {'serializer': serializer, 'type_ids': type_ids,
+                                       'options': sorted(options)})
+                               for name, (serializer, type_ids, options) in CODECS.items()),
+                'results': results,
+                'unsampled': missing,
+            }, outfile, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print(f'regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
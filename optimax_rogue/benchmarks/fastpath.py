@@ -0,0 +1,74 @@
+"""Measures how long it takes to encode and decode each of the packets which have a
+fixed-layout encoding (see networking.fastpath), both through the serializer as
+negotiated without the fast path and with it.
+
+python -m optimax_rogue.benchmarks.fastpath --serializer binary
+"""
+import argparse
+import socket
+import timeit
+import typing
+
+import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.serializer as ser
+import optimax_rogue.networking.shared as nshared
+from optimax_rogue.logic.updates import EntityPositionUpdate
+from optimax_rogue.logic.updater import UpdateResult
+from optimax_rogue.logic.moves import Move
+
+PACKETS = (
+    ('MovePacket', packets.MovePacket(2, Move.Left, 1234)),
+    ('TickStartPacket', packets.TickStartPacket()),
+    ('TickEndPacket', packets.TickEndPacket(UpdateResult.InProgress)),
+    ('EntityPositionUpdate', packets.UpdatePacket(EntityPositionUpdate(3, 2, 1, 1, 17, 4))),
+)
+
+def bench_packet(conn: nshared.Connection, packet: packets.Packet,
+                 number: int) -> typing.Tuple[float, float, int]:
+    """Measures the given packet as encoded for the given connection.
+
+    Returns:
+        encode_secs (float): the average time to serialize the packet
+        decode_secs (float): the average time to read the packet back
+        size (int): the number of bytes in the serialized packet
+    """
+    serd = conn.serialize(packet)
+    encode_secs = timeit.timeit(lambda: conn.serialize(packet), number=number) / number
+
+    def decode():
+        conn.rec_queue.put_nowait(serd)
+        conn.read()
+    decode_secs = timeit.timeit(decode, number=number) / number
+    return encode_secs, decode_secs, len(serd)
+
+def main():
+    """Main entry"""
+    parser = argparse.ArgumentParser(description='Benchmark the fixed-layout packets')
+    parser.add_argument('--number', type=int, default=20000, help='repetitions per measurement')
+    parser.add_argument('--serializer', type=str, choices=tuple(ser.SERIALIZERS.keys()),
+                        default='json', help='the serializer to use')
+    parser.add_argument('--features', type=str, nargs='*',
+                        default=sorted(nshared.SUPPORTED_FEATURES - {nshared.FEATURE_FAST_PATH}),
+                        help='the features negotiated besides the fast path')
+    args = parser.parse_args()
+
+    ser.set_serializer(args.serializer)
+    sock1, sock2 = socket.socketpair()
+    with sock1, sock2:
+        before = nshared.Connection(sock1, 'bench')
+        before.features = frozenset(args.features)
+        after = nshared.Connection(sock1, 'bench')
+        after.features = before.features | {nshared.FEATURE_FAST_PATH}
+
+        print(f'{"packet":>20} {"encode us":>17} {"decode us":>17} {"bytes":>15}')
+        print(f'{"":>20}' + ' {:>8} {:>8}'.format('before', 'after') * 2
+              + ' {:>7} {:>7}'.format('before', 'after'))
+        for name, packet in PACKETS:
+            enc_before, dec_before, size_before = bench_packet(before, packet, args.number)
+            enc_after, dec_after, size_after = bench_packet(after, packet, args.number)
+            print(f'{name:>20} {enc_before * 1e6:>8.2f} {enc_after * 1e6:>8.2f} '
+                  + f'{dec_before * 1e6:>8.2f} {dec_after * 1e6:>8.2f} '
+                  + f'{size_before:>7} {size_after:>7}')
+
+if __name__ == '__main__':
+    main()
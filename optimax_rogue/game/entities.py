@@ -130,4 +130,7 @@ class Entity(ser.Serializable):
     def __repr__(self):
         return f'[Entity @ ({self.x}, {self.y})]'
 
-ser.register(Entity)
+ser.register(Entity, (
+    ('iden', 'i'), ('depth', 'i'), ('x', 'i'), ('y', 'i'), ('health', 'i'),
+    ('base_max_health', 'i'), ('base_damage', 'i'), ('base_armor', 'i'),
+    ('modifiers', ser.EMBED_LIST), ('items', ser.EMBED_DICT)))
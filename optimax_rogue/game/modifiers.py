@@ -36,7 +36,7 @@ class AttackResult(ser.Serializable):
             [CombatFlag(tag) for tag in prims['tags']]
         )
 
-ser.register(AttackResult)
+ser.register(AttackResult, (('damage', 'i'), ('tags', (ser.SEQ, CombatFlag, set))))
 
 class AttackEventArgs(ser.Serializable):
     """These are the arguments to the 'parent_attack' event. This event is invoked
@@ -58,7 +58,7 @@ class AttackEventArgs(ser.Serializable):
     def from_prims(cls, prims) -> 'AttackEventArgs':
         return cls(prims['defender_iden'], ser.deserialize_embeddable(prims['attack_result']))
 
-ser.register(AttackEventArgs)
+ser.register(AttackEventArgs, (('defender_iden', 'i'), ('attack_result', ser.EMBED)))
 
 class DefendEventArgs(ser.Serializable):
     """These are the arguments to the 'parent_defend' event. This event is invoked
@@ -82,7 +82,7 @@ class DefendEventArgs(ser.Serializable):
     def from_prims(cls, prims) -> 'AttackEventArgs':
         return cls(prims['attacker_iden'], ser.deserialize_embeddable(prims['attack_result']))
 
-ser.register(DefendEventArgs)
+ser.register(DefendEventArgs, (('attacker_iden', 'i'), ('attack_result', ser.EMBED)))
 
 class TickEventArgs(ser.Serializable):
     """This corresponds to the 'tick' event, which is invoked at the end of every
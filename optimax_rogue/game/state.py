@@ -2,11 +2,32 @@
 
 import typing
 import io
+import struct
+import operator
+import numpy as np
 import optimax_rogue.networking.serializer as ser
 
 from optimax_rogue.game.world import World
 from optimax_rogue.game.entities import Entity
 
+COLUMNAR_ENTITIES_OPTION = 'centities'
+"""The serializer option (see serializer.option_enabled) which lets the entities in a
+game state be written as a columnar block rather than one at a time"""
+
+_FLAG_AUTHORITATIVE = 1
+_FLAG_COLUMNAR = 2
+"""Set in the first byte if the entities are in the columnar format"""
+_HEADER_STRUCT = struct.Struct('>BIIIQ')
+_LEN32_STRUCT = struct.Struct('>I')
+_COLUMNAR_HEADER_STRUCT = struct.Struct('>II')
+_SIDE_ENTRY_STRUCT = struct.Struct('>II')
+_COLUMNS = ('iden', 'depth', 'x', 'y', 'health', 'base_max_health', 'base_damage', 'base_armor')
+"""The Entity attributes in the columnar block, which are each written as an array of
+big-endian int32s in the same order as the constructor arguments"""
+_COLUMNS_GETTER = operator.attrgetter(*_COLUMNS)
+_INT32_MIN = -(1 << 31)
+_INT32_MAX = (1 << 31) - 1
+
 class GameState(ser.Serializable):
     """The entire game state of the world. If not actively updating, this instance
     completely describes everything that a new spectator needs
@@ -30,8 +51,11 @@ class GameState(ser.Serializable):
         self.player_2_iden = player_2_iden
         self.world = world
         self.entities = entities
-        self.pos_lookup = dict(((ent.depth, ent.x, ent.y), ent) for ent in entities)
-        self.iden_lookup = dict((ent.iden, ent) for ent in entities)
+        self.pos_lookup = dict()
+        self.iden_lookup = dict()
+        for ent in entities:
+            self.pos_lookup[(ent.depth, ent.x, ent.y)] = ent
+            self.iden_lookup[ent.iden] = ent
 
     @property
     def player_1(self) -> Entity:
@@ -93,8 +117,14 @@ class GameState(ser.Serializable):
 
     def to_prims(self) -> bytes:
         arr = io.BytesIO()
-        auth_val = 1 if self.is_authoritative else 0
-        arr.write(auth_val.to_bytes(1, byteorder='big', signed=False))
+        columns = None
+        if ser.option_enabled(COLUMNAR_ENTITIES_OPTION):
+            columns = self._entity_columns()
+
+        flags = _FLAG_AUTHORITATIVE if self.is_authoritative else 0
+        if columns is not None:
+            flags |= _FLAG_COLUMNAR
+        arr.write(flags.to_bytes(1, byteorder='big', signed=False))
         arr.write(self.tick.to_bytes(4, byteorder='big', signed=False))
         arr.write(self.player_1_iden.to_bytes(4, byteorder='big', signed=False))
         arr.write(self.player_2_iden.to_bytes(4, byteorder='big', signed=False))
@@ -103,6 +133,16 @@ class GameState(ser.Serializable):
         arr.write(len(wserd).to_bytes(8, byteorder='big', signed=False))
         arr.write(wserd)
 
+        if columns is not None:
+            plain, side = columns
+            arr.write(_COLUMNAR_HEADER_STRUCT.pack(plain.shape[1], len(side)))
+            arr.write(plain.astype('>i4').tobytes())
+            for ind in side:
+                eserd: bytes = ser.serialize(self.entities[ind])
+                arr.write(_SIDE_ENTRY_STRUCT.pack(ind, len(eserd)))
+                arr.write(eserd)
+            return arr.getvalue()
+
         arr.write(len(self.entities).to_bytes(4, byteorder='big', signed=False))
         for ent in self.entities:
             eserd: bytes = ser.serialize(ent)
@@ -111,25 +151,78 @@ class GameState(ser.Serializable):
 
         return arr.getvalue()
 
+    def _entity_columns(self) -> typing.Optional[typing.Tuple[np.ndarray, typing.List[int]]]:
+        """Splits the entities for the columnar format. Entities which are exactly
+        Entity without modifiers or items go in the columnar block and the rest are
+        serialized individually in the side section.
+
+        Returns:
+            plain (np.ndarray[len(_COLUMNS) x n]): the columns for the plain entities,
+                in the order they appear in entities
+            side (list[int]): the indexes in entities of everything else
+
+            or None if the plain entities don't fit in int32s
+        """
+        rows = []
+        side = []
+        for ind, ent in enumerate(self.entities):
+            if type(ent) is Entity and not ent.modifiers and not ent.items: # pylint: disable=unidiomatic-typecheck
+                rows.append(_COLUMNS_GETTER(ent))
+            else:
+                side.append(ind)
+
+        plain = np.array(rows, dtype='int64').reshape(len(rows), len(_COLUMNS)).T
+        if rows and (plain.min() < _INT32_MIN or plain.max() > _INT32_MAX):
+            return None
+        return plain, side
+
     @classmethod
     def from_prims(cls, prims: bytes) -> 'GameState':
-        arr = io.BytesIO(prims)
-        arr.seek(0, 0)
-        auth_val = int.from_bytes(arr.read(1), 'big', signed=False)
-        tick = int.from_bytes(arr.read(4), 'big', signed=False)
-        p1_iden = int.from_bytes(arr.read(4), 'big', signed=False)
-        p2_iden = int.from_bytes(arr.read(4), 'big', signed=False)
-        wlen = int.from_bytes(arr.read(8), 'big', signed=False)
-        world = World.from_prims(arr.read(wlen))
-
-        nents = int.from_bytes(arr.read(4), 'big', signed=False)
+        prims = memoryview(prims)
+        flags, tick, p1_iden, p2_iden, wlen = _HEADER_STRUCT.unpack_from(prims)
+        off = _HEADER_STRUCT.size
+        world = World.from_prims(prims[off:off + wlen])
+        off += wlen
+
+        is_authoritative = (flags & _FLAG_AUTHORITATIVE) != 0
+        if flags & _FLAG_COLUMNAR:
+            entities = cls._entities_from_columnar(prims, off)
+            return cls(is_authoritative, tick, p1_iden, p2_iden, world, entities)
+
+        nents = _LEN32_STRUCT.unpack_from(prims, off)[0]
+        off += _LEN32_STRUCT.size
         entities = []
         for _ in range(nents):
-            elen = int.from_bytes(arr.read(4), 'big', signed=False)
-            ent = ser.deserialize(arr.read(elen))
+            elen = _LEN32_STRUCT.unpack_from(prims, off)[0]
+            off += _LEN32_STRUCT.size
+            ent = ser.deserialize(prims[off:off + elen])
+            off += elen
             entities.append(ent)
 
-        return cls(auth_val == 1, tick, p1_iden, p2_iden, world, entities)
+        return cls(is_authoritative, tick, p1_iden, p2_iden, world, entities)
+
+    @staticmethod
+    def _entities_from_columnar(prims: memoryview, off: int) -> typing.List[Entity]:
+        """Decodes the entities written in the columnar format starting at the given
+        offset"""
+        nplain, nside = _COLUMNAR_HEADER_STRUCT.unpack_from(prims, off)
+        off += _COLUMNAR_HEADER_STRUCT.size
+        plain = np.frombuffer(prims, dtype='>i4', count=len(_COLUMNS) * nplain, offset=off)
+        off += plain.nbytes
+
+        entities = [None] * (nplain + nside)
+        for _ in range(nside):
+            ind, elen = _SIDE_ENTRY_STRUCT.unpack_from(prims, off)
+            off += _SIDE_ENTRY_STRUCT.size
+            entities[ind] = ser.deserialize(prims[off:off + elen])
+            off += elen
+
+        columns = plain.reshape(len(_COLUMNS), nplain).tolist()
+        plain_iter = zip(*columns)
+        for ind, ent in enumerate(entities):
+            if ent is None:
+                entities[ind] = Entity(*next(plain_iter), [], dict())
+        return entities
 
     def __eq__(self, other):
         if not isinstance(other, GameState):
@@ -3,10 +3,35 @@
 
 import enum
 import io
+import struct
 import typing
+import zlib
+import hashlib
+import contextlib
+from collections import OrderedDict
 import numpy as np
 import optimax_rogue.networking.serializer as ser
 
+COMPACT_DUNGEONS_OPTION = 'cdungeons'
+"""The serializer option (see serializer.option_enabled) which lets dungeons be written
+in whichever compact format is smallest rather than with one byte per tile"""
+
+_FORMAT_RUNS = 1
+"""Each byte is a run of up to 64 of the same tile; the tile in the top 2 bits and the
+length minus one in the bottom 6"""
+_FORMAT_PACKED = 2
+"""Four tiles to a byte, 2 bits each, starting from the most significant bits"""
+_FORMAT_ZLIB = 3
+"""The packed format compressed with zlib"""
+_FORMAT_REF = 4
+"""Just the content hash of a dungeon the receiver already has (see DungeonCache)"""
+_COMPACT_HEADER = struct.Struct('>BII')
+_SIZE_STRUCT = struct.Struct('>II')
+_WORLD_HEADER_STRUCT = struct.Struct('>I')
+_WORLD_ENTRY_STRUCT = struct.Struct('>IQ')
+_RUN_MAX = 64
+_PACKED_SHIFTS = np.array([6, 4, 2, 0], dtype='uint8')
+
 class Tile(enum.IntEnum):
     """Describes a tile on the world as an enum. They are typically stored
     as integers rather than wrapped, but they can be more easily displayed
@@ -22,11 +47,32 @@ class Dungeon(ser.Serializable):
 
     Attributes:
         tiles (np.ndarray[width x height]): the world int tuple, where each item
-            corresponds to a tile.
+            corresponds to a tile. If the dungeon was deserialized these are read-only
+            uint8s, which may share memory with the packet; see writable_tiles()
     """
 
     def __init__(self, tiles: np.ndarray) -> None:
         self.tiles = tiles
+        self._content_hash = None
+
+    @property
+    def content_hash(self) -> bytes:
+        """A hash of the size and tiles of this dungeon, which is how peers refer to
+        dungeons they have already been sent"""
+        if self._content_hash is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(_SIZE_STRUCT.pack(self.tiles.shape[0], self.tiles.shape[1]))
+            hasher.update(np.ascontiguousarray(self.tiles, dtype='uint8'))
+            self._content_hash = hasher.digest()
+        return self._content_hash
+
+    def writable_tiles(self) -> np.ndarray:
+        """Returns the tiles so that they can be modified, copying them first if they
+        are read-only"""
+        if not self.tiles.flags.writeable:
+            self.tiles = self.tiles.copy()
+        self._content_hash = None
+        return self.tiles
 
     @property
     def width(self):
@@ -71,24 +117,84 @@ class Dungeon(ser.Serializable):
         return True
 
     def to_prims(self) -> bytes:
-        """Returns a compressed representation of this dungeon"""
+        """Returns a compressed representation of this dungeon. If the receiver supports
+        it this is whichever of the compact formats is smallest, otherwise it is the
+        width, height, and one byte per tile. Inside using_dungeon_cache this is just
+        the content hash if the receiver already has the dungeon"""
+        cache = _DUNGEON_CACHE
+        if cache is not None:
+            if cache.get(self.content_hash) is not None:
+                header = _COMPACT_HEADER.pack(_FORMAT_REF, self.tiles.shape[0], self.tiles.shape[1])
+                return header + self.content_hash
+            cache.add(self)
+
+        flat = self.tiles.astype('uint8', copy=False).reshape(self.tiles.shape[0] * self.tiles.shape[1])
+        if ser.option_enabled(COMPACT_DUNGEONS_OPTION):
+            return self._to_compact_prims(flat)
+
         arr = io.BytesIO()
         arr.write(int(self.tiles.shape[0]).to_bytes(4, byteorder='big', signed=False))
         arr.write(int(self.tiles.shape[1]).to_bytes(4, byteorder='big', signed=False))
-
-        tmp = self.tiles.astype('uint8').reshape(self.tiles.shape[0] * self.tiles.shape[1])
-        arr.write(tmp.tobytes())
+        arr.write(flat.tobytes())
         return arr.getvalue()
 
+    def _to_compact_prims(self, flat: np.ndarray) -> bytes:
+        """Writes the flattened uint8 tiles in whichever compact format is smallest. The
+        format byte comes first, which is never 0 unlike the first byte of the width in
+        the original format"""
+        packed = _pack_tiles(flat)
+        candidates = (
+            (_FORMAT_RUNS, _run_length_encode(flat)),
+            (_FORMAT_PACKED, packed),
+            (_FORMAT_ZLIB, zlib.compress(packed)),
+        )
+        fmt, body = min(candidates, key=lambda cand: len(cand[1]))
+        header = _COMPACT_HEADER.pack(fmt, self.tiles.shape[0], self.tiles.shape[1])
+        return header + body
+
     @classmethod
     def from_prims(cls, prims: bytes) -> 'Dungeon':
-        """Returns the uncompressed dungeon"""
-        arr: io.BytesIO = io.BytesIO(prims)
-        arr.seek(0, 0)
-        wid = int.from_bytes(arr.read(4), byteorder='big', signed=False)
-        hei = int.from_bytes(arr.read(4), byteorder='big', signed=False)
-        tmp = np.frombuffer(arr.read(wid*hei), dtype='uint8').reshape(wid, hei)
-        tiles = tmp.astype('int32')
+        """Returns the uncompressed dungeon. In the original format the tiles are a view
+        of prims rather than a copy. Inside using_dungeon_cache the dungeon is added to
+        the cache"""
+        prims = memoryview(prims)
+        if prims and prims[0] != 0:
+            dung = cls._from_compact_prims(prims)
+        else:
+            wid, hei = _SIZE_STRUCT.unpack_from(prims)
+            tiles = np.frombuffer(prims, dtype='uint8', count=wid*hei,
+                                  offset=_SIZE_STRUCT.size).reshape(wid, hei)
+            tiles.flags.writeable = False
+            dung = cls(tiles)
+
+        if _DUNGEON_CACHE is not None:
+            _DUNGEON_CACHE.add(dung)
+        return dung
+
+    @classmethod
+    def _from_compact_prims(cls, prims: memoryview) -> 'Dungeon':
+        """Returns the dungeon from the result of _to_compact_prims"""
+        fmt, wid, hei = _COMPACT_HEADER.unpack_from(prims)
+        body = prims[_COMPACT_HEADER.size:]
+        if fmt == _FORMAT_REF:
+            content_hash = bytes(body[:16])
+            dung = _DUNGEON_CACHE.get(content_hash) if _DUNGEON_CACHE is not None else None
+            if dung is None:
+                raise KeyError(f'dungeon {content_hash.hex()} is not in the dungeon cache')
+            return dung
+        # a85 encoding may have padded the body to a multiple of 4 bytes
+        if fmt == _FORMAT_RUNS:
+            flat = _run_length_decode(body)[:wid * hei]
+        elif fmt == _FORMAT_PACKED:
+            flat = _unpack_tiles(body, wid * hei)
+        elif fmt == _FORMAT_ZLIB:
+            flat = _unpack_tiles(zlib.decompress(body), wid * hei)
+        else:
+            raise ValueError(f'unknown dungeon format {fmt}')
+        if flat.shape[0] != wid * hei:
+            raise ValueError(f'expected {wid * hei} tiles, got {flat.shape[0]}')
+        tiles = flat.reshape(wid, hei)
+        tiles.flags.writeable = False
         return cls(tiles)
 
     def __eq__(self, other):
@@ -98,6 +204,106 @@ class Dungeon(ser.Serializable):
 
 ser.register(Dungeon)
 
+class DungeonCache:
+    """A bounded collection of dungeons by content hash which drops the least recently
+    used dungeon when full. Both sides of a connection keep one: the sender tracks which
+    dungeons the receiver has, and the receiver has them. Since both see the same dungeons
+    in the same order, the receiver has everything the sender expects as long as its
+    capacity is at least as large.
+
+    Attributes:
+        capacity (int): the maximum number of dungeons
+        dungeons (OrderedDict[bytes, Dungeon]): the dungeons by content hash, from least
+            to most recently used
+    """
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.dungeons = OrderedDict()
+
+    def __contains__(self, content_hash: bytes) -> bool:
+        """Returns True if the dungeon is in the cache without marking it as used"""
+        return content_hash in self.dungeons
+
+    def get(self, content_hash: bytes) -> typing.Optional[Dungeon]:
+        """Returns the dungeon with the given content hash, marking it as used, or None
+        if it isn't in the cache"""
+        dung = self.dungeons.get(content_hash)
+        if dung is not None:
+            self.dungeons.move_to_end(content_hash)
+        return dung
+
+    def add(self, dung: Dungeon) -> None:
+        """Adds the given dungeon to the cache or marks it as used if it's already there"""
+        self.dungeons[dung.content_hash] = dung
+        self.dungeons.move_to_end(dung.content_hash)
+        while len(self.dungeons) > self.capacity:
+            self.dungeons.popitem(last=False)
+
+class DungeonRecorder:
+    """Can be used in place of a DungeonCache which is always empty. Remembers every
+    dungeon added so a packet can be serialized once and then the DungeonCache for
+    each connection it is sent to can be updated
+
+    Attributes:
+        added (list[Dungeon]): the dungeons added, in order
+    """
+    def __init__(self) -> None:
+        self.added = []
+
+    def get(self, content_hash: bytes) -> typing.Optional[Dungeon]: # pylint: disable=unused-argument
+        """Always returns None"""
+        return None
+
+    def add(self, dung: Dungeon) -> None:
+        """Remembers that the dungeon was added"""
+        self.added.append(dung)
+
+_DUNGEON_CACHE = None
+
+@contextlib.contextmanager
+def using_dungeon_cache(cache: typing.Optional[typing.Union[DungeonCache, DungeonRecorder]]):
+    """Dungeons serialized within this context are written as a reference if they are in
+    the given cache and are added to it otherwise. Dungeons deserialized within this
+    context are looked up in / added to the cache. None to always write the whole dungeon"""
+    global _DUNGEON_CACHE # pylint: disable=global-statement
+    old_cache = _DUNGEON_CACHE
+    _DUNGEON_CACHE = cache
+    try:
+        yield
+    finally:
+        _DUNGEON_CACHE = old_cache
+
+def _pack_tiles(flat: np.ndarray) -> bytes:
+    """Packs the flattened uint8 tiles four to a byte"""
+    if flat.shape[0] % 4 != 0:
+        flat = np.concatenate((flat, np.zeros(4 - flat.shape[0] % 4, dtype='uint8')))
+    quads = flat.reshape(-1, 4)
+    return (quads << _PACKED_SHIFTS).sum(axis=1, dtype='uint8').tobytes()
+
+def _unpack_tiles(packed: bytes, num: int) -> np.ndarray:
+    """Unpacks the first num tiles from the result of _pack_tiles"""
+    quads = np.frombuffer(packed, dtype='uint8')
+    return ((quads[:, np.newaxis] >> _PACKED_SHIFTS) & 3).reshape(-1)[:num]
+
+def _run_length_encode(flat: np.ndarray) -> bytes:
+    """Encodes the flattened uint8 tiles as one byte per run of up to _RUN_MAX tiles"""
+    if flat.shape[0] == 0:
+        return b''
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.shape[0]))
+
+    # runs longer than _RUN_MAX are split into full chunks followed by the remainder
+    chunks = (lengths + (_RUN_MAX - 1)) // _RUN_MAX
+    chunk_lengths = np.full(int(chunks.sum()), _RUN_MAX, dtype='int64')
+    chunk_lengths[np.cumsum(chunks) - 1] = lengths - (chunks - 1) * _RUN_MAX
+    chunk_tiles = np.repeat(flat[starts], chunks)
+    return ((chunk_tiles << 6) | (chunk_lengths - 1).astype('uint8')).tobytes()
+
+def _run_length_decode(runs: bytes) -> np.ndarray:
+    """Decodes the result from _run_length_encode back into flattened uint8 tiles"""
+    runs = np.frombuffer(runs, dtype='uint8')
+    return np.repeat(runs >> 6, (runs & (_RUN_MAX - 1)).astype('int64') + 1)
+
 class World(ser.Serializable):
     """Describes the static components of the world, which is a collection of dungeons,
     which may be partially loaded
@@ -152,15 +358,17 @@ class World(ser.Serializable):
 
     @classmethod
     def from_prims(cls, prims: bytes) -> 'World':
-        """Deserializes the given serialized world"""
-        arr = io.BytesIO(prims)
-        arr.seek(0, 0)
-        num = int.from_bytes(arr.read(4), 'big', signed=False)
+        """Deserializes the given serialized world. The dungeons are decoded from views
+        of prims rather than copies"""
+        prims = memoryview(prims)
+        num = _WORLD_HEADER_STRUCT.unpack_from(prims)[0]
+        off = _WORLD_HEADER_STRUCT.size
         dungeons = dict()
         for _ in range(num):
-            depth = int.from_bytes(arr.read(4), 'big', signed=False)
-            size = int.from_bytes(arr.read(8), 'big', signed=False)
-            lyr = Dungeon.from_prims(arr.read(size))
+            depth, size = _WORLD_ENTRY_STRUCT.unpack_from(prims, off)
+            off += _WORLD_ENTRY_STRUCT.size
+            lyr = Dungeon.from_prims(prims[off:off + size])
+            off += size
             dungeons[depth] = lyr
         return cls(dungeons)
 
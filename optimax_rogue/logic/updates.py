@@ -66,7 +66,9 @@ class EntityEventUpdate(GameStateUpdate):
     def relevant_for(self, game_state: GameState, depth: int) -> bool:
         return game_state.iden_lookup[self.entity_iden].depth == depth
 
-ser.register(EntityEventUpdate)
+ser.register(EntityEventUpdate, (
+    ('order', 'i'), ('entity_iden', 'i'), ('event_name', ser.PRIM), ('args', ser.EMBED),
+    ('prevals', (ser.SEQ, ser.EMBED, tuple))))
 
 class EntityCombatUpdate(GameStateUpdate):
     """This update corresponds with combat between two entities on the world, which is
@@ -136,7 +138,10 @@ class EntityCombatUpdate(GameStateUpdate):
         return (game_state.iden_lookup[self.attacker_iden].depth == depth
                 or game_state.iden_lookup[self.defender_iden].depth == depth)
 
-ser.register(EntityCombatUpdate)
+ser.register(EntityCombatUpdate, (
+    ('order', 'i'), ('attacker_iden', 'i'), ('defender_iden', 'i'), ('og_damage', 'i'),
+    ('tags', (ser.SEQ, CombatFlag, set)), ('attack_prevals', (ser.SEQ, ser.EMBED, tuple)),
+    ('defend_prevals', (ser.SEQ, ser.EMBED, tuple))))
 
 class EntitySpawnUpdate(GameStateUpdate):
     """This update corresponds with an entity spawning on the world
@@ -162,7 +167,7 @@ class EntitySpawnUpdate(GameStateUpdate):
     def relevant_for(self, game_state: GameState, depth: int) -> bool:
         return self.entity.depth == depth
 
-ser.register(EntitySpawnUpdate)
+ser.register(EntitySpawnUpdate, (('order', 'i'), ('entity', ser.EMBED)))
 
 class EntityDeathUpdate(GameStateUpdate):
     """This update corresponds with an entity dying on the world
@@ -181,7 +186,7 @@ class EntityDeathUpdate(GameStateUpdate):
     def relevant_for(self, game_state: GameState, depth: int) -> bool:
         return game_state.iden_lookup[self.entity_iden].depth == depth
 
-ser.register(EntityDeathUpdate)
+ser.register(EntityDeathUpdate, (('order', 'i'), ('entity_iden', 'i')))
 
 class EntityPositionUpdate(GameStateUpdate):
     """This update corresponds with an entity moving on the world
@@ -217,7 +222,9 @@ class EntityPositionUpdate(GameStateUpdate):
     def relevant_for(self, game_state: GameState, depth: int) -> bool:
         return depth == self.old_depth
 
-ser.register(EntityPositionUpdate)
+ser.register(EntityPositionUpdate, (
+    ('order', 'i'), ('entity_iden', 'i'), ('depth', 'i'), ('old_depth', 'i'),
+    ('posx', 'i'), ('posy', 'i')))
 
 class EntityHealthUpdate(GameStateUpdate):
     """This update corresponds with an entity being hurt or healed outside of combat
@@ -250,7 +257,9 @@ class EntityHealthUpdate(GameStateUpdate):
         return depth in (game_state.iden_lookup[self.entity_iden].depth,
                          game_state.iden_lookup[self.source_iden].depth)
 
-ser.register(EntityHealthUpdate)
+ser.register(EntityHealthUpdate, (
+    ('order', 'i'), ('entity_iden', 'i'), ('source_iden', 'i'), ('amount', 'i'),
+    ('tags', (ser.SEQ, None, frozenset))))
 
 class EntityModifierAddedUpdate(GameStateUpdate):
     """This update corresponds with an entity gaining a modifier
@@ -282,7 +291,7 @@ class EntityModifierAddedUpdate(GameStateUpdate):
         return depth in (game_state.iden_lookup[self.entity_iden].depth,)
 
 
-ser.register(EntityModifierAddedUpdate)
+ser.register(EntityModifierAddedUpdate, (('order', 'i'), ('entity_iden', 'i'), ('modifier', ser.EMBED)))
 
 class EntityModifierRemovedUpdate(GameStateUpdate):
     """This update corresponds to an entity losing a modifier
@@ -303,7 +312,7 @@ class EntityModifierRemovedUpdate(GameStateUpdate):
     def relevant_for(self, game_state: GameState, depth: int) -> bool:
         return depth in (game_state.iden_lookup[self.entity_iden].depth,)
 
-ser.register(EntityModifierRemovedUpdate)
+ser.register(EntityModifierRemovedUpdate, (('order', 'i'), ('entity_iden', 'i'), ('modifier_index', 'i')))
 
 class DungeonCreatedUpdate(GameStateUpdate):
     """Called when a dungeon is created
@@ -332,4 +341,4 @@ class DungeonCreatedUpdate(GameStateUpdate):
         return cls(prims['order'], prims['depth'],
                    ser.deserialize_embeddable(prims['dungeon']))
 
-ser.register(DungeonCreatedUpdate)
+ser.register(DungeonCreatedUpdate, (('order', 'i'), ('depth', 'i'), ('dungeon', ser.EMBED)))
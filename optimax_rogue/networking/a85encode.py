@@ -1,10 +1,44 @@
 """This is just the a85encoding without the z-alias for 4 0s. The z-alias is only helpful
 if reducing file size is more important than reducing decryption speed, which isn't obviously
 true anymore. It also mmakes the implementation more complicated which is definitely unhelpful
+
+Large buffers (such as a GameState embedding a World with many dungeons) are encoded and
+decoded with numpy, which handles the whole buffer with array arithmetic instead of looping
+over every 4-byte block in python.
 """
+import typing
+import base64
+import numpy as np
+
+NUMPY_THRESHOLD = 128
+"""Buffers with at least this many bytes are encoded / decoded with numpy. Below this
+the fixed overhead of setting up the arrays outweighs the per-block savings"""
+
+NUMPY_DECODE_CHUNK = 1 << 16
+"""How many blocks a85decode_numpy widens to 64 bits at a time, which bounds how much
+extra memory decoding a large buffer needs"""
 
 def a85encode(inp: bytes) -> bytes:
     """Encodes blocks of 4 input bytes to 5 output bytes using ascii 33-108"""
+    if len(inp) >= NUMPY_THRESHOLD:
+        return a85encode_numpy(inp)
+    return a85encode_python(inp)
+
+def a85decode(inp: typing.Union[bytes, str]) -> bytes:
+    """Decodes the result from a85encode. Behaves exactly like base64.a85decode, but
+    uses numpy for large inputs that are just blocks of 5 characters (which is always
+    the case for a85encode output)"""
+    if len(inp) >= NUMPY_THRESHOLD and len(inp) % 5 == 0:
+        if isinstance(inp, str):
+            inp = inp.encode('ascii', 'strict')
+        res = a85decode_numpy(inp)
+        if res is not None:
+            return res
+    return base64.a85decode(inp)
+
+def a85encode_python(inp: bytes) -> bytes:
+    """Encodes blocks of 4 input bytes to 5 output bytes using ascii 33-108 one block
+    at a time. This is faster than a85encode_numpy for small inputs"""
     if len(inp) % 4 != 0:
         inp = inp + (b'\x00' * (4 - (len(inp) % 4)))
 
@@ -26,4 +60,42 @@ def a85encode(inp: bytes) -> bytes:
         result[off + 1] = 33 + (remaining - temp * 85)
         result[off] = 33 + temp
 
-    return bytes(result)
\ No newline at end of file
+    return bytes(result)
+
+def a85encode_numpy(inp: bytes) -> bytes:
+    """Encodes blocks of 4 input bytes to 5 output bytes using ascii 33-108, handling
+    every block at once with numpy"""
+    if len(inp) % 4 != 0:
+        inp = bytes(inp) + (b'\x00' * (4 - (len(inp) % 4)))
+
+    remaining = np.frombuffer(inp, dtype='>u4').astype('uint32')
+    result = np.empty((remaining.shape[0], 5), dtype='uint8')
+    for digit in range(4, 0, -1):
+        remaining, result[:, digit] = np.divmod(remaining, 85)
+    result[:, 0] = remaining
+    result += 33
+    return result.tobytes()
+
+def a85decode_numpy(inp: bytes) -> typing.Optional[bytes]:
+    """Decodes blocks of 5 input characters back into 4 bytes with numpy. Returns None
+    if the input uses anything other than plain 5 character blocks (i.e., the z-alias or
+    whitespace), in which case base64.a85decode should be used instead"""
+    if len(inp) % 5 != 0:
+        return None
+    digits = np.frombuffer(inp, dtype='uint8')
+    if digits.shape[0] == 0:
+        return b''
+    if digits.min() < 33 or digits.max() > 117:
+        return None
+
+    blocks = digits.reshape(-1, 5)
+    result = np.empty(blocks.shape[0], dtype='>u4')
+    for start in range(0, blocks.shape[0], NUMPY_DECODE_CHUNK):
+        chunk = blocks[start:start + NUMPY_DECODE_CHUNK].astype('uint64') - 33
+        values = chunk[:, 0]
+        for digit in range(1, 5):
+            values = values * 85 + chunk[:, digit]
+        if values.max() > 0xFFFFFFFF:
+            raise ValueError('Ascii85 overflow')
+        result[start:start + NUMPY_DECODE_CHUNK] = values
+    return result.tobytes()
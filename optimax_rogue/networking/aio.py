@@ -0,0 +1,294 @@
+"""asyncio transport for the networking layer. Rather than duplicating Connection, the
+protocol here looks enough like a non-blocking socket to be the connection of an
+ordinary Connection, and the listener enough like a listening socket to be the
+listen_sock of a ServerPregame or Server. That way the framing, compression and
+everything built on top of them work the same on either transport, and the
+synchronous API is untouched.
+
+Each game shares one asyncio.Event among its listener and connections which is set
+whenever any of them has something to do, so many games can run on one event loop
+without polling:
+
+    activity = asyncio.Event()
+    listener = await aio.listen('localhost', 0, activity)
+    result = await aio.run_game(listener, activity, pregame)
+"""
+import asyncio
+import contextlib
+import os
+import socket
+import sys
+import typing
+from collections import deque
+
+from optimax_rogue.networking.shared import (
+    Connection, configure_socket, close_all, remove_stale_socket, SOCKET_BUFFER_SIZE)
+from optimax_rogue.networking.server import Server
+from optimax_rogue.logic.updater import UpdateResult
+
+class ConnectionProtocol(asyncio.Protocol):
+    """An asyncio Protocol which can be used as the connection of a Connection. What is
+    received is held onto until Connection.update takes it with recv_into, and what
+    Connection sends is handed straight to the transport, which takes care of partial
+    writes.
+
+    Attributes:
+        activity (asyncio.Event): set whenever something is received, the peer goes away,
+            or the transport can be written to again
+        listener (Listener, optional): the listener to announce ourself to once connected
+        transport (asyncio.Transport, optional): the transport, once connected
+        received (deque[bytes]): what we've received that recv_into hasn't taken yet
+        received_offset (int): how much of the first of received recv_into has taken
+        eof (bool): True once the peer won't send anything more
+        paused (bool): True while the transport wants us to stop writing
+    """
+    def __init__(self, activity: asyncio.Event, listener: typing.Optional['Listener'] = None) -> None:
+        self.activity = activity
+        self.listener = listener
+        self.transport = None
+        self.received = deque()
+        self.received_offset = 0
+        self.eof = False
+        self.paused = False
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            configure_socket(sock)
+        transport.set_write_buffer_limits(high=SOCKET_BUFFER_SIZE)
+        if self.listener is not None:
+            self.listener.accepted.append(self)
+        self.activity.set()
+
+    def data_received(self, data: bytes) -> None:
+        self.received.append(data)
+        self.activity.set()
+
+    def eof_received(self) -> bool:
+        self.eof = True
+        self.activity.set()
+        return False
+
+    def connection_lost(self, exc: typing.Optional[Exception]) -> None:
+        self.eof = True
+        self.transport = None
+        self.activity.set()
+
+    def pause_writing(self) -> None:
+        self.paused = True
+
+    def resume_writing(self) -> None:
+        self.paused = False
+        self.activity.set()
+
+    def recv_into(self, buffer: typing.Any) -> int:
+        """Like socket.recv_into on a non-blocking socket"""
+        if not self.received:
+            if self.eof:
+                return 0
+            raise BlockingIOError()
+        view = memoryview(buffer)
+        total = 0
+        while self.received and total < len(view):
+            chunk = self.received[0]
+            amt = min(len(chunk) - self.received_offset, len(view) - total)
+            view[total:total + amt] = memoryview(chunk)[self.received_offset:self.received_offset + amt]
+            total += amt
+            self.received_offset += amt
+            if self.received_offset == len(chunk):
+                self.received.popleft()
+                self.received_offset = 0
+        return total
+
+    def sendmsg(self, buffers: typing.Sequence[typing.Any]) -> int:
+        """Like socket.sendmsg on a non-blocking socket, except that everything is
+        always taken unless the transport has asked us to stop writing"""
+        if self.transport is None or self.transport.is_closing():
+            raise BrokenPipeError()
+        if self.paused:
+            raise BlockingIOError()
+        self.transport.writelines(buffers)
+        return sum(len(buf) for buf in buffers)
+
+    def send(self, data: typing.Any) -> int:
+        """Like socket.send on a non-blocking socket. See sendmsg"""
+        return self.sendmsg([data])
+
+    def setblocking(self, flag: bool) -> None:
+        """Protocols never block, so this does nothing"""
+
+    def shutdown(self, how: int) -> None:
+        """Closes the transport once what was sent has been written"""
+        self.close()
+
+    def close(self) -> None:
+        """Closes the transport once what was sent has been written"""
+        if self.transport is not None:
+            self.transport.close()
+
+    def getpeername(self) -> typing.Any:
+        """Gets the address of the peer"""
+        return self.transport.get_extra_info('peername') if self.transport else None
+
+class Listener:
+    """Accepts connections on an asyncio server. This can be the listen_sock of a
+    ServerPregame or Server, since accept() behaves like it would on a non-blocking
+    listening socket
+
+    Attributes:
+        activity (asyncio.Event): set whenever someone connects
+        accepted (deque[ConnectionProtocol]): the connections that accept() hasn't
+            returned yet
+        server (asyncio.AbstractServer, optional): the server, once listening
+        unix_path (str, optional): the path of the unix domain socket we listen on, if we
+            do, which is removed once we stop listening
+    """
+    def __init__(self, activity: asyncio.Event) -> None:
+        self.activity = activity
+        self.accepted = deque()
+        self.server = None
+        self.unix_path = None
+
+    def make_protocol(self) -> ConnectionProtocol:
+        """The protocol factory for the server"""
+        return ConnectionProtocol(self.activity, self)
+
+    def accept(self) -> typing.Tuple[ConnectionProtocol, typing.Any]:
+        """Like socket.accept on a non-blocking socket"""
+        while self.accepted:
+            proto = self.accepted.popleft()
+            if proto.transport is not None:
+                return proto, proto.getpeername()
+        raise BlockingIOError()
+
+    def getsockname(self) -> typing.Any:
+        """Gets the address we are listening on"""
+        return self.server.sockets[0].getsockname()
+
+    def close(self) -> None:
+        """Stops listening. Connections which were already accepted are unaffected"""
+        if self.server is not None:
+            self.server.close()
+        if self.unix_path is not None:
+            with contextlib.suppress(OSError):
+                os.unlink(self.unix_path)
+            self.unix_path = None
+
+async def listen(host: str, port: int, activity: asyncio.Event,
+                 unix_path: typing.Optional[str] = None) -> Listener:
+    """Starts listening on the given host and port, or on the unix domain socket at
+    unix_path if specified, returning the listener"""
+    listener = Listener(activity)
+    loop = asyncio.get_running_loop()
+    if unix_path is None:
+        listener.server = await loop.create_server(
+            listener.make_protocol, host, port, family=socket.AF_INET)
+    else:
+        # asyncio would replace the socket at the path even if it is still in use
+        remove_stale_socket(unix_path)
+        listener.server = await loop.create_unix_server(listener.make_protocol, unix_path)
+        listener.unix_path = unix_path
+    return listener
+
+async def open_connection(host: str, port: int,
+                          activity: typing.Optional[asyncio.Event] = None,
+                          unix_path: typing.Optional[str] = None) -> Connection:
+    """Connects to the given host and port, or to the unix domain socket at unix_path if
+    specified, returning the connection"""
+    if activity is None:
+        activity = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    if unix_path is None:
+        _, proto = await loop.create_connection(lambda: ConnectionProtocol(activity), host, port)
+        return Connection(proto, f'{host}:{port}')
+    _, proto = await loop.create_unix_connection(lambda: ConnectionProtocol(activity), unix_path)
+    return Connection(proto, unix_path)
+
+def _can_send(conns: typing.Iterable[typing.Optional[Connection]]) -> bool:
+    """Returns True if one of the given connections has something to send and its
+    transport will take it"""
+    for conn in conns:
+        if conn is None or conn.disconnected() or not conn.has_pending(read=False):
+            continue
+        if not isinstance(conn.connection, ConnectionProtocol) or not conn.connection.paused:
+            return True
+    return False
+
+def _has_work(conns: typing.Iterable[typing.Optional[Connection]]) -> bool:
+    """Returns True if one of the given connections can send (see _can_send), has
+    packets which haven't been read(), or has received data that Connection.update
+    left for later because it ran out of its budget. The activity event won't be set
+    again for the last two, so we must not wait on it while there are any"""
+    if _can_send(conns):
+        return True
+    for conn in conns:
+        if conn is None or conn.disconnected():
+            continue
+        if not conn.rec_queue.empty():
+            return True
+        if isinstance(conn.connection, ConnectionProtocol) and conn.connection.received:
+            return True
+    return False
+
+async def wait_for_activity(activity: asyncio.Event, timeout: typing.Optional[float]) -> None:
+    """Waits until the activity event is set or the timeout passes, then clears it. The
+    event only says that something new happened, so once it is cleared the caller has
+    to handle everything it was set for: it should look at every connection afterward,
+    and should wait with a timeout of 0 while anything is left over (see _has_work)"""
+    if timeout is None or timeout > 0:
+        try:
+            await asyncio.wait_for(activity.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    activity.clear()
+
+async def update_pregame(pregame: 'ServerPregame', activity: asyncio.Event) -> typing.Tuple[
+        'PregameUpdateResult', typing.Optional[Server]]:
+    """The async version of ServerPregame.update, which first waits until something has
+    happened on one of the connections or the listener. Once both players are there,
+    which may be right away if they are bots, the game starts without waiting"""
+    starting = pregame.player1_conn is not None and pregame.player2_conn is not None
+    await wait_for_activity(activity, 0 if starting or _has_work(pregame.connections()) else None)
+    return pregame.update()
+
+async def update_server(server: Server, activity: asyncio.Event) -> UpdateResult:
+    """The async version of Server.update, which first waits until something has
+    happened on one of the connections or the listener, or the next tick is due"""
+    timeout = 0 if _has_work(server.connections()) else server.time_until_tick()
+    await wait_for_activity(activity, timeout)
+    return server.update()
+
+async def run_game(listener: Listener, activity: asyncio.Event, pregame: 'ServerPregame',
+                   outf: typing.TextIO = sys.stdout) -> UpdateResult:
+    """Runs the lobby and then the game, the same way server.main does, until the game
+    ends and everything has been sent. The pregame should have been made with the
+    listener as its listen socket. Returns the result of the game, or None if the lobby
+    failed"""
+    from optimax_rogue.server.pregame import PregameUpdateResult # pylint: disable=import-outside-toplevel
+
+    result = PregameUpdateResult.InProgress
+    server = None
+    try:
+        while result == PregameUpdateResult.InProgress:
+            result, server = await update_pregame(pregame, activity)
+
+        if result != PregameUpdateResult.Ready:
+            print(f'[aio] ending due to non-ready pregame result {result}', file=outf)
+            return None
+
+        server.outf = outf
+        result = UpdateResult.InProgress
+        while result == UpdateResult.InProgress:
+            server.game_state.on_tick()
+            result = await update_server(server, activity)
+
+        while server.has_pending():
+            server.update_queues()
+            await wait_for_activity(activity, 0 if _can_send(server.connections()) else None)
+
+        print(f'[aio] game ended with result {result}', file=outf)
+        return result
+    finally:
+        close_all(server.connections() if server is not None else pregame.connections())
+        listener.close()
@@ -0,0 +1,85 @@
+"""Fixed-layout encoding for the packets which make up most of the traffic. These only
+carry a few small integers, so rather than going through the serializer they are
+written as a one-byte tag followed by the fields packed with the struct format from
+their schema (see serializer.register).
+
+The tags are in the range FIRST_TAG to LAST_TAG, which neither the binary serializer
+(whose tags are at most serializer.MAX_TAG) nor JSON (which is ascii) ever start with,
+so the receiver can always tell these apart without anything being negotiated. Only
+the sender needs to know the peer understands them (see shared.FEATURE_FAST_PATH).
+"""
+import struct
+import typing
+
+import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.serializer as ser
+from optimax_rogue.logic.updates import EntityPositionUpdate
+
+FIRST_TAG = 0xE0
+LAST_TAG = 0xEF
+
+TAG_MOVE = 0xE0
+TAG_TICK_START = 0xE1
+TAG_TICK_END = 0xE2
+TAG_ENTITY_POSITION_UPDATE = 0xE3
+
+def _layout(tag: int, typ: type) -> typing.Tuple[struct.Struct, typing.Callable, typing.Callable]:
+    """Returns the struct for the tag followed by the fields of the given type, the
+    getter for those fields and the decoder from the types schema"""
+    packer, getter = ser.FIXED_LAYOUTS[typ]
+    assert FIRST_TAG <= tag <= LAST_TAG
+    return struct.Struct('>B' + packer.format.lstrip('>')), getter, ser.DECODERS[typ]
+
+_PACKET_LAYOUTS = {
+    packets.MovePacket: (TAG_MOVE,) + _layout(TAG_MOVE, packets.MovePacket),
+    packets.TickStartPacket: (TAG_TICK_START,) + _layout(TAG_TICK_START, packets.TickStartPacket),
+    packets.TickEndPacket: (TAG_TICK_END,) + _layout(TAG_TICK_END, packets.TickEndPacket),
+}
+"""For each packet type which is encoded directly, (tag, struct, getter, decoder)"""
+
+_UPDATE_LAYOUTS = {
+    EntityPositionUpdate: (TAG_ENTITY_POSITION_UPDATE,)
+                          + _layout(TAG_ENTITY_POSITION_UPDATE, EntityPositionUpdate),
+}
+"""For each update type whose UpdatePacket is encoded as just the update, (tag, struct,
+getter, decoder)"""
+
+_DECODERS = dict()
+for _tag, _packer, _, _decoder in _PACKET_LAYOUTS.values():
+    _DECODERS[_tag] = (_packer, _decoder, False)
+for _tag, _packer, _, _decoder in _UPDATE_LAYOUTS.values():
+    _DECODERS[_tag] = (_packer, _decoder, True)
+del _tag, _packer, _decoder
+
+def encode(packet: packets.Packet) -> typing.Optional[bytes]:
+    """Returns the fixed-layout encoding of the given packet, or None if it doesn't have
+    one and must go through the serializer"""
+    typ = type(packet)
+    layout = _PACKET_LAYOUTS.get(typ)
+    if layout is not None:
+        tag, packer, getter, _ = layout
+        return packer.pack(tag, *getter(packet))
+    if typ is packets.UpdatePacket:
+        layout = _UPDATE_LAYOUTS.get(type(packet.update))
+        if layout is not None:
+            tag, packer, getter, _ = layout
+            return packer.pack(tag, *getter(packet.update))
+    return None
+
+def is_fast(serd: bytes) -> bool:
+    """Returns True if the given serialized packet was encoded with encode()"""
+    return len(serd) > 0 and FIRST_TAG <= serd[0] <= LAST_TAG
+
+def decode(serd: bytes) -> packets.Packet:
+    """Decodes the packet from something returned from encode()"""
+    tag = serd[0]
+    layout = _DECODERS.get(tag)
+    if layout is None:
+        raise ValueError(f'unknown fast path tag {tag}')
+    packer, decoder, is_update = layout
+    if len(serd) != packer.size:
+        raise ValueError(f'expected {packer.size} bytes for fast path tag {tag}, got {len(serd)}')
+    res = decoder(list(packer.unpack(serd))[1:])
+    if is_update:
+        return packets.UpdatePacket(res)
+    return res
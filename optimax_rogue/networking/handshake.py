@@ -0,0 +1,161 @@
+"""Describes the handshake that happens when a client connects. Players send an
+IdentifyPacket with their secret, spectators may send one with an empty secret, and
+either way the server responds with an IdentifyResultPacket.
+
+The handshake is also where optional protocol features are negotiated. The client
+lists the features it supports in its IdentifyPacket, and the server responds with
+the subset that will be used for the connection. Peers that don't know about features
+never send or receive them, so they keep working with the original protocol.
+
+Clients connecting to a host which runs many matches (see server.lobbies) also name the
+lobby they want to join, and are told which lobby they ended up in.
+
+These packets are used by server.pregame, but they live here so that the server can
+handshake with spectators that join after the game has started.
+"""
+import io
+import typing
+
+import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.serializer as ser
+from optimax_rogue.networking.shared import Connection, SUPPORTED_FEATURES, FEATURE_TYPE_IDS
+
+class IdentifyPacket(packets.Packet):
+    """Sent by a spectator in the lobby to identify themself
+
+    Attributes:
+        secret (bytes): the secret identification
+        features (tuple[str]): the optional protocol features the sender supports
+        lobby (str, optional): the id of the lobby the sender wants to join, if the
+            server hosts more than one
+    """
+    def __init__(self, secret: bytes, features: typing.Iterable[str] = (),
+                 lobby: typing.Optional[str] = None):
+        self.secret = secret
+        self.features = tuple(features)
+        self.lobby = lobby
+
+    @classmethod
+    def identifier(cls):
+        return 'optimax_rogue.server.pregame.identify_packet'
+
+    @classmethod
+    def has_custom_serializer(cls):
+        return True
+
+    def to_prims(self):
+        res = io.BytesIO()
+        res.write(len(self.secret).to_bytes(4, 'big', signed=False))
+        res.write(self.secret)
+        if self.features or self.lobby is not None:
+            # older servers stop reading after the secret
+            res.write(len(self.features).to_bytes(1, 'big', signed=False))
+            for feature in self.features:
+                serd = feature.encode('ascii', 'strict')
+                res.write(len(serd).to_bytes(1, 'big', signed=False))
+                res.write(serd)
+        if self.lobby is not None:
+            # ... and servers that only know about features stop reading after those
+            serd = self.lobby.encode('ascii', 'strict')
+            res.write(len(serd).to_bytes(1, 'big', signed=False))
+            res.write(serd)
+        return res.getvalue()
+
+    @classmethod
+    def from_prims(cls, prims) -> 'IdentifyPacket':
+        res = io.BytesIO(prims)
+        res.seek(0, 0)
+        secret_len = int.from_bytes(res.read(4), 'big', signed=False)
+        secret = res.read(secret_len)
+        features = []
+        num_features = res.read(1)
+        if num_features:
+            for _ in range(num_features[0]):
+                feature_len = res.read(1)[0]
+                features.append(res.read(feature_len).decode('ascii', 'strict'))
+        lobby = None
+        lobby_len = res.read(1)
+        if lobby_len and lobby_len[0]: # lobby ids are never empty, but padding may be zeros
+            lobby = res.read(lobby_len[0]).decode('ascii', 'strict')
+        return cls(secret, features, lobby)
+
+    def __str__(self):
+        return f'IdentifyPacket[secret={self.secret}, features={self.features}, lobby={self.lobby}]'
+
+    def __eq__(self, other):
+        if not isinstance(other, IdentifyPacket):
+            return False
+        return (self.secret == other.secret and self.features == other.features
+                and self.lobby == other.lobby)
+
+packets.register_packet(IdentifyPacket)
+
+class IdentifyResultPacket(packets.Packet):
+    """Sent from the server back to a spectator to tell them about the result of
+    their IdentifyPacket
+
+    Attributes:
+        player_id (int, optional): if specified, the id that the spectator
+            successfully identified as. Either 1 or 2
+        features (list[str], optional): if the IdentifyPacket listed features, the
+            features that will be used on this connection
+        type_table (list[str], optional): if the typeids feature is used, the servers
+            type table (see serializer.type_table)
+        lobby (str, optional): if the server hosts more than one lobby, the id of the
+            lobby the spectator is now in
+    """
+    def __init__(self, player_id: typing.Optional[int],
+                 features: typing.Optional[typing.List[str]] = None,
+                 type_table: typing.Optional[typing.List[str]] = None,
+                 lobby: typing.Optional[str] = None):
+        self.player_id = player_id
+        self.features = features
+        self.type_table = type_table
+        self.lobby = lobby
+
+    @classmethod
+    def identifier(cls):
+        return 'optimax_rogue.server.pregame.identify_result_packet'
+
+    def to_prims(self):
+        # older clients construct this from every key, so only add what they asked for
+        res = {'player_id': self.player_id}
+        if self.features is not None:
+            res['features'] = list(self.features)
+        if self.type_table is not None:
+            res['type_table'] = list(self.type_table)
+        if self.lobby is not None:
+            res['lobby'] = self.lobby
+        return res
+
+    @classmethod
+    def from_prims(cls, prims) -> 'IdentifyResultPacket':
+        return cls(prims['player_id'], prims.get('features'), prims.get('type_table'),
+                   prims.get('lobby'))
+
+packets.register_packet(IdentifyResultPacket)
+
+def respond(conn: Connection, packet: IdentifyPacket, player_id: typing.Optional[int],
+            lobby: typing.Optional[str] = None) -> None:
+    """Responds to the given IdentifyPacket on the server side, enabling the features
+    that both sides support on the connection. The response itself is sent without
+    them since the client can't use them until it has read it. The lobby is only told
+    to clients new enough to have sent features or a lobby of their own"""
+    if not packet.features:
+        if packet.lobby is None:
+            lobby = None
+        conn.send(IdentifyResultPacket(player_id, lobby=lobby))
+        return
+
+    features = [feat for feat in packet.features if feat in SUPPORTED_FEATURES]
+    type_table = ser.type_table() if FEATURE_TYPE_IDS in features else None
+    conn.send(IdentifyResultPacket(player_id, features, type_table, lobby))
+    conn.features = frozenset(features)
+
+def apply_result(conn: Connection, packet: IdentifyResultPacket) -> None:
+    """Enables the features the server accepted on the client side of the connection"""
+    if packet.features is None:
+        return
+    if packet.type_table is not None:
+        ser.use_type_table(packet.type_table)
+    conn.features = frozenset(packet.features)
@@ -9,9 +9,10 @@ from optimax_rogue.logic.updates import GameStateUpdate
 from optimax_rogue.logic.updater import UpdateResult
 
 PACKET_TYPES = set()
-def register_packet(typ):
-    """Registers the specified packet for serialization/deserialization"""
-    ser.register(typ)
+def register_packet(typ, schema=None):
+    """Registers the specified packet for serialization/deserialization. See
+    serializer.register for the schema"""
+    ser.register(typ, schema)
     PACKET_TYPES.add(typ.identifier())
 
 class Packet(ser.Serializable):
@@ -60,7 +61,7 @@ class SyncPacket(Packet):
             return False
         return self.game_state == other.game_state and self.player_iden == other.player_iden
 
-register_packet(SyncPacket)
+register_packet(SyncPacket, (('game_state', ser.EMBED), ('player_iden', ser.PRIM)))
 
 class MovePacket(Packet):
     """This packet is sent from players to the server to indicate that they
@@ -90,7 +91,7 @@ class MovePacket(Packet):
     def from_prims(cls, prims) -> 'MovePacket':
         return cls(prims['entity_iden'], Move(prims['move']), prims['tick'])
 
-register_packet(MovePacket)
+register_packet(MovePacket, (('entity_iden', 'i'), ('move', ('B', Move)), ('tick', 'i')))
 
 class UpdatePacket(Packet):
     """Describes a packet associated with a game state update
@@ -111,13 +112,13 @@ class UpdatePacket(Packet):
     def from_prims(cls, prims) -> 'UpdatePacket':
         return cls(ser.deserialize_embeddable(prims['update']))
 
-register_packet(UpdatePacket)
+register_packet(UpdatePacket, (('update', ser.EMBED),))
 
 class TickStartPacket(Packet):
     """Describes a packet associated with a tick starting"""
     pass
 
-register_packet(TickStartPacket)
+register_packet(TickStartPacket, ())
 
 class TickEndPacket(Packet):
     """Describes a packet associated with the tick ending (now opening it
@@ -138,4 +139,33 @@ class TickEndPacket(Packet):
     def from_prims(cls, prims) -> 'TickEndPacket':
         return cls(UpdateResult(prims['result']))
 
-register_packet(TickEndPacket)
+register_packet(TickEndPacket, (('result', ('B', UpdateResult)),))
+
+class TickBundlePacket(Packet):
+    """Describes everything that happened during a tick. This is sent instead of a
+    TickStartPacket, the packets for the tick, and a TickEndPacket to connections
+    which support it
+
+    Attributes:
+        packets (list[Packet]): the UpdatePackets and SyncPackets for the tick, in the
+            order they should be handled
+        result (UpdateResult): the result of the tick
+    """
+    def __init__(self, packets: typing.List[Packet], result: UpdateResult): # pylint: disable=redefined-outer-name
+        if not isinstance(result, UpdateResult):
+            raise ValueError(f'expected result is UpdateResult, got {result} (type={type(result)})')
+        self.packets = packets
+        self.result = result
+
+    def to_prims(self):
+        return {
+            'packets': [ser.serialize_embeddable(packet) for packet in self.packets],
+            'result': int(self.result)
+        }
+
+    @classmethod
+    def from_prims(cls, prims) -> 'TickBundlePacket':
+        return cls([ser.deserialize_embeddable(packet) for packet in prims['packets']],
+                   UpdateResult(prims['result']))
+
+register_packet(TickBundlePacket, (('packets', ser.EMBED_LIST), ('result', ('B', UpdateResult))))
@@ -0,0 +1,154 @@
+"""Relays a game to spectators on behalf of the server, so that the server only has to
+feed the relay no matter how many are watching. Relays can watch other relays, so they
+can be chained into a tree
+"""
+import socket
+import typing
+import sys
+
+import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.shared as nshared
+import optimax_rogue.networking.handshake as handshake
+from optimax_rogue.networking.shared import Connection
+from optimax_rogue.networking.server import (
+    Audience, SPECTATOR_MAX_QUEUED_BYTES, SPECTATOR_MAX_LAG)
+from optimax_rogue.server.pregame import LobbyChangePacket
+from optimax_rogue.game.state import GameState
+from optimax_rogue.logic.updater import UpdateResult
+
+class Relay:
+    """Watches a game over a single spectator connection and serves it to spectators of
+    its own. It keeps a copy of the game as spectators see it, so spectators which join
+    late or fall behind are synced by the relay rather than the server.
+
+    Attributes:
+        upstream (Connection): the connection to the server or relay we are watching
+        listen_sock (socket.socket): the socket that our spectators connect to
+        identified (bool): True once the upstream answered our handshake. The type table
+            it sends replaces ours, so our spectators can't be answered before then
+        game_state (GameState, optional): the game as spectators see it, once we've
+            been synced
+        audience (Audience): our spectators. Spectators which connect before we've been
+            identified and synced wait to be accepted until we have been
+        tick_packets (list[Packet], optional): the packets of the tick we are in the middle
+            of receiving, if we are
+        result (UpdateResult, optional): how the game ended, once it has
+        running (bool): False once the game ended or we lost the upstream connection
+    """
+    def __init__(self, upstream: Connection, listen_sock: socket.socket,
+                 max_queued_bytes: int = SPECTATOR_MAX_QUEUED_BYTES,
+                 max_lag: float = SPECTATOR_MAX_LAG, outf = sys.stdout) -> None:
+        self.upstream = upstream
+        self.listen_sock = listen_sock
+        self.identified = False
+        self.game_state: typing.Optional[GameState] = None
+        self.audience = Audience(listen_sock,
+                                 lambda: packets.SyncPacket(self.game_state.view_spec(), None),
+                                 None, max_queued_bytes, max_lag, outf, 'relay')
+        self.tick_packets = None
+        self.result = None
+        self.running = True
+
+    @property
+    def outf(self):
+        """Where we output logs to"""
+        return self.audience.outf
+
+    @outf.setter
+    def outf(self, value):
+        self.audience.outf = value
+
+    def identify(self, lobby: typing.Optional[str] = None) -> None:
+        """Identifies us to the upstream as a spectator that supports every feature we do,
+        of the given lobby if the upstream hosts many"""
+        self.upstream.send(handshake.IdentifyPacket(b'', nshared.SUPPORTED_FEATURES, lobby))
+
+    def connections(self) -> typing.List[Connection]:
+        """Returns the upstream connection and every spectator"""
+        return [self.upstream] + self.audience.spectators
+
+    def accepting(self) -> bool:
+        """Returns True if we are accepting spectators, which we only do once we have
+        been identified and have something to sync them with"""
+        return self.running and self.identified and self.game_state is not None
+
+    def update(self, ready: typing.Optional[typing.Set[socket.socket]] = None) -> bool:
+        """Receives whatever the upstream sent and relays it, handles our spectators, and
+        accepts new ones. Returns False once the relay is done, though there may still be
+        things to send (see has_pending)
+
+        Args:
+            ready (set[socket.socket], optional): if specified, only these sockets are
+                ready (see networking.waiter), like in Server.update
+        """
+        self.update_queues(ready)
+
+        while self.running:
+            packet = self.upstream.read()
+            if packet is None:
+                break
+            self._handle_upstream(packet)
+
+        if self.running and self.upstream.disconnected():
+            print('[relay] lost the connection to the game', file=self.outf)
+            self.running = False
+
+        self.audience.update()
+        if self.accepting() and (ready is None or self.listen_sock in ready):
+            self.audience.accept()
+        return self.running
+
+    def update_queues(self, ready: typing.Optional[typing.Set[socket.socket]] = None):
+        """Sends pending messages and receives new ones. If ready is specified, only
+        connections whose socket is in it or which have something to send are updated"""
+        for conn in self.connections():
+            if ready is None or conn.connection in ready or conn.has_pending(read=False):
+                conn.update()
+
+    def has_pending(self) -> bool:
+        """Returns True if we have something left to send our spectators"""
+        return any(spec.has_pending(read=False) for spec in self.audience.spectators)
+
+    def _handle_upstream(self, packet: packets.Packet) -> None:
+        if isinstance(packet, handshake.IdentifyResultPacket):
+            handshake.apply_result(self.upstream, packet)
+            self.identified = True
+        elif isinstance(packet, packets.SyncPacket) and self.tick_packets is None:
+            self.game_state = packet.game_state
+            self.game_state.on_tick()
+            # we may have missed ticks, so our spectators need the new state too
+            self.audience.sync_all()
+        elif isinstance(packet, packets.TickStartPacket):
+            self.tick_packets = []
+        elif isinstance(packet, packets.TickEndPacket):
+            self._end_tick(self.tick_packets or [], packet.result)
+        elif isinstance(packet, packets.TickBundlePacket):
+            for bpacket in packet.packets:
+                self._apply(bpacket)
+            self._end_tick(packet.packets, packet.result)
+        elif isinstance(packet, (packets.UpdatePacket, packets.SyncPacket)) and self.tick_packets is not None:
+            self._apply(packet)
+            self.tick_packets.append(packet)
+        elif isinstance(packet, LobbyChangePacket):
+            print(f'[relay] lobby changed to {packet.result}', file=self.outf)
+            nshared.broadcast(self.audience.spectators, packet)
+            self.running = False
+        else:
+            print(f'[relay] upstream sent unexpected packet {packet} (type={type(packet)})', file=self.outf)
+
+    def _apply(self, packet: packets.Packet) -> None:
+        if isinstance(packet, packets.SyncPacket):
+            self.game_state = packet.game_state
+        else:
+            packet.update.apply(self.game_state)
+
+    def _end_tick(self, tick_packets: typing.List[packets.Packet], result: UpdateResult) -> None:
+        self.tick_packets = None
+        self.game_state.on_tick()
+        self.game_state.tick += 1
+        self.audience.send_tick(tick_packets, result)
+        if result != UpdateResult.InProgress:
+            print(f'[relay] game ended with result {result}', file=self.outf)
+            self.audience.report()
+            self.result = result
+            self.running = False
@@ -20,18 +20,38 @@ ser.register(M)
 
 # to serialize
 recov = ser.deserialize(ser.serialize(MyClass()))
+
+# to switch the process to the compact binary wire format
+ser.set_serializer(ser.BinarySerializer())
+
+Classes whose constructor takes a fixed list of fields may instead pass a schema to
+register, which generates a compact encoder and decoder for the class. These are used
+in place of to_prims / from_prims when talking to peers that have our type table:
+
+class Point(ser.Serializable):
+    def __init__(self, x: int, y: int, label: str):
+        ...
+
+ser.register(Point, schema=(('x', 'i'), ('y', 'i'), ('label', ser.PRIM)))
 """
 
 import typing
 import json
+import struct
+import operator
 import inflection
-from optimax_rogue.networking.a85encode import a85encode
-from base64 import a85decode
+from optimax_rogue.networking.a85encode import a85encode, a85decode
 
 
 class Serializer:
     """The interface that anything that is capable of serialization must
-    implement"""
+    implement
+
+    Attributes:
+        supports_bytes (bool): True if bytes may be passed to serialize() directly,
+            False if they must be converted to strings first
+    """
+    supports_bytes = False
 
     def serialize(self, val: typing.Any) -> bytes:
         """Converts the specified value, which may be a dict, list, set, number, string,
@@ -54,13 +74,106 @@ class JsonSerializer(Serializer):
     def deserialize(self, serd: bytes) -> typing.Any:
         """Deserializes the value from json format"""
         try:
-            return json.loads(serd.decode(encoding='ASCII', errors='strict'))
+            return json.loads(str(serd, encoding='ASCII', errors='strict'))
         except:
-            decoded = serd.decode(encoding='ASCII', errors='strict')
+            decoded = str(serd, encoding='ASCII', errors='strict')
             print('error when decoding:')
             print(decoded)
             raise
 
+class BinarySerializer(Serializer):
+    """Serializes to a length-prefixed binary format which supports bytes natively, so
+    objects with a custom serializer are embedded without a85-encoding them first.
+
+    The structure around the bytes is written as compact json by the json module's C
+    encoder, since walking values one at a time in python costs far more than json
+    does. Each bytes value is instead appended raw after the json, which refers to it
+    by {BLOB_KEY: [offset, length]}. The layout is
+
+        tag (1 byte, FORMAT_TAG) | json length (4 bytes) | json | bytes values
+
+    The tag is below 0x20, which json output never starts with, so deserialize() can
+    tell the two formats apart from the first byte. Like json, dict keys are strings
+    and tuples become lists, and a dict whose only key is BLOB_KEY can't be sent.
+    """
+    supports_bytes = True
+
+    FORMAT_TAG = 0x01
+    MAX_TAG = 0x01
+    BLOB_KEY = '\x00'
+    """The key of the dicts which stand in for bytes values in the json"""
+
+    def __init__(self) -> None:
+        self._encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False,
+                                         default=self._stash_blob)
+        self._decoder = json.JSONDecoder(object_hook=self._resolve_blob)
+        self._plain_decoder = json.JSONDecoder()
+        self._blobs = []
+        self._blobs_len = 0
+        self._blob_view = None
+
+    def serialize(self, val: typing.Any) -> bytes:
+        """Serializes the value to the binary format"""
+        self._blobs = []
+        self._blobs_len = 0
+        try:
+            serd = self._encoder.encode(val).encode('ascii', 'strict')
+            return b''.join([_HEADER_STRUCT.pack(self.FORMAT_TAG, len(serd)), serd]
+                            + self._blobs)
+        finally:
+            self._blobs = []
+
+    def _stash_blob(self, val: typing.Any) -> dict:
+        """The json default hook, which moves bytes values out of the json"""
+        if not isinstance(val, (bytes, bytearray, memoryview)):
+            raise TypeError(f'cannot binary serialize {val} (type={type(val)})')
+        view = memoryview(val).cast('B')
+        ref = {self.BLOB_KEY: [self._blobs_len, len(view)]}
+        self._blobs.append(view)
+        self._blobs_len += len(view)
+        return ref
+
+    def deserialize(self, serd: bytes) -> typing.Any:
+        """Deserializes the value from the binary format. Bytes values are returned as
+        memoryview slices of serd rather than copies, so custom serializers
+        can decode large payloads without copying them"""
+        tag, json_len = _HEADER_STRUCT.unpack_from(serd)
+        if tag != self.FORMAT_TAG:
+            raise ValueError(f'unknown binary format {tag}')
+        json_end = _HEADER_STRUCT.size + json_len
+        if json_end > len(serd):
+            raise ValueError(f'binary value is truncated ({len(serd)} of at least {json_end} bytes)')
+        text = str(serd[_HEADER_STRUCT.size:json_end], 'ascii', 'strict')
+        if _ESCAPED_BLOB_KEY not in text:
+            # nothing refers to a bytes value, so the object hook can be skipped
+            if json_end != len(serd):
+                raise ValueError(f'trailing data after binary value ({len(serd) - json_end} bytes)')
+            val, end = self._plain_decoder.raw_decode(text)
+        else:
+            self._blob_view = memoryview(serd)[json_end:]
+            try:
+                val, end = self._decoder.raw_decode(text)
+            finally:
+                self._blob_view = None
+        if end != len(text):
+            raise ValueError(f'trailing data after binary value ({len(text) - end} characters)')
+        return val
+
+    def _resolve_blob(self, obj: dict) -> typing.Any:
+        """The json object hook, which swaps references to bytes values for them"""
+        ref = obj.get(self.BLOB_KEY)
+        if ref is None or len(obj) != 1 or not isinstance(ref, list) or len(ref) != 2:
+            return obj
+        start, length = ref
+        if not isinstance(start, int) or not isinstance(length, int):
+            return obj
+        if start < 0 or length < 0 or start + length > len(self._blob_view):
+            raise ValueError(f'bytes value at {start} ({length} bytes) is out of range')
+        return self._blob_view[start:start + length]
+
+_HEADER_STRUCT = struct.Struct('>BI')
+_ESCAPED_BLOB_KEY = json.dumps(BinarySerializer.BLOB_KEY)[1:-1]
+
 class Serializable:
     """This is the base class for anything that can be serialized.
     """
@@ -79,8 +192,10 @@ class Serializable:
 
     @classmethod
     def from_prims_embeddable(cls, prims: str) -> 'Serializable':
-        """Converts the result of to_prims_embeddable back to an instance"""
-        if SERIALIZER_SUPPORTS_BYTES or not cls.has_custom_serializer():
+        """Converts the result of to_prims_embeddable back to an instance. Since
+        the sender may have used a different serializer than we do, this decides
+        if the primitives were a85-encoded based on their type"""
+        if not isinstance(prims, str) or not cls.has_custom_serializer():
             return cls.from_prims(prims)
         return cls.from_prims(a85decode(prims))
 
@@ -128,16 +243,211 @@ class SerializableDict(Serializable):
         return repr(self.attrs)
 
 IDENS_TO_TYPE = dict()
+TYPES_TO_IDEN = dict()
+ENCODERS = dict()
+DECODERS = dict()
+FIXED_LAYOUTS = dict()
+TYPE_TABLE = []
+TYPES_BY_ID = []
+TYPES_TO_ID = dict()
+_TYPE_TABLE_IS_LOCAL = True
+_EMBED_TYPE_IDS = False
+_OPTIONS = frozenset()
 SERIALIZER_SUPPORTS_BYTES = False
 SERIALIZER = JsonSerializer()
-
-def register(ser: type) -> None:
-    """Registers the specified serializable such that it can be deserialized"""
-    IDENS_TO_TYPE[ser.identifier()] = ser
+SERIALIZERS = {'json': JsonSerializer, 'binary': BinarySerializer}
+_JSON_SERIALIZER = JsonSerializer()
+_BINARY_SERIALIZER = BinarySerializer()
+
+def set_serializer(serializer: typing.Union[Serializer, str]) -> None:
+    """Changes the serializer used for everything this process serializes. May be
+    passed either a Serializer or one of the names in SERIALIZERS. Deserialization
+    detects the format, so peers using a different serializer are still understood
+    as long as they are running a version that knows about it."""
+    global SERIALIZER, SERIALIZER_SUPPORTS_BYTES # pylint: disable=global-statement
+    if isinstance(serializer, str):
+        serializer = SERIALIZERS[serializer]()
+    SERIALIZER = serializer
+    SERIALIZER_SUPPORTS_BYTES = serializer.supports_bytes
+
+EMBED = 'embed'
+"""Schema field kind for a nested Serializable"""
+
+PRIM = 'prim'
+"""Schema field kind for a primitive (or list / dict of primitives) that is passed
+through to the serializer unchanged"""
+
+EMBED_LIST = 'embed_list'
+"""Schema field kind for a list of nested Serializables"""
+
+EMBED_DICT = 'embed_dict'
+"""Schema field kind for a dict whose values are nested Serializables. It is sent as
+a list of [key, value] pairs so that non-string keys survive"""
+
+SEQ = 'seq'
+"""Schema field kind tag for a set, tuple or list of values. Used as (SEQ, conv) or
+(SEQ, conv, container), where conv is None to pass the values through unchanged, a
+callable to convert each value when decoding (e.g. CombatFlag), or EMBED for nested
+Serializables. The container (default list) is called with the decoded values"""
+
+def _serialize_embeddable_list(objs: typing.List[Serializable]) -> typing.List[typing.Any]:
+    """Encoder for EMBED_LIST fields"""
+    return [serialize_embeddable(obj) for obj in objs]
+
+def _deserialize_embeddable_list(serds: typing.List[typing.Any]) -> typing.List[Serializable]:
+    """Decoder for EMBED_LIST fields"""
+    return [deserialize_embeddable(serd) for serd in serds]
+
+def _serialize_embeddable_dict(objs: typing.Dict[typing.Any, Serializable]
+                              ) -> typing.List[typing.Any]:
+    """Encoder for EMBED_DICT fields"""
+    return [[key, serialize_embeddable(obj)] for key, obj in objs.items()]
+
+def _deserialize_embeddable_dict(serds: typing.List[typing.Any]
+                                ) -> typing.Dict[typing.Any, Serializable]:
+    """Decoder for EMBED_DICT fields"""
+    return dict((key, deserialize_embeddable(serd)) for key, serd in serds)
+
+def _seq_coders(kind: tuple) -> typing.Tuple[typing.Callable, typing.Callable]:
+    """Gets the encoder and decoder for a (SEQ, conv[, container]) field"""
+    conv = kind[1]
+    container = kind[2] if len(kind) > 2 else list
+    if conv is EMBED:
+        return (_serialize_embeddable_list,
+                lambda serds: container(deserialize_embeddable(serd) for serd in serds))
+    if conv is None:
+        return list, container
+    return list, lambda vals: container(conv(val) for val in vals)
+
+def _compile_schema(typ: type, schema: typing.Sequence[typing.Tuple[str, typing.Any]]
+                    ) -> typing.Tuple[typing.Callable, typing.Callable]:
+    """Generates the encoder and decoder for the given schema. See register()"""
+    names = tuple(name for name, _ in schema)
+    kinds = tuple(kind for _, kind in schema)
+    if not names:
+        getter = lambda obj: ()
+    elif len(names) == 1:
+        single_getter = operator.attrgetter(names[0])
+        getter = lambda obj: (single_getter(obj),)
+    else:
+        getter = operator.attrgetter(*names)
+
+    is_seq = tuple(isinstance(kind, tuple) and kind[0] == SEQ for kind in kinds)
+    convs = tuple(kind[1] if isinstance(kind, tuple) and not seq else None
+                  for kind, seq in zip(kinds, is_seq))
+    has_convs = any(conv is not None for conv in convs)
+
+    if not any(is_seq) and all(kind not in (EMBED, EMBED_LIST, EMBED_DICT, PRIM)
+                               for kind in kinds):
+        packer = struct.Struct('>' + ''.join(kind[0] if isinstance(kind, tuple) else kind
+                                             for kind in kinds))
+        FIXED_LAYOUTS[typ] = (packer, getter)
+
+        def encode_fixed(obj):
+            return list(getter(obj))
+
+        def decode_fixed(prims):
+            if has_convs:
+                return typ(*[val if conv is None else conv(val)
+                             for conv, val in zip(convs, prims)])
+            return typ(*prims)
+
+        return encode_fixed, decode_fixed
+
+    seq_coders = tuple(_seq_coders(kind) if seq else (None, None)
+                       for kind, seq in zip(kinds, is_seq))
+    encs = tuple(serialize_embeddable if kind is EMBED
+                 else _serialize_embeddable_list if kind is EMBED_LIST
+                 else _serialize_embeddable_dict if kind is EMBED_DICT
+                 else coders[0] for kind, coders in zip(kinds, seq_coders))
+    decs = tuple(deserialize_embeddable if kind is EMBED
+                 else _deserialize_embeddable_list if kind is EMBED_LIST
+                 else _deserialize_embeddable_dict if kind is EMBED_DICT
+                 else coders[1] if coders[1] is not None
+                 else conv for kind, conv, coders in zip(kinds, convs, seq_coders))
+
+    def encode_mixed(obj):
+        return [val if enc is None else enc(val) for enc, val in zip(encs, getter(obj))]
+
+    def decode_mixed(prims):
+        return typ(*[val if dec is None else dec(val) for dec, val in zip(decs, prims)])
+
+    return encode_mixed, decode_mixed
+
+def register(ser: type,
+             schema: typing.Optional[typing.Sequence[typing.Tuple[str, typing.Any]]] = None
+            ) -> None:
+    """Registers the specified serializable such that it can be deserialized. The
+    identifier is computed once here, and the type is given the next integer type id
+    unless we are using a type table from someone else (see use_type_table)
+
+    Args:
+        ser (type): the Serializable to register
+        schema (sequence, optional): if specified, a list of (attribute name, kind) in
+            the same order as the constructor arguments. The kind is a struct format
+            character (e.g. 'i'), a tuple of a struct format character and a callable
+            to convert the unpacked value (e.g. ('B', Move)), EMBED, EMBED_LIST,
+            EMBED_DICT, PRIM or a sequence (e.g. (SEQ, CombatFlag, set); see SEQ).
+            The class is sent as a list of values. If every field is a struct format it
+            also gets a fixed layout (see FIXED_LAYOUTS), which the fast path packs with
+            struct.
+    """
+    iden = ser.identifier()
+    IDENS_TO_TYPE[iden] = ser
+    TYPES_TO_IDEN[ser] = iden
+    if schema is not None:
+        ENCODERS[ser], DECODERS[ser] = _compile_schema(ser, schema)
+
+    if ser in TYPES_TO_ID:
+        return
+    if iden in TYPE_TABLE:
+        type_id = TYPE_TABLE.index(iden)
+        TYPES_BY_ID[type_id] = ser
+        TYPES_TO_ID[ser] = type_id
+    elif _TYPE_TABLE_IS_LOCAL:
+        TYPES_TO_ID[ser] = len(TYPE_TABLE)
+        TYPE_TABLE.append(iden)
+        TYPES_BY_ID.append(ser)
+
+def type_table() -> typing.List[str]:
+    """Gets the identifiers for each type id, where the index is the type id. This
+    is sent during the handshake so the other side can use our type ids"""
+    return list(TYPE_TABLE)
+
+def use_type_table(idens: typing.List[str]) -> None:
+    """Replaces our type ids with the ones from the given type table, which came
+    from type_table() on the other side of the connection. Types the other side
+    knows about that we do not are left as holes and will fail to deserialize, and
+    types we know about that they do not are always sent by identifier"""
+    global _TYPE_TABLE_IS_LOCAL # pylint: disable=global-statement
+    TYPE_TABLE.clear()
+    TYPES_BY_ID.clear()
+    TYPES_TO_ID.clear()
+    _TYPE_TABLE_IS_LOCAL = False
+    for type_id, iden in enumerate(idens):
+        typ = IDENS_TO_TYPE.get(iden)
+        TYPE_TABLE.append(iden)
+        TYPES_BY_ID.append(typ)
+        if typ is not None:
+            TYPES_TO_ID[typ] = type_id
 
 def serialize_embeddable(obj: Serializable) -> typing.Any:
-    """Serializes the given object in an embeddable way"""
-    return {'iden': obj.identifier(), 'prims': obj.to_prims_embeddable()}
+    """Serializes the given object in an embeddable way. Inside serialize() with
+    type_ids set this is [type id, prims], where prims come from the compiled
+    encoder if the type was registered with a schema. Otherwise it is a dict with
+    the full identifier and the result from to_prims"""
+    typ = type(obj)
+    if _EMBED_TYPE_IDS:
+        type_id = TYPES_TO_ID.get(typ)
+        if type_id is not None:
+            encoder = ENCODERS.get(typ)
+            if encoder is not None:
+                return [type_id, encoder(obj)]
+            return [type_id, obj.to_prims_embeddable()]
+    iden = TYPES_TO_IDEN.get(typ)
+    if iden is None:
+        iden = obj.identifier()
+    return {'iden': iden, 'prims': obj.to_prims_embeddable()}
 
 def _debug_dump(obj: Serializable):
     """Tries to fairly determine why something will fail to serialize"""
@@ -147,25 +457,67 @@ def _debug_dump(obj: Serializable):
         if isinstance(val, Serializable):
             _debug_dump(val)
 
-def serialize(obj: Serializable) -> bytes:
-    """Serializes the given object"""
+def serialize(obj: Serializable, type_ids: typing.Optional[bool] = None,
+              options: typing.Optional[typing.FrozenSet[str]] = None) -> bytes:
+    """Serializes the given object
+
+    Args:
+        obj (Serializable): the thing to serialize
+        type_ids (bool, optional): True to write integer type ids instead of identifiers,
+            which is only appropriate if the receiver has our type table. None to keep
+            whatever the enclosing serialize() call is using (False at the top level)
+        options (frozenset[str], optional): the optional encodings the receiver
+            understands, which custom serializers can check with option_enabled().
+            None to keep whatever the enclosing serialize() call is using (none at
+            the top level)
+    """
+    global _EMBED_TYPE_IDS, _OPTIONS # pylint: disable=global-statement
+    old_type_ids = _EMBED_TYPE_IDS
+    old_options = _OPTIONS
+    if type_ids is not None:
+        _EMBED_TYPE_IDS = type_ids
+    if options is not None:
+        _OPTIONS = options
     try:
         return SERIALIZER.serialize(serialize_embeddable(obj))
     except:
         _debug_dump(obj)
         raise
+    finally:
+        _EMBED_TYPE_IDS = old_type_ids
+        _OPTIONS = old_options
+
+def option_enabled(option: str) -> bool:
+    """Returns True if the receiver of the serialize() call in progress understands
+    the given optional encoding, False otherwise. Decoders should always accept every
+    encoding, so only the writer has to check this"""
+    return option in _OPTIONS
 
 def peek_type_embeddable(serd: typing.Any) -> typing.Type:
     """Returns the type of the serialized embeddable"""
+    if isinstance(serd, list):
+        typ = TYPES_BY_ID[serd[0]]
+        if typ is None:
+            raise KeyError(f'type id {serd[0]} ({TYPE_TABLE[serd[0]]}) is not registered')
+        return typ
     return IDENS_TO_TYPE[serd['iden']]
 
 def deserialize_embeddable(serd: typing.Any) -> Serializable:
     """Deserializes the result from serialize_embeddable() back into the object"""
-    typ = peek_type_embeddable(serd)
-    return typ.from_prims_embeddable(serd['prims'])
+    if isinstance(serd, list):
+        typ = TYPES_BY_ID[serd[0]]
+        if typ is None:
+            raise KeyError(f'type id {serd[0]} ({TYPE_TABLE[serd[0]]}) is not registered')
+        decoder = DECODERS.get(typ)
+        if decoder is not None and not isinstance(serd[1], dict):
+            return decoder(serd[1])
+        return typ.from_prims_embeddable(serd[1])
+    return IDENS_TO_TYPE[serd['iden']].from_prims_embeddable(serd['prims'])
 
 def deserialize(serd: bytes) -> Serializable:
     """Deserializes the result from serialize() back into the object"""
-    return deserialize_embeddable(SERIALIZER.deserialize(serd))
+    if serd and serd[0] <= BinarySerializer.MAX_TAG:
+        return deserialize_embeddable(_BINARY_SERIALIZER.deserialize(serd))
+    return deserialize_embeddable(_JSON_SERIALIZER.deserialize(serd))
 
 register(SerializableDict)
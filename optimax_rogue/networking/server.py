@@ -4,6 +4,8 @@ import socket
 import typing
 import time
 import sys
+import traceback
+from collections import Counter
 from contextlib import suppress
 
 import optimax_rogue.networking.packets as packets
@@ -11,7 +13,15 @@ from optimax_rogue.logic.updater import Updater, UpdateResult
 import optimax_rogue.logic.updates as updates
 from optimax_rogue.game.state import GameState
 from optimax_rogue.networking.shared import Connection
-import optimax_rogue.networking.serializer as ser
+import optimax_rogue.networking.shared as nshared
+import optimax_rogue.networking.handshake as handshake
+
+SPECTATOR_MAX_QUEUED_BYTES = 1 << 22
+"""How many bytes a spectator may have waiting to be sent before we drop its queued ticks
+and resync it once it has caught up"""
+SPECTATOR_MAX_LAG = 30.0
+"""How many seconds a spectator may take to catch up after falling behind before we
+disconnect it"""
 
 class PlayerConnection(Connection):
     """Describes a connection to the server by someone who is actually
@@ -32,25 +42,304 @@ class PlayerConnection(Connection):
         """Turns the generic connection into a player connection by associating with the
         given iden"""
         res = cls(other.connection, other.address, iden)
-        res.send_queue = other.send_queue
-        res.rec_queue = other.rec_queue
-        res.curr_send_packet = other.curr_send_packet
-        res.curr_rec = other.curr_rec
+        res._take_over(other) # pylint: disable=protected-access
         return res
 
+class BotPlayerConnection(PlayerConnection):
+    """Stands in for the connection of a player whose bot runs inside the server. Rather
+    than being sent the game and sending back its moves, the bot is called directly with
+    the same view of the authoritative game state that a connected player would be
+    synced with, so nothing is serialized for it. It has no socket, never has anything to
+    send or receive, and only disconnects if it is closed.
+
+    Since the view shares its entities and dungeons with the authoritative state, the bot
+    must not modify the game state it is given. It also isn't given time to think(), as
+    that would hold up the server.
+
+    Attributes:
+        make_bot (callable): makes the bot given the iden of the entity it controls, like
+            the constructor of an optimax_rogue_bots.bot.Bot
+        bot (Bot, optional): the bot, once the game has started
+        closed (bool): True if the bot was disconnected
+    """
+
+    def __init__(self, make_bot: typing.Callable[[int], typing.Any], entity_iden: int) -> None:
+        super().__init__(None, 'bot', entity_iden)
+        self.make_bot = make_bot
+        self.bot = None
+        self.closed = False
+
+    def disconnected(self):
+        return self.closed
+
+    def update(self):
+        """There is nothing to send or receive"""
+
+    def send(self, packet: packets.Packet):
+        """The bot looks at the game state instead, so this does nothing"""
+
+    def send_serd(self, packet_serd: bytes):
+        """The bot looks at the game state instead, so this does nothing"""
+
+    def has_pending(self, read=True, write=True) -> bool:
+        return False
+
+    def view(self, game_state: GameState) -> GameState:
+        """Gets the bots view of the given authoritative game state"""
+        return game_state.view_for(game_state.iden_lookup[self.entity_iden])
+
+    def start(self, game_state: GameState) -> None:
+        """Makes the bot and tells it that the given game is starting"""
+        self.bot = self.make_bot(self.entity_iden)
+        self.bot.started(self.view(game_state))
+
+    def choose_move(self, game_state: GameState) -> None:
+        """Asks the bot for its move in the given game state"""
+        view = self.view(game_state)
+        self.move = self.bot.move(view)
+        self.bot.on_move(view, self.move)
+
+    def finish(self, game_state: GameState, result: UpdateResult) -> None:
+        """Tells the bot that the game ended with the given result"""
+        self.bot.finished(self.view(game_state), result)
+
 class SpectatorConnection(Connection):
-    """Describes a connection to the server by someone who is watching the game"""
+    """Describes a connection to the server by someone who is watching the game
+
+    Attributes:
+        resyncing_since (float, optional): the time.time() at which we dropped the ticks
+            queued for this spectator because it fell too far behind, or None if it is
+            keeping up. It isn't sent ticks until it has caught up and been resynced
+        sync_bytes (int): how many bytes of the last sync for this spectator may still be
+            waiting to be sent. Snapshots can be large, so they don't count toward falling
+            behind (see sync_allowance)
+        sync_end (int): queued_packets right after the last sync was queued
+    """
+
+    def __init__(self, connection: socket.socket, address: str) -> None:
+        super().__init__(connection, address)
+        self.resyncing_since = None
+        self.sync_bytes = 0
+        self.sync_end = 0
 
     @classmethod
     def copy_from(cls, other: Connection):
         """Turns the generic connection into a spectator connection"""
         res = cls(other.connection, other.address)
-        res.send_queue = other.send_queue
-        res.rec_queue = other.rec_queue
-        res.curr_send_packet = other.curr_send_packet
-        res.curr_rec = other.curr_rec
+        res._take_over(other) # pylint: disable=protected-access
+        res.sync_bytes = res.queued_bytes
+        res.sync_end = res.queued_packets
         return res
 
+    def sync_allowance(self) -> int:
+        """Returns how many of the queued bytes may be the last sync. Until the sync is
+        moved to the send buffers that is all of it, and after that it is at most what
+        is left in them, so the allowance runs out as the sync is sent"""
+        if self.sync_bytes and self.committed_packets >= self.sync_end:
+            self.sync_bytes = min(self.sync_bytes, sum(len(buf) for buf in self.send_buffers))
+        return self.sync_bytes
+
+def broadcast_tick(conns: typing.List[Connection], tick_packets: typing.List[packets.Packet],
+                   result: UpdateResult, serds: typing.Optional[dict] = None) -> None:
+    """Sends a tick to each of the given connections, as one TickBundlePacket to those which
+    negotiated tick bundles and as a TickStartPacket, the packets and a TickEndPacket to
+    the rest. The serializations of the unbundled packets are kept in serds by id(packet),
+    so passing the same dict when sending the same packets to other connections this tick
+    avoids serializing them again"""
+    bundled = [conn for conn in conns if nshared.FEATURE_TICK_BUNDLES in conn.features]
+    if bundled:
+        nshared.broadcast(bundled, packets.TickBundlePacket(tick_packets, result))
+    if len(bundled) == len(conns):
+        return
+
+    if serds is None:
+        serds = dict()
+    unbundled = [conn for conn in conns if nshared.FEATURE_TICK_BUNDLES not in conn.features]
+    nshared.broadcast(unbundled, packets.TickStartPacket(), serds.setdefault('start', dict()))
+    for packet in tick_packets:
+        nshared.broadcast(unbundled, packet, serds.setdefault(id(packet), dict()))
+    nshared.broadcast(unbundled, packets.TickEndPacket(result), serds.setdefault('end', dict()))
+
+class Audience:
+    """The spectators of a game, who are all sent the same ticks. The server has one for
+    the spectators connected straight to it, and each relay has one for its own.
+
+    A spectator which has more than max_queued_bytes waiting to be sent after a tick has
+    its queued ticks dropped and is sent a fresh snapshot once it has caught up, or is
+    disconnected if that takes longer than max_lag seconds.
+
+    Attributes:
+        listen_sock (socket.socket, optional): the socket that spectators can connect to
+        snapshot (callable): returns the SyncPacket for a spectator which joins now
+        spectators (list[SpectatorConnection]): all the spectators
+
+        max_queued_bytes (int): how many bytes a spectator may have waiting to be sent
+            before its queued ticks are dropped and it is resynced
+        max_lag (float): how many seconds a spectator whose ticks were dropped may take
+            to catch up before it is disconnected. If 0 it is disconnected right away
+            rather than resynced
+        counters (Counter[str]): how often spectators fell behind ('overflows'), what was
+            dropped ('dropped_packets', 'dropped_bytes'), how many caught up and were
+            resynced ('resyncs'), and how many were disconnected instead ('lag_disconnects')
+
+        outf (filehandle): where we output logs to
+        tag (str): what our log lines start with
+
+        _snapshot (SyncPacket, optional): the packet sent to spectators synced during the
+            current tick, built when the first of them is
+        _snapshot_serds (dict): the serializations of _snapshot by encoding (see
+            nshared.broadcast), so spectators synced in the same tick share the same bytes
+    """
+    def __init__(self, listen_sock: typing.Optional[socket.socket],
+                 snapshot: typing.Callable[[], packets.SyncPacket],
+                 spectators: typing.Optional[typing.List[SpectatorConnection]] = None,
+                 max_queued_bytes: int = SPECTATOR_MAX_QUEUED_BYTES,
+                 max_lag: float = SPECTATOR_MAX_LAG,
+                 outf = sys.stdout, tag: str = 'server') -> None:
+        self.listen_sock = listen_sock
+        self.snapshot = snapshot
+        self.spectators = spectators if spectators is not None else []
+        self.max_queued_bytes = max_queued_bytes
+        self.max_lag = max_lag
+        self.counters = Counter()
+        self.outf = outf
+        self.tag = tag
+        self._snapshot = None
+        self._snapshot_serds = dict()
+
+    def update(self) -> None:
+        """Forgets spectators which disconnected, resyncs or disconnects those which fell
+        behind, and answers their handshakes. The connections should have been updated"""
+        for i in range(len(self.spectators) - 1, -1, -1):
+            spec = self.spectators[i]
+            if spec.disconnected():
+                print(f'[{self.tag}] a spectator disconnected', file=self.outf)
+                self.spectators.pop(i)
+                continue
+            self._check_resync(spec)
+            self._handle_spectator(spec)
+
+    def accept(self):
+        """Accepts every spectator waiting to join and syncs them. The sync is serialized
+        at most once per tick and encoding no matter how many join"""
+        if self.listen_sock is None:
+            return
+        with suppress(BlockingIOError):
+            while True:
+                conn, addr = self.listen_sock.accept()
+                print(f'[{self.tag}] got new connection from {addr}', file=self.outf)
+                conn.setblocking(0)
+                spec = SpectatorConnection(conn, addr)
+                self.sync(spec)
+                self.spectators.append(spec)
+
+    def join(self, conn: Connection, packet: handshake.IdentifyPacket,
+             lobby: typing.Optional[str] = None) -> None:
+        """Adds a spectator which already sent the given IdentifyPacket to someone else,
+        such as the host of many matches (see server.lobbies), answers it and syncs it"""
+        spec = SpectatorConnection.copy_from(conn)
+        handshake.respond(spec, packet, None, lobby)
+        self.sync(spec)
+        self.spectators.append(spec)
+
+    def sync(self, spec: SpectatorConnection) -> None:
+        """Sends the spectator the current state of the game, sharing the snapshot with
+        everyone else synced this tick"""
+        if self._snapshot is None:
+            self._snapshot = self.snapshot()
+        queued_bytes = spec.queued_bytes
+        nshared.broadcast([spec], self._snapshot, self._snapshot_serds)
+        spec.sync_bytes = spec.queued_bytes - queued_bytes
+        spec.sync_end = spec.queued_packets
+
+    def sync_all(self) -> None:
+        """Syncs every spectator which is keeping up with a fresh snapshot, for when the
+        game changed other than by a tick"""
+        self._snapshot = None
+        self._snapshot_serds = dict()
+        for spec in self.spectators:
+            if spec.resyncing_since is None and not spec.disconnected():
+                self.sync(spec)
+
+    def send_tick(self, tick_packets: typing.List[packets.Packet], result: UpdateResult,
+                  serds: typing.Optional[dict] = None) -> None:
+        """Sends the tick which just happened to every spectator which is keeping up (see
+        broadcast_tick), then drops the queued ticks of any which fell too far behind. If
+        the game is over, spectators still catching up at least learn how it ended"""
+        self._snapshot = None
+        self._snapshot_serds = dict()
+
+        keeping_up = [spec for spec in self.spectators if spec.resyncing_since is None]
+        starts = [spec.queued_packets for spec in keeping_up]
+        broadcast_tick(keeping_up, tick_packets, result, serds)
+        if result != UpdateResult.InProgress:
+            broadcast_tick([spec for spec in self.spectators if spec.resyncing_since is not None],
+                           [], result)
+
+        for spec, start in zip(keeping_up, starts):
+            spec.mark_droppable(start)
+            if result == UpdateResult.InProgress:
+                self._check_overflow(spec)
+
+    def report(self) -> None:
+        """Logs how spectators kept up, if any didn't"""
+        if self.counters:
+            print(f'[{self.tag}] spectator backpressure: {dict(self.counters)}', file=self.outf)
+
+    def _check_overflow(self, spec: SpectatorConnection) -> None:
+        """Called after queueing a tick for the spectator. If it has more waiting to be
+        sent than we allow, drops its queued ticks so that it can be resynced once it has
+        caught up, or disconnects it if we don't wait for spectators to catch up"""
+        if spec.disconnected():
+            return
+        if spec.queued_bytes <= self.max_queued_bytes + spec.sync_allowance():
+            return
+        self.counters['overflows'] += 1
+        if self.max_lag <= 0:
+            print(f'[{self.tag}] disconnecting spectator from {spec.address} which is '
+                  + f'{spec.queued_bytes} bytes behind', file=self.outf)
+            self.counters['lag_disconnects'] += 1
+            self._disconnect(spec)
+            return
+
+        behind = spec.queued_bytes
+        dropped_packets, dropped_bytes = spec.drop_queued()
+        self.counters['dropped_packets'] += dropped_packets
+        self.counters['dropped_bytes'] += dropped_bytes
+        spec.resyncing_since = time.time()
+        print(f'[{self.tag}] spectator from {spec.address} is {behind} bytes behind; dropped '
+              + f'{dropped_packets} packets and will resync it', file=self.outf)
+
+    def _check_resync(self, spec: SpectatorConnection) -> None:
+        """If we dropped ticks for the spectator, resyncs it once it has sent everything
+        that was left, or disconnects it if that is taking too long"""
+        if spec.resyncing_since is None:
+            return
+        if not spec.has_pending(read=False):
+            spec.resyncing_since = None
+            self.counters['resyncs'] += 1
+            self.sync(spec)
+        elif time.time() - spec.resyncing_since > self.max_lag:
+            print(f'[{self.tag}] disconnecting spectator from {spec.address} which took more '
+                  + f'than {self.max_lag}s to catch up', file=self.outf)
+            self.counters['lag_disconnects'] += 1
+            self._disconnect(spec)
+
+    def _disconnect(self, spec: SpectatorConnection) -> None:
+        with suppress(OSError):
+            spec.connection.shutdown(socket.SHUT_RDWR)
+        spec.connection = None
+
+    def _handle_spectator(self, spec: SpectatorConnection) -> None:
+        while True:
+            packet = spec.read()
+            if packet is None:
+                return
+            if isinstance(packet, handshake.IdentifyPacket):
+                handshake.respond(spec, packet, None)
+            else:
+                print(f'[{self.tag}] spectator sent unexpected packet {packet} (type={type(packet)})', file=self.outf)
+
 class Server:
     """Handles the glue that allows the game to update while informing all clients
 
@@ -62,10 +351,14 @@ class Server:
 
         listen_sock (socket.socket): the socket that spectators can connect to
 
-        player1_conn (PlayerConnection): the connection from player 1
-        player2_conn (PlayerConnection): the connection from player 2
+        player1_conn (PlayerConnection): the connection from player 1, which is a
+            BotPlayerConnection if their bot runs inside the server
+        player2_conn (PlayerConnection): the connection from player 2, like player1_conn
 
-        spectators (SpectatorConnection): all the spectators
+        audience (Audience): the spectators, who are dropped and resynced if they fall
+            more than spec_max_queued_bytes behind (see Audience). Players never are
+        spectators (list[SpectatorConnection]): all the spectators
+        spec_counters (Counter[str]): how the spectators kept up (see Audience.counters)
 
         _last_tick (float): last time.time() we ticked
 
@@ -76,7 +369,9 @@ class Server:
                  listen_sock: socket.socket,
                  player1_conn: PlayerConnection, player2_conn: PlayerConnection,
                  spectators: typing.List[SpectatorConnection],
-                 outf = sys.stdout):
+                 outf = sys.stdout,
+                 spec_max_queued_bytes: int = SPECTATOR_MAX_QUEUED_BYTES,
+                 spec_max_lag: float = SPECTATOR_MAX_LAG):
         if not game_state.is_authoritative:
             raise ValueError('server must have authoritative game state')
         if not isinstance(player1_conn, PlayerConnection):
@@ -89,14 +384,40 @@ class Server:
         self.listen_sock = listen_sock
         self.player1_conn = player1_conn
         self.player2_conn = player2_conn
-        self.spectators = spectators
+        self.audience = Audience(listen_sock,
+                                 lambda: packets.SyncPacket(self.game_state.view_spec(), None),
+                                 spectators, spec_max_queued_bytes, spec_max_lag, outf)
         self._last_tick = time.time()
-        self.outf = outf
 
-    def update(self) -> UpdateResult:
+    @property
+    def spectators(self) -> typing.List[SpectatorConnection]:
+        """All the spectators"""
+        return self.audience.spectators
+
+    @property
+    def spec_counters(self) -> Counter:
+        """How the spectators kept up (see Audience.counters)"""
+        return self.audience.counters
+
+    @property
+    def outf(self):
+        """Where we output logs to"""
+        return self.audience.outf
+
+    @outf.setter
+    def outf(self, value):
+        self.audience.outf = value
+
+    def update(self, ready: typing.Optional[typing.Set[socket.socket]] = None) -> UpdateResult:
         """Handles moving the world along and scanning for new / disconnected spectators
+
+        Args:
+            ready (set[socket.socket], optional): if specified, only these sockets are
+                ready (see networking.waiter), so connections with nothing to send whose
+                socket isn't in here are skipped, as is accepting new spectators unless
+                the listen socket is in here. Otherwise everything is polled
         """
-        self.update_queues()
+        self.update_queues(ready)
 
         if self.player1_conn.disconnected() and self.player2_conn.disconnected():
             print('[server] both players disconnected -> tie', file=self.outf)
@@ -110,10 +431,7 @@ class Server:
             print('[server] game ended by player 2 disconnecting', file=self.outf)
             return UpdateResult.Player1Win
 
-        for i in range(len(self.spectators) - 1, -1, -1):
-            if self.spectators[i].disconnected():
-                print('[server] a spectator disconnected', file=self.outf)
-                self.spectators.pop(i)
+        self.audience.update()
 
         self._handle_player(self.player1_conn)
         self._handle_player(self.player2_conn)
@@ -121,32 +439,66 @@ class Server:
         if (self.player1_conn.move is not None and self.player2_conn.move is not None
                 and time.time() >= self._last_tick + self.tickrate):
             self._last_tick = time.time()
+            return self._tick()
 
-            self._broadcast_packet(packets.TickStartPacket())
-            result, upds = self.updater.update(self.game_state, self.player1_conn.move,
-                                               self.player2_conn.move)
-
-            for upd in upds:
-                self._broadcast_update(upd)
-            self._broadcast_packet(packets.TickEndPacket(result))
-
-            if result != UpdateResult.InProgress:
-                print(f'[server] game ended normally with result {result}', file=self.outf)
-
-            self.player1_conn.move = None
-            self.player2_conn.move = None
-            return result
-
-        self._check_new_spectators()
+        if ready is None or self.listen_sock in ready:
+            self.audience.accept()
 
         return UpdateResult.InProgress
 
-    def update_queues(self):
-        """Sends pending messages"""
-        self.player1_conn.update()
-        self.player2_conn.update()
-        for spec in self.spectators:
-            spec.update()
+    def connections(self) -> typing.List[Connection]:
+        """Returns the connections to both players, unless their bot runs inside the
+        server, and every spectator"""
+        return [conn for conn in (self.player1_conn, self.player2_conn)
+                if not isinstance(conn, BotPlayerConnection)] + self.spectators
+
+    def time_until_tick(self) -> typing.Optional[float]:
+        """Returns the seconds until the next tick can happen, which is 0 if it can
+        happen now, or None if we are waiting on a player to choose their move. Bots
+        which run inside the server choose theirs as soon as we update"""
+        for player in (self.player1_conn, self.player2_conn):
+            if player.move is None and not isinstance(player, BotPlayerConnection):
+                return None
+        return max(0.0, self._last_tick + self.tickrate - time.time())
+
+    def _tick(self) -> UpdateResult:
+        """Moves the game forward using the current player moves and sends everyone
+        the result. Each distinct packet is serialized once per encoding rather than
+        once per connection"""
+        result, upds = self.updater.update(self.game_state, self.player1_conn.move,
+                                           self.player2_conn.move)
+
+        p1_packets, p2_packets, spec_packets = [], [], []
+        for upd in upds:
+            self._broadcast_update(upd, p1_packets, p2_packets, spec_packets)
+
+        serds = dict()
+        for player, player_packets in ((self.player1_conn, p1_packets),
+                                       (self.player2_conn, p2_packets)):
+            if not isinstance(player, BotPlayerConnection):
+                broadcast_tick([player], player_packets, result, serds)
+        self.audience.send_tick(spec_packets, result, serds)
+
+        if result != UpdateResult.InProgress:
+            print(f'[server] game ended normally with result {result}', file=self.outf)
+            self.audience.report()
+            for player in (self.player1_conn, self.player2_conn):
+                if isinstance(player, BotPlayerConnection) and not player.disconnected():
+                    try:
+                        player.finish(self.game_state, result)
+                    except Exception: # pylint: disable=broad-except
+                        traceback.print_exc(file=self.outf)
+
+        self.player1_conn.move = None
+        self.player2_conn.move = None
+        return result
+
+    def update_queues(self, ready: typing.Optional[typing.Set[socket.socket]] = None):
+        """Sends pending messages and receives new ones. If ready is specified, only
+        connections whose socket is in it or which have something to send are updated"""
+        for conn in self.connections():
+            if ready is None or conn.connection in ready or conn.has_pending(read=False):
+                conn.update()
 
     def has_pending(self):
         """Returns True if there are pending messages, False otherwise"""
@@ -158,30 +510,25 @@ class Server:
             if spec.has_pending(read=False):
                 return True
 
-
-    def _check_new_spectators(self):
-        with suppress(BlockingIOError):
-            conn, addr = self.listen_sock.accept()
-            print(f'[server] got new connection from {addr}', file=self.outf)
-            conn.setblocking(0)
-            spec = SpectatorConnection(conn, addr)
-            spec.send(packets.SyncPacket(self.game_state.view_spec(), None))
-            self.spectators.append(spec)
-
-    def _broadcast_update(self, update: updates.GameStateUpdate):
+    def _broadcast_update(self, update: updates.GameStateUpdate,
+                          p1_packets: typing.List[packets.Packet],
+                          p2_packets: typing.List[packets.Packet],
+                          spec_packets: typing.List[packets.Packet]):
+        """Decides what each connection needs to be sent for the given update, appending
+        it to the packets for that connection this tick"""
         p1_handled = False
         p2_handled = False
         if isinstance(update, updates.EntityPositionUpdate) and update.depth_changed:
             update: updates.EntityPositionUpdate
             if update.entity_iden == self.player1_conn.entity_iden:
-                self.player1_conn.send(
+                p1_packets.append(
                     packets.SyncPacket(self.game_state.view_for(
                         self.game_state.player_1, reduce_tick=True
                     ), self.player1_conn.entity_iden)
                 )
                 p1_handled = True
             elif update.entity_iden == self.player2_conn.entity_iden:
-                self.player2_conn.send(
+                p2_packets.append(
                     packets.SyncPacket(self.game_state.view_for(
                         self.game_state.player_2, reduce_tick=True
                     ), self.player2_conn.entity_iden)
@@ -189,7 +536,7 @@ class Server:
                 p2_handled = True
 
             if not p1_handled and update.depth == self.game_state.player_1.depth:
-                self.player1_conn.send(
+                p1_packets.append(
                     packets.UpdatePacket(updates.EntitySpawnUpdate(
                         self.updater.get_incr_upd_order(),
                         self.game_state.iden_lookup[update.entity_iden]
@@ -198,37 +545,38 @@ class Server:
                 p1_handled = True
 
             if not p2_handled and update.depth == self.game_state.player_2.depth:
-                self.player2_conn.send(
+                p2_packets.append(
                     packets.UpdatePacket(updates.EntitySpawnUpdate(
                         self.updater.get_incr_upd_order(),
                         self.game_state.iden_lookup[update.entity_iden]
                     ))
                 )
-                p1_handled = True
-
+                p2_handled = True
 
+        packet = packets.UpdatePacket(update)
         if not isinstance(update, updates.DungeonCreatedUpdate):
             if not p1_handled and update.relevant_for(
                     self.game_state,
                     self.game_state.iden_lookup[self.player1_conn.entity_iden].depth):
-                self.player1_conn.send(packets.UpdatePacket(update))
+                p1_packets.append(packet)
 
             if not p2_handled and update.relevant_for(
                     self.game_state,
                     self.game_state.iden_lookup[self.player2_conn.entity_iden].depth):
-                self.player2_conn.send(packets.UpdatePacket(update))
+                p2_packets.append(packet)
 
-        for spec in self.spectators:
-            spec.send(packets.UpdatePacket(update))
-
-    def _broadcast_packet(self, packet: packets.Packet):
-        serd = ser.serialize(packet)
-        self.player1_conn.send_serd(serd)
-        self.player2_conn.send_serd(serd)
-        for spec in self.spectators:
-            spec.send_serd(serd)
+        spec_packets.append(packet)
 
     def _handle_player(self, player: PlayerConnection) -> None:
+        if isinstance(player, BotPlayerConnection):
+            if player.move is None:
+                try:
+                    player.choose_move(self.game_state)
+                except Exception: # pylint: disable=broad-except
+                    # the same as a bot outside the server crashing
+                    traceback.print_exc(file=self.outf)
+                    self._disconnect_player(player)
+            return
         while True:
             packet = player.read()
             if packet is None:
@@ -257,5 +605,8 @@ class Server:
         else:
             print('[server] forcibly disconnecting a player', file=self.outf)
 
+        if isinstance(player, BotPlayerConnection):
+            player.closed = True
+            return
         player.connection.shutdown(socket.SHUT_RDWR)
         player.connection = None
@@ -1,21 +1,250 @@
 """Shared networking components (ie. networking protocol)
 """
+import contextlib
+import errno
+import os
 import socket
+import stat
 try:
     from queue import SimpleQueue as Queue
 except:
     from queue import Queue as Queue
 
-import io
+import struct
+import time
 import typing
 import traceback
+import zlib
 from collections import deque
 
 import optimax_rogue.networking.packets as packets
 import optimax_rogue.networking.serializer as ser
+import optimax_rogue.networking.fastpath as fastpath
+import optimax_rogue.game.world as world
+import optimax_rogue.game.state as state
 
 BLOCK_SIZE = 4096
 
+SOCKET_BUFFER_SIZE = 1 << 20
+"""The kernel send and receive buffer sizes we ask for on each connection, so that a big
+sync or a busy tick is taken by the kernel in one update rather than trickling out over
+many. The kernel may cap this"""
+
+REC_BUFFER_SIZE = 1 << 16
+"""The size of the buffer packets are received into. Packets larger than this get a
+buffer of their own"""
+MIN_IO_BUDGET = 1 << 19
+"""The bytes a connection may send, and separately receive, in one update while it is
+keeping up"""
+MAX_IO_BUDGET = 1 << 23
+"""How far the budget of a connection which is falling behind may grow"""
+IO_TIME_BUDGET = 0.005
+"""Roughly the most seconds a connection spends sending, and separately receiving, in
+one update, so that one busy connection doesn't hold up the rest"""
+BEHIND_REPORT_UPDATES = 8
+"""How many updates in a row a connection must run out of budget before it is
+reported as falling behind"""
+MAX_SEND_BUFFERS = 64
+"""The most buffers (two per packet) that are passed to one sendmsg. Well under IOV_MAX
+everywhere"""
+SEND_COALESCE_SIZE = 1 << 16
+"""Where sendmsg isn't available, buffers are joined until they are this large before
+sending them so that small packets still share a syscall"""
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+FEATURE_TYPE_IDS = 'typeids'
+"""Packets sent on the connection use integer type ids from the servers type table"""
+
+FEATURE_COMPACT_DUNGEONS = world.COMPACT_DUNGEONS_OPTION
+"""Dungeons sent on the connection use the smallest of the compact tile encodings"""
+
+FEATURE_COLUMNAR_ENTITIES = state.COLUMNAR_ENTITIES_OPTION
+"""Entities in game states sent on the connection are written as a columnar block"""
+
+FEATURE_DUNGEON_CACHE = 'dcache'
+"""Dungeons the peer was already sent on the connection are sent as just their content
+hash (see game.world.DungeonCache)"""
+
+FEATURE_COMPRESSION = 'zlib'
+"""Packets sent on the connection may be compressed with a zlib stream which lasts for the
+whole connection, so later packets are compressed against earlier ones"""
+
+FEATURE_TICK_BUNDLES = 'bundles'
+"""Each tick is sent on the connection as one TickBundlePacket rather than a TickStartPacket,
+the packets for the tick, and a TickEndPacket"""
+
+FEATURE_FAST_PATH = 'fastpath'
+"""The most common small packets are sent on the connection with a fixed layout rather than
+through the serializer (see networking.fastpath)"""
+
+SUPPORTED_FEATURES = frozenset((FEATURE_TYPE_IDS, FEATURE_COMPACT_DUNGEONS, FEATURE_COLUMNAR_ENTITIES,
+                                FEATURE_DUNGEON_CACHE, FEATURE_COMPRESSION, FEATURE_TICK_BUNDLES,
+                                FEATURE_FAST_PATH))
+"""The optional protocol features this version knows about (see networking.handshake)"""
+
+DUNGEON_CACHE_SIZE = 32
+"""How many of the dungeons we send we assume the peer is holding onto. We hold onto
+twice as many of the dungeons we receive so that the peer never refers to one we've
+dropped"""
+
+COMPRESSION_THRESHOLD = 8
+"""Packets shorter than this are never compressed"""
+COMPRESSION_LEVEL = 6
+COMPRESSION_WBITS = -12
+"""Raw deflate with a 4kb window, which is plenty for a ticks worth of packets and keeps
+the compressor for each connection at about 32kb. We always decompress with the largest
+window so this can change without breaking older peers"""
+COMPRESSION_MEMLEVEL = 5
+
+_COMPRESSED_FLAG = 1 << 31
+"""Set in the length prefix of a packet if it is compressed. Uncompressed packets never
+get this large"""
+_SYNC_FLUSH_TAIL = b'\x00\x00\xff\xff'
+"""Every Z_SYNC_FLUSH ends with these bytes, so they are stripped before sending and
+added back before decompressing"""
+
+_LENGTH_STRUCT = struct.Struct('>I')
+
+def configure_socket(sock: socket.socket) -> None:
+    """Asks for SOCKET_BUFFER_SIZE kernel buffers on the given socket. Not every
+    platform or socket allows this, in which case the defaults are kept"""
+    for opt in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            if sock.getsockopt(socket.SOL_SOCKET, opt) < SOCKET_BUFFER_SIZE:
+                sock.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER_SIZE)
+        except OSError:
+            pass
+
+def _unix_family() -> int:
+    family = getattr(socket, 'AF_UNIX', None)
+    if family is None:
+        raise ValueError('unix domain sockets are not supported on this platform')
+    return family
+
+def remove_stale_socket(unix_path: str) -> None:
+    """Removes the unix domain socket at the given path if it was left behind by a server
+    which is gone, so that we can listen there. Raises OSError (EADDRINUSE) if something
+    is still listening on it, since taking the path would cut it off from its clients"""
+    try:
+        if not stat.S_ISSOCK(os.stat(unix_path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+
+    with socket.socket(_unix_family(), socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(unix_path)
+        except ConnectionRefusedError:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(unix_path)
+            return
+    raise OSError(errno.EADDRINUSE, f'something is already listening on {unix_path}')
+
+@contextlib.contextmanager
+def listening(host: str, port: int, unix_path: typing.Optional[str] = None):
+    """Listens on the given host and port, or on the unix domain socket at unix_path if
+    specified, yielding the non-blocking listening socket and closing it afterward. A
+    unix domain socket replaces a stale socket left at its path (see remove_stale_socket),
+    and is removed once we are done with it"""
+    if unix_path is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = (host, port)
+    else:
+        remove_stale_socket(unix_path)
+        sock = socket.socket(_unix_family(), socket.SOCK_STREAM)
+        address = unix_path
+
+    with sock:
+        sock.bind(address)
+        try:
+            sock.setblocking(0)
+            sock.listen()
+            yield sock
+        finally:
+            if unix_path is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(unix_path)
+
+def connect(host: str, port: int, unix_path: typing.Optional[str] = None) -> socket.socket:
+    """Connects to the given host and port, or to the unix domain socket at unix_path if
+    specified, returning the non-blocking socket for a Connection"""
+    if unix_path is None:
+        sock = socket.create_connection((host, port))
+    else:
+        sock = socket.socket(_unix_family(), socket.SOCK_STREAM)
+        try:
+            sock.connect(unix_path)
+        except:
+            sock.close()
+            raise
+    sock.setblocking(False)
+    return sock
+
+def bound_address(sock: socket.socket) -> typing.Tuple[str, typing.Optional[int]]:
+    """Gets the host and port the listening socket is bound on, or its path and None if it
+    is a unix domain socket"""
+    address = sock.getsockname()
+    if isinstance(address, tuple):
+        return address[0], address[1]
+    if isinstance(address, bytes):
+        address = address.decode('utf-8', 'replace')
+    return address, None
+
+def describe_address(host: str, port: typing.Optional[int]) -> str:
+    """Describes the result of bound_address for logs"""
+    if port is None:
+        return f'unix socket {host}'
+    return f'host {host}, port {port}'
+
+class IOBudget:
+    """How much a connection may send or receive in one update. Whenever an update runs
+    out of budget with more still to do the byte budget doubles, up to max_bytes, and
+    once the connection is keeping up again it halves back down to min_bytes. That way
+    a connection which is falling behind catches up in a few updates, while no single
+    update spends more than time_limit on it.
+
+    Attributes:
+        min_bytes (int): the byte budget while the connection is keeping up
+        max_bytes (int): the most the byte budget grows to
+        time_limit (float, optional): roughly the most seconds to spend in one update, or
+            None for no limit
+        bytes (int): the current byte budget
+        behind (int): how many updates in a row ran out of budget with more to do
+    """
+    def __init__(self, min_bytes: int = MIN_IO_BUDGET, max_bytes: int = MAX_IO_BUDGET,
+                 time_limit: typing.Optional[float] = IO_TIME_BUDGET) -> None:
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.time_limit = time_limit
+        self.bytes = min_bytes
+        self.behind = 0
+
+    def deadline(self) -> typing.Optional[float]:
+        """Returns the perf_counter() at which an update starting now should stop, or
+        None if there is no time limit"""
+        return None if self.time_limit is None else time.perf_counter() + self.time_limit
+
+    def exceeded(self, used: int, deadline: typing.Optional[float]) -> bool:
+        """Returns True if an update which has used the given number of bytes and was
+        given the deadline from deadline() should stop"""
+        return used >= self.bytes or (deadline is not None and time.perf_counter() >= deadline)
+
+    def finish(self, used: int, exhausted: bool) -> None:
+        """Adapts the budget after an update which used the given number of bytes, and
+        which ran out of budget with more to do if exhausted is True"""
+        if exhausted:
+            self.behind += 1
+            self.bytes = min(self.bytes * 2, self.max_bytes)
+        else:
+            self.behind = 0
+            if used < self.bytes // 2:
+                self.bytes = max(self.bytes // 2, self.min_bytes)
+
+    def falling_behind(self) -> bool:
+        """Returns True if the connection has been running out of budget for long enough
+        that it is unlikely to catch up on its own"""
+        return self.behind >= BEHIND_REPORT_UPDATES
+
 class Connection:
     """Describes a connection either from the server to some client or from the client
     to the server
@@ -25,12 +254,44 @@ class Connection:
         address (str): where the entity connected from / where we connected to
 
         send_queue (queue[bytes]): the packets that we need to send
-        rec_queue (queue[Packet]): the packets that they have sent us
+        rec_queue (queue[bytes]): the packets that they have sent us which have not yet
+            been deserialized. Deserialization happens in read() so that anything
+            negotiated by earlier packets is in effect for later ones
 
-        curr_send_packet (optional BytesIO): if we are currently trying to send a message
-            to the client, this is the serialized message we are trying to send (that has
-            already been removed from the send_queue)
-        curr_rec (deque[bytes]): the things that we have in memory received
+        send_buffers (deque[memoryview]): the length prefixes and packets taken from the
+            send_queue that haven't been fully sent yet. The first may be partially sent,
+            in which case it is a view of what is left
+        queued_bytes (int): how many of the bytes we were asked to send haven't been sent
+        queued_packets (int): how many packets have been queued on this connection
+        committed_packets (int): how many of those were moved to send_buffers, after
+            which they can't be dropped
+        droppable (deque[tuple[int, int]]): the ranges [start, end) of packet numbers
+            which drop_queued may drop (see mark_droppable)
+        rec_buffer (bytearray): what we receive is written here with recv_into, and
+            packets are handed to rec_queue as memoryviews into it
+        rec_start (int): where the bytes in rec_buffer we haven't parsed yet start
+        rec_end (int): where the bytes we have received in rec_buffer end
+        rec_exported (bool): True if part of rec_buffer was handed out. Decoded objects
+            may still refer to it, so it is never written over; when it runs out of
+            room the unparsed bytes are moved to a new buffer instead
+
+        send_budget (IOBudget): how much we send each update
+        rec_budget (IOBudget): how much we receive each update
+        reported_behind (bool): True if we've reported that this connection is falling
+            behind and haven't yet reported that it caught up
+
+        features (frozenset[str]): the optional protocol features negotiated for this
+            connection during the handshake
+        sent_dungeons (DungeonCache): the dungeons the peer is holding onto from us, if
+            the dungeon cache feature is used
+        received_dungeons (DungeonCache): the dungeons we are holding onto from the peer,
+            if the dungeon cache feature is used
+
+        compressor (zlib.Compress, optional): the stream we compress packets with, if
+            we've compressed anything yet
+        decompressor (zlib.Decompress, optional): the stream we decompress packets
+            with, if we've received anything compressed yet. Compressed packets are
+            always accepted, so only the sender needs the compression feature
     """
     def __init__(self, connection: socket.socket, address: str) -> None:
         self.connection = connection
@@ -39,8 +300,77 @@ class Connection:
         self.send_queue = Queue()
         self.rec_queue = Queue()
 
-        self.curr_send_packet: io.BytesIO = None
-        self.curr_rec = deque()
+        self.send_buffers = deque()
+        self.queued_bytes = 0
+        self.queued_packets = 0
+        self.committed_packets = 0
+        self.droppable = deque()
+        self.rec_buffer = bytearray(REC_BUFFER_SIZE)
+        self.rec_start = 0
+        self.rec_end = 0
+        self.rec_exported = False
+
+        self.send_budget = IOBudget()
+        self.rec_budget = IOBudget()
+        self.reported_behind = False
+        if isinstance(connection, socket.socket):
+            configure_socket(connection)
+
+        self.features = frozenset()
+        self.sent_dungeons = world.DungeonCache(DUNGEON_CACHE_SIZE)
+        self.received_dungeons = world.DungeonCache(DUNGEON_CACHE_SIZE * 2)
+
+        self.compressor = None
+        self.decompressor = None
+
+    def _take_over(self, other: 'Connection') -> None:
+        """Takes over all of the state from the given connection, which should not be
+        used afterward. Used to change the type of a connection once we know who it is"""
+        self.send_queue = other.send_queue
+        self.rec_queue = other.rec_queue
+        self.send_buffers = other.send_buffers
+        self.queued_bytes = other.queued_bytes
+        self.queued_packets = other.queued_packets
+        self.committed_packets = other.committed_packets
+        self.droppable = other.droppable
+        self.rec_buffer = other.rec_buffer
+        self.rec_start = other.rec_start
+        self.rec_end = other.rec_end
+        self.rec_exported = other.rec_exported
+        self.send_budget = other.send_budget
+        self.rec_budget = other.rec_budget
+        self.reported_behind = other.reported_behind
+        self.features = other.features
+        self.sent_dungeons = other.sent_dungeons
+        self.received_dungeons = other.received_dungeons
+        self.compressor = other.compressor
+        self.decompressor = other.decompressor
+
+    @property
+    def encoding(self) -> typing.Hashable:
+        """Connections with the same encoding can be sent the same serialized packets"""
+        return self.features
+
+    def serialize(self, packet: packets.Packet) -> bytes:
+        """Serializes the packet the way this connection expects it. The result may refer
+        to dungeons sent earlier on this connection, so it must not be sent on any other
+        connection (see broadcast)"""
+        cache = self.sent_dungeons if FEATURE_DUNGEON_CACHE in self.features else None
+        return self.serialize_with_cache(packet, cache)
+
+    def serialize_with_cache(
+            self, packet: packets.Packet,
+            cache: typing.Optional[typing.Union[world.DungeonCache, world.DungeonRecorder]]
+        ) -> bytes:
+        """Serializes the packet the way this connection expects it, using the given
+        cache for dungeons rather than the one for this connection"""
+        if FEATURE_FAST_PATH in self.features:
+            serd = fastpath.encode(packet)
+            if serd is not None:
+                return serd
+        with world.using_dungeon_cache(cache):
+            return ser.serialize(packet, type_ids=FEATURE_TYPE_IDS in self.features,
+                                 options=self.features)
 
     def disconnected(self):
         """Returns True if the connection is dead for whatever reason, False otherwise"""
@@ -62,111 +392,241 @@ class Connection:
             self.connection = None
             print(f'[networking.shared] connection lost')
             traceback.print_exc()
+            return
+
+        if self.falling_behind() != self.reported_behind:
+            self.reported_behind = not self.reported_behind
+            if self.reported_behind:
+                print(f'[networking.shared] {self.address} is falling behind (send budget '
+                      + f'{self.send_budget.bytes}, receive budget {self.rec_budget.bytes})')
+            else:
+                print(f'[networking.shared] {self.address} caught up')
 
+    def falling_behind(self) -> bool:
+        """Returns True if this connection has been running out of its send or receive
+        budget for a while, meaning we are sending or receiving more than we keep up with"""
+        return self.send_budget.falling_behind() or self.rec_budget.falling_behind()
 
     def _handle_send(self):
-        if self.curr_send_packet is None:
-            if self.send_queue.empty():
-                return
+        deadline = self.send_budget.deadline()
+        sent_total = 0
+        exhausted = False
+        while True:
+            if self.send_budget.exceeded(sent_total, deadline):
+                exhausted = True
+                break
+            self._fill_send_buffers()
+            if not self.send_buffers:
+                break
+            try:
+                if HAS_SENDMSG:
+                    buffers = [self.send_buffers[i]
+                               for i in range(min(len(self.send_buffers), MAX_SEND_BUFFERS))]
+                    amt_sent = self.connection.sendmsg(buffers)
+                else:
+                    buffers = self._coalesce_send_buffers()
+                    amt_sent = self.connection.send(buffers[0])
+            except BlockingIOError:
+                break
+            sent_total += amt_sent
+            self._consume_send_buffers(amt_sent)
+            if amt_sent < sum(len(buf) for buf in buffers):
+                break
+        self.send_budget.finish(
+            sent_total, exhausted and (bool(self.send_buffers) or not self.send_queue.empty()))
+
+    def _fill_send_buffers(self):
+        """Moves packets from the send_queue to send_buffers, compressing them if we're
+        doing that, until there are enough buffers for a sendmsg"""
+        while len(self.send_buffers) < MAX_SEND_BUFFERS and not self.send_queue.empty():
             packet_serd = self.send_queue.get_nowait()
-            self.curr_send_packet = io.BytesIO()
-            self.curr_send_packet.write(len(packet_serd).to_bytes(4, 'big', signed=False))
-            self.curr_send_packet.write(packet_serd)
-            self.curr_send_packet.seek(0, 0)
-
-        for _ in range(128): # avoid sending more than 512kb in one go
-            block = self.curr_send_packet.read(BLOCK_SIZE)
-            if not block:
-                self.curr_send_packet = None
-                return
+            self.committed_packets += 1
+            self.queued_bytes -= len(packet_serd)
+            header = len(packet_serd)
+            if FEATURE_COMPRESSION in self.features and len(packet_serd) >= COMPRESSION_THRESHOLD:
+                packet_serd = self._compress(packet_serd)
+                header = len(packet_serd) | _COMPRESSED_FLAG
+            self.queued_bytes += 4 + len(packet_serd)
+            self.send_buffers.append(memoryview(_LENGTH_STRUCT.pack(header)))
+            self.send_buffers.append(memoryview(packet_serd))
 
-            amt_sent = self.connection.send(block)
-            if amt_sent < len(block):
-                self.curr_send_packet.seek(amt_sent - len(block), 1)
-                return
+    def _coalesce_send_buffers(self) -> typing.List[memoryview]:
+        """Joins buffers at the start of send_buffers until they are SEND_COALESCE_SIZE
+        long (or we run out), replacing them with the result. Returns a list with just the
+        first buffer. Used when sendmsg isn't available"""
+        if len(self.send_buffers[0]) < SEND_COALESCE_SIZE and len(self.send_buffers) > 1:
+            parts = []
+            total = 0
+            while self.send_buffers and total < SEND_COALESCE_SIZE:
+                parts.append(self.send_buffers.popleft())
+                total += len(parts[-1])
+            self.send_buffers.appendleft(memoryview(b''.join(parts)))
+        return [self.send_buffers[0]]
 
-    def _try_from_recq(self, amt: int) -> typing.Optional[bytes]:
-        """Tries to read the specified number of bytes from the receive queue.
-        If this fails to get that many bytes the receive queue is effectively
-        unaltered, otherwise the bytes are removed from the receive queue
-        and returned"""
+    def _consume_send_buffers(self, amt: int):
+        """Removes the given number of sent bytes from the start of send_buffers"""
+        self.queued_bytes -= amt
+        while self.send_buffers and len(self.send_buffers[0]) <= amt:
+            amt -= len(self.send_buffers.popleft())
+        if amt:
+            self.send_buffers[0] = self.send_buffers[0][amt:]
 
-        if not self.curr_rec:
-            return None
-        if len(self.curr_rec) == 1 or len(self.curr_rec[0]) >= amt:
-            # happy / most common case
-            if len(self.curr_rec[0]) < amt:
-                return None
-            block = self.curr_rec.popleft()
-            if len(block) == amt:
-                return block
-
-            self.curr_rec.appendleft(block[amt:])
-            return block[:amt]
-
-        result = io.BytesIO()
-        curlen = 0
-        while self.curr_rec:
-            block = self.curr_rec.popleft()
-            if curlen + len(block) == amt:
-                # another happy / common case
-                result.write(block)
-                return result.getvalue()
-
-            if curlen + len(block) < amt:
-                result.write(block)
-                continue
-
-            result.write(block[:amt])
-            self.curr_rec.appendleft(block[amt:])
-            return result.getvalue()
-
-        # didn't get enough data, but now the curr_rec queue is all merged
-        # so we will get the top happy case
-        self.curr_rec.appendleft(result.getvalue())
-        return None
+    def _compress(self, packet_serd: bytes) -> bytes:
+        """Compresses the serialized packet with the stream for this connection. This
+        must be called in the same order that packets are sent"""
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                               COMPRESSION_WBITS, COMPRESSION_MEMLEVEL)
+        res = self.compressor.compress(packet_serd) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return res[:-len(_SYNC_FLUSH_TAIL)]
+
+    def _decompress(self, block: memoryview) -> bytes:
+        """Decompresses the result from _compress on the other end of the connection.
+        This must be called in the same order that packets are received"""
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return (self.decompressor.decompress(block)
+                + self.decompressor.decompress(_SYNC_FLUSH_TAIL))
+
+    def _reserve_rec(self, amt: int) -> None:
+        """Makes sure there is room for at least amt more bytes at the end of rec_buffer.
+        The unparsed bytes are moved to the start of the buffer if nothing was handed out
+        from it and they fit, otherwise they are moved to a new buffer"""
+        if len(self.rec_buffer) - self.rec_end >= amt:
+            return
+        pending = self.rec_end - self.rec_start
+        if not self.rec_exported and len(self.rec_buffer) >= pending + amt:
+            self.rec_buffer[:pending] = self.rec_buffer[self.rec_start:self.rec_end]
+        else:
+            buffer = bytearray(max(REC_BUFFER_SIZE, pending + amt))
+            buffer[:pending] = memoryview(self.rec_buffer)[self.rec_start:self.rec_end]
+            self.rec_buffer = buffer
+            self.rec_exported = False
+        self.rec_start = 0
+        self.rec_end = pending
 
     def _handle_rec(self):
-        for _ in range(128): # avoid reading more than 512kb in one go
-            block = self.connection.recv(BLOCK_SIZE)
-            if not block:
+        deadline = self.rec_budget.deadline()
+        received = 0
+        exhausted = False
+        while True:
+            if self.rec_budget.exceeded(received, deadline):
+                exhausted = True
+                break
+            self._reserve_rec(BLOCK_SIZE)
+            space = len(self.rec_buffer) - self.rec_end
+            try:
+                amt = self.connection.recv_into(memoryview(self.rec_buffer)[self.rec_end:])
+            except BlockingIOError:
+                break
+            if not amt:
                 self.connection.close()
                 self.connection = None
                 break
-            self.curr_rec.append(block)
-            if len(block) < BLOCK_SIZE:
+            self.rec_end += amt
+            received += amt
+            self._split_rec()
+            if amt < space:
                 break
+        self.rec_budget.finish(received, exhausted)
+
+        if self.rec_start == self.rec_end and not self.rec_exported:
+            self.rec_start = self.rec_end = 0
 
-        for _ in range(8): # avoid parsing too many packets at once
-            lenblock = self._try_from_recq(4)
-            if not lenblock:
+    def _split_rec(self):
+        """Hands every complete packet in rec_buffer to rec_queue. This is cheap since
+        they are only deserialized in read(), and it means only an incomplete packet is
+        ever moved by _reserve_rec"""
+        view = memoryview(self.rec_buffer)
+        while True:
+            pending = self.rec_end - self.rec_start
+            if pending < 4:
                 return
-            explen = int.from_bytes(lenblock, 'big', signed=False)
-            block = self._try_from_recq(explen)
-            if not block:
-                self.curr_rec.appendleft(lenblock)
+            explen = _LENGTH_STRUCT.unpack_from(self.rec_buffer, self.rec_start)[0]
+            length = explen & ~_COMPRESSED_FLAG
+            if pending < 4 + length:
+                # make sure the rest of the packet lands right after what we have
+                self._reserve_rec(4 + length - pending)
                 return
 
-            packet = ser.deserialize(block)
-            if not isinstance(packet, packets.Packet):
-                raise ValueError(f'got non-packet {packet} (type={type(packet)})')
-            self.rec_queue.put(packet)
+            block = view[self.rec_start + 4:self.rec_start + 4 + length]
+            self.rec_start += 4 + length
+            if explen & _COMPRESSED_FLAG:
+                block = self._decompress(block)
+            else:
+                self.rec_exported = True
+            self.rec_queue.put(block)
 
     def send(self, packet: packets.Packet):
         """Sends this client the specified packet"""
         if self.disconnected():
             return
-        self.send_queue.put_nowait(ser.serialize(packet))
+        self.send_serd(self.serialize(packet))
 
     def send_serd(self, packet_serd: bytes):
         """Sends this client the serialized packet"""
         if self.disconnected():
             return
         self.send_queue.put_nowait(packet_serd)
+        self.queued_bytes += len(packet_serd)
+        self.queued_packets += 1
+
+    def mark_droppable(self, start: int) -> None:
+        """Marks the packets queued since queued_packets was start as a group which
+        drop_queued may drop, all together or not at all"""
+        while self.droppable and self.droppable[0][1] <= self.committed_packets:
+            self.droppable.popleft()
+        if start < self.queued_packets:
+            self.droppable.append((start, self.queued_packets))
+
+    def drop_queued(self) -> typing.Tuple[int, int]:
+        """Drops the queued packets which were marked droppable and haven't started being
+        sent. A group which has started is sent in full, and packets which weren't marked
+        are never dropped. The dropped packets may have been the ones carrying dungeons,
+        so we also forget which dungeons the peer has.
+
+        Returns:
+            dropped_packets (int): how many packets were dropped
+            dropped_bytes (int): how many bytes those were
+        """
+        ranges = deque(rng for rng in self.droppable if rng[0] >= self.committed_packets)
+        self.droppable.clear()
+        kept = []
+        dropped_packets = 0
+        dropped_bytes = 0
+        index = self.committed_packets
+        while not self.send_queue.empty():
+            packet_serd = self.send_queue.get_nowait()
+            while ranges and ranges[0][1] <= index:
+                ranges.popleft()
+            if ranges and ranges[0][0] <= index:
+                dropped_packets += 1
+                dropped_bytes += len(packet_serd)
+            else:
+                kept.append(packet_serd)
+            index += 1
+
+        for packet_serd in kept:
+            self.send_queue.put_nowait(packet_serd)
+        self.queued_packets = self.committed_packets + len(kept)
+        self.queued_bytes -= dropped_bytes
+        if dropped_packets:
+            self.sent_dungeons = world.DungeonCache(DUNGEON_CACHE_SIZE)
+        return dropped_packets, dropped_bytes
 
     def read(self) -> typing.Optional[packets.Packet]:
         """Returns the packet from the client if there is one"""
-        return self.rec_queue.get_nowait() if not self.rec_queue.empty() else None
+        if self.rec_queue.empty():
+            return None
+        serd = self.rec_queue.get_nowait()
+        if fastpath.is_fast(serd):
+            return fastpath.decode(serd)
+        cache = self.received_dungeons if FEATURE_DUNGEON_CACHE in self.features else None
+        with world.using_dungeon_cache(cache):
+            packet = ser.deserialize(serd)
+        if not isinstance(packet, packets.Packet):
+            raise ValueError(f'got non-packet {packet} (type={type(packet)})')
+        return packet
 
     def has_pending(self, read=True, write=True) -> bool:
         """Returns True if there are pending sends / receives, False otherwise"""
@@ -176,10 +636,57 @@ class Connection:
         if read and not self.rec_queue.empty():
             # have things that we've parsed but haven't been read() yet
             return True
-        if write and self.curr_send_packet is not None:
+        if write and self.send_buffers:
             # in the middle of sending something
             return True
-        if read and self.curr_rec:
+        if read and self.rec_end > self.rec_start:
             # have things not yet parsed / incomplete
             return True
-        return False
\ No newline at end of file
+        return False
+
+def close_all(conns: typing.Iterable[Connection]) -> None:
+    """Closes the sockets of the given connections which are still connected, rather than
+    leaving that to when they are collected, which may be much later for connections
+    caught in a reference cycle. None or disconnected connections are skipped"""
+    for conn in conns:
+        if conn is None or conn.disconnected() or conn.connection is None:
+            continue
+        with contextlib.suppress(OSError):
+            conn.connection.close()
+        conn.connection = None
+
+def broadcast(conns: typing.Iterable[Connection], packet: packets.Packet,
+              serds: typing.Optional[dict] = None) -> None:
+    """Sends the packet to each of the given connections, serializing it only once
+    for each distinct encoding among them. Dungeons are written in full in the shared
+    serialization, unless the connection already has one of them, in which case the
+    packet is serialized just for that connection
+
+    Args:
+        conns (iterable[Connection]): the connections to send to. None or disconnected
+            connections are skipped
+        packet (Packet): the packet to send
+        serds (dict, optional): where the serializations are kept by encoding. Passing
+            the same dict when sending the same packet to another group of connections
+            avoids serializing it again
+    """
+    if serds is None:
+        serds = dict()
+    for conn in conns:
+        if conn is None or conn.disconnected():
+            continue
+        serd_and_dungeons = serds.get(conn.encoding)
+        if serd_and_dungeons is None:
+            recorder = world.DungeonRecorder()
+            serd_and_dungeons = (conn.serialize_with_cache(packet, recorder), recorder.added)
+            serds[conn.encoding] = serd_and_dungeons
+        serd, dungeons = serd_and_dungeons
+
+        if FEATURE_DUNGEON_CACHE not in conn.features or not dungeons:
+            conn.send_serd(serd)
+        elif any(dung.content_hash in conn.sent_dungeons for dung in dungeons):
+            conn.send(packet)
+        else:
+            for dung in dungeons:
+                conn.sent_dungeons.add(dung)
+            conn.send_serd(serd)
@@ -0,0 +1,70 @@
+"""Waits for connections to become ready using selectors, so that a loop only wakes up
+when there is something to do rather than polling every connection on a timer"""
+import selectors
+import socket
+import typing
+
+from optimax_rogue.networking.shared import Connection
+
+class SocketWaiter:
+    """Blocks until one of a changing set of connections is ready. Connections are
+    always waited on for reading, and for writing only while they have something to
+    send.
+
+    Attributes:
+        selector (selectors.BaseSelector): what we wait with (epoll where available)
+        registered (dict[socket.socket, int]): the events each socket in the selector is
+            registered for
+    """
+    def __init__(self) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.registered = dict()
+
+    def wait(self, conns: typing.Iterable[typing.Optional[Connection]],
+             listen_sock: typing.Optional[socket.socket],
+             timeout: typing.Optional[float]) -> typing.Set[socket.socket]:
+        """Waits until one of the given connections can be read from, one with something
+        to send can be written to, someone is waiting to connect on listen_sock, or the
+        timeout passes. Returns right away if one of the connections already has packets
+        which haven't been read(), since the caller may have left some for later.
+
+        Args:
+            conns (iterable[Connection]): the connections to wait on. None or disconnected
+                connections are skipped
+            listen_sock (socket.socket, optional): the socket to wait for new connections on
+            timeout (float, optional): the most seconds to wait, or None to wait until
+                something is ready
+
+        Returns:
+            the sockets which are ready
+        """
+        wanted = dict()
+        if listen_sock is not None:
+            wanted[listen_sock] = selectors.EVENT_READ
+        for conn in conns:
+            if conn is None or conn.disconnected():
+                continue
+            if not conn.rec_queue.empty():
+                timeout = 0
+            events = selectors.EVENT_READ
+            if conn.has_pending(read=False):
+                events |= selectors.EVENT_WRITE
+            wanted[conn.connection] = events
+
+        for sock in [sock for sock in self.registered if sock not in wanted]:
+            self.selector.unregister(sock)
+            del self.registered[sock]
+        for sock, events in wanted.items():
+            old = self.registered.get(sock)
+            if old is None:
+                self.selector.register(sock, events)
+            elif old != events:
+                self.selector.modify(sock, events)
+            self.registered[sock] = events
+
+        return set(key.fileobj for key, _ in self.selector.select(timeout))
+
+    def close(self) -> None:
+        """Releases the selector"""
+        self.selector.close()
+        self.registered = dict()
@@ -0,0 +1,135 @@
+"""Main entry into spawning a host for many matches at once (see server.lobbies). Players
+either join a lobby by its id or get a new one, so no secrets are needed up front, though
+lobbies can be opened with the secrets of their players like with server.main:
+
+python -m optimax_rogue.server.host --port 1769 --lobby practice secret1 secret2
+"""
+
+import argparse
+import sys
+import traceback
+import time
+import importlib
+from optimax_rogue.logic.worldgen import EmptyDungeonGenerator, GameStartGenerator
+from optimax_rogue.logic.updater import DungeonDespawningStrategy
+from optimax_rogue.networking.server import SPECTATOR_MAX_QUEUED_BYTES, SPECTATOR_MAX_LAG
+from optimax_rogue.networking.waiter import SocketWaiter
+from optimax_rogue.server.lobbies import MatchHost
+import optimax_rogue.networking.shared as nshared
+import optimax_rogue.networking.serializer as ser
+
+MAX_WAIT = 1.0
+"""The most seconds we wait for something to happen, so that we still log regularly"""
+
+def main():
+    """Main entry function"""
+    parser = argparse.ArgumentParser(description='Host many OptiMAX Rogue matches at once')
+    parser.add_argument('-hn', '--host', '--hostname', type=str, help='specify the host to use')
+    parser.add_argument('-p', '--port', type=int, help='specify port to listen on')
+    parser.add_argument('--unix', type=str, metavar='PATH',
+                        help='listen on the unix domain socket at this path rather than on a '
+                        + 'host and port')
+    parser.add_argument('-l', '--log', type=str,
+                        help='if specified, rerout stdout and stderr to this file')
+    parser.add_argument('--lobby', nargs=3, action='append', default=[],
+                        metavar=('ID', 'S1', 'S2'),
+                        help='open a lobby with this id for players with these secrets. May be '
+                        + 'given more than once')
+    parser.add_argument('--max-matches', type=int, default=None,
+                        help='the most matches to host at once')
+    parser.add_argument('-t', '--tickrate', type=float, help='minimum seconds between ticks',
+                        default=1.0)
+    parser.add_argument('--width', type=int, help='width of map', default=60)
+    parser.add_argument('--height', type=int, help='height of map', default=10)
+    parser.add_argument('--dsunused', action='store_true',
+                        help=('If specified uses DungeonDespawningStrategy.Unused instead of '
+                              + 'DungeonDespawningStrategy.Unreachable'))
+    parser.add_argument('-mt', '--maxticks', type=int,
+                        help='maximum number of ticks before a tie is declared', default=None)
+    parser.add_argument('--gamestart', type=str,
+                        default='optimax_rogue.logic.worldgen.TogetherGameStartGenerator',
+                        help='The path to the callable which returns an instance of the '
+                        + 'GameStartGenerator to use')
+    parser.add_argument('--spec-max-queued', type=int, default=SPECTATOR_MAX_QUEUED_BYTES,
+                        help='bytes a spectator may have waiting to be sent before its queued '
+                        + 'ticks are dropped and it is resynced once it catches up')
+    parser.add_argument('--spec-max-lag', type=float, default=SPECTATOR_MAX_LAG,
+                        help='seconds a spectator may take to catch up before it is '
+                        + 'disconnected, or 0 to disconnect rather than resync it')
+    parser.add_argument('--serializer', type=str, choices=tuple(ser.SERIALIZERS.keys()),
+                        default='json', help='the serializer to use for packets we send')
+    args = parser.parse_args()
+
+    if args.log:
+        with open(args.log, 'w') as fh:
+            try:
+                print('[host.main] starting', file=fh)
+                _run(args, fh)
+            except:
+                traceback.print_exc(file=fh)
+                fh.flush()
+                raise
+            fh.flush()
+    else:
+        _run(args, sys.stdout)
+
+
+def _run(args, fh):
+    ser.set_serializer(args.serializer)
+    host = args.host or 'localhost'
+    port = args.port or 0
+
+    updater_kwargs = {
+        'despawn_strat': (
+            DungeonDespawningStrategy.Unused
+            if args.dsunused
+            else DungeonDespawningStrategy.Unreachable
+        )
+    }
+
+    if args.maxticks:
+        updater_kwargs['max_ticks'] = args.maxticks
+
+    server_kwargs = {
+        'spec_max_queued_bytes': args.spec_max_queued,
+        'spec_max_lag': args.spec_max_lag
+    }
+
+    igamestart_spl = args.gamestart.split('.')
+    igamestart_mod = importlib.import_module('.'.join(igamestart_spl[:-1]))
+    igamestart = getattr(igamestart_mod, igamestart_spl[-1])()
+    if not isinstance(igamestart, GameStartGenerator):
+        raise ValueError(f'gamestart {args.gamestart} corresponds with {igamestart} '
+                         + '(not a GameStartGenerator)')
+    dgen = EmptyDungeonGenerator(args.width, args.height)
+    waiter = SocketWaiter()
+
+    with nshared.listening(host, port, args.unix) as listen_sock:
+        host, port = nshared.bound_address(listen_sock)
+        print(f'[host.main] bound on {nshared.describe_address(host, port)}', file=fh)
+
+        match_host = MatchHost(listen_sock, dgen, igamestart, args.tickrate, updater_kwargs,
+                               server_kwargs, args.max_matches, fh)
+        for lobby, secret1, secret2 in args.lobby:
+            match_host.open_lobby(lobby, secret1.encode('ASCII', 'strict'),
+                                  secret2.encode('ASCII', 'strict'))
+
+        last_printed = time.time()
+        ready = None
+        while True:
+            match_host.update(ready)
+
+            timeout = match_host.time_until_tick()
+            if timeout is None or timeout > MAX_WAIT:
+                timeout = MAX_WAIT
+            ready = waiter.wait(match_host.connections(), listen_sock, timeout)
+
+            if time.time() - last_printed > 30:
+                print(f'[host.main] {len(match_host.matches)} matches, {match_host.running()} '
+                      + f'running, {len(match_host.connections())} connections', file=fh)
+                fh.flush()
+                last_printed = time.time()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""Hosts many matches behind one listening socket. Every client identifies with the id of
+the lobby it wants to join (see handshake.IdentifyPacket) and is handed to that lobby's
+ServerPregame, or to the spectators of its Server once the game has started. A player
+who doesn't name a lobby gets a new one, and is told its id so that their opponent and
+any spectators can join it. Each match has its own game state and updater, exactly as
+if it were hosted by its own server.main.
+"""
+import secrets
+import socket
+import sys
+import time
+import typing
+from contextlib import suppress
+
+import optimax_rogue.networking.handshake as handshake
+from optimax_rogue.networking.handshake import IdentifyPacket
+from optimax_rogue.networking.shared import Connection
+from optimax_rogue.networking.server import Server
+from optimax_rogue.logic.updater import UpdateResult
+from optimax_rogue.logic.worldgen import DungeonGenerator, GameStartGenerator
+from optimax_rogue.server.pregame import ServerPregame, PregameUpdateResult
+
+LOBBY_ID_BYTES = 4
+"""How many random bytes are in the ids of lobbies we make up"""
+IDENTIFY_TIMEOUT = 10.0
+"""How many seconds a new connection has to identify itself before we disconnect it"""
+
+class Match:
+    """A lobby, and the game played in it once both players joined
+
+    Attributes:
+        lobby (str): the id of the lobby
+        pregame (ServerPregame): the lobby
+        server (Server, optional): the game, once it has started
+        result (UpdateResult, optional): how the game ended, once it has. The match is
+            forgotten once everything has been sent
+    """
+    def __init__(self, lobby: str, pregame: ServerPregame) -> None:
+        self.lobby = lobby
+        self.pregame = pregame
+        self.server: typing.Optional[Server] = None
+        self.result: typing.Optional[UpdateResult] = None
+
+    def connections(self) -> typing.List[Connection]:
+        """Returns every connection in the lobby or the game"""
+        if self.server is not None:
+            return self.server.connections()
+        return self.pregame.connections()
+
+class MatchHost:
+    """Accepts connections on one socket and routes them to the match they identify for.
+    Lobbies are opened either by the host itself (see open_lobby), with the secrets the
+    players identify with, or by a player who identifies without naming one
+
+    Attributes:
+        listen_sock (socket.socket): the socket everyone connects to
+        dgen (DungeonGenerator): used by the updater of each match to spawn new dungeons
+        igamestate (GameStartGenerator): generates the initial game state of each match
+        tickrate (float): the tickrate of each match
+        updater_kwargs (dict): the additional kwargs to pass to the updater of each match
+        server_kwargs (dict): the additional kwargs to pass to the server of each match
+        max_matches (int, optional): the most matches we host at once. Players can't open
+            new lobbies while we have this many
+
+        matches (dict[str, Match]): the matches by lobby id
+        by_secret (dict[bytes, str]): the lobby opened for each secret given to open_lobby,
+            so that players who don't know about lobbies can still join them
+        pending (list[tuple[Connection, float]]): connections which haven't identified
+            themselves yet and the time.time() they connected at
+        rejected (list[Connection]): connections which we couldn't route, which are
+            closed once they've been told so
+
+        outf (filehandle): where we output logs to
+    """
+    def __init__(self, listen_sock: socket.socket, dgen: DungeonGenerator,
+                 igamestate: GameStartGenerator, tickrate: float, updater_kwargs: dict,
+                 server_kwargs: typing.Optional[dict] = None,
+                 max_matches: typing.Optional[int] = None, outf = sys.stdout) -> None:
+        self.listen_sock = listen_sock
+        self.dgen = dgen
+        self.igamestate = igamestate
+        self.tickrate = float(tickrate)
+        self.updater_kwargs = updater_kwargs
+        self.server_kwargs = server_kwargs or dict()
+        self.max_matches = max_matches
+        self.matches: typing.Dict[str, Match] = dict()
+        self.by_secret: typing.Dict[bytes, str] = dict()
+        self.pending: typing.List[typing.Tuple[Connection, float]] = []
+        self.rejected: typing.List[Connection] = []
+        self.outf = outf
+
+    def open_lobby(self, lobby: typing.Optional[str] = None,
+                   player1_secret: typing.Optional[bytes] = None,
+                   player2_secret: typing.Optional[bytes] = None) -> str:
+        """Opens a new lobby and returns its id
+
+        Args:
+            lobby (str, optional): the id of the lobby, or None to make one up
+            player1_secret (bytes, optional): the secret player 1 identifies with, or None
+                for whoever identifies first (see ServerPregame)
+            player2_secret (bytes, optional): the secret player 2 identifies with, or None
+                for whoever identifies first
+        """
+        if lobby is None:
+            lobby = secrets.token_hex(LOBBY_ID_BYTES)
+            while lobby in self.matches:
+                lobby = secrets.token_hex(LOBBY_ID_BYTES)
+        elif lobby in self.matches:
+            raise ValueError(f'lobby {lobby} is already open')
+        elif not lobby or len(lobby.encode('ascii', 'strict')) > 255:
+            raise ValueError(f'lobby ids must be 1 to 255 ascii characters, got {lobby}')
+        if player1_secret is not None and player1_secret == player2_secret:
+            raise ValueError('player1_secret cannot be the same as player2_secret')
+        for secret in (player1_secret, player2_secret):
+            if secret is not None and secret in self.by_secret:
+                raise ValueError(f'secret {secret} is already used by lobby {self.by_secret[secret]}')
+
+        pregame = ServerPregame(None, player1_secret, player2_secret, self.dgen, self.igamestate,
+                                self.tickrate, self.updater_kwargs, self.server_kwargs, lobby)
+        self.matches[lobby] = Match(lobby, pregame)
+        for secret in (player1_secret, player2_secret):
+            if secret is not None:
+                self.by_secret[secret] = lobby
+        print(f'[host] opened lobby {lobby}', file=self.outf)
+        return lobby
+
+    def update(self, ready: typing.Optional[typing.Set[socket.socket]] = None) -> None:
+        """Routes connections which identified themselves, moves every match along, and
+        accepts new connections
+
+        Args:
+            ready (set[socket.socket], optional): if specified, only these sockets are
+                ready (see networking.waiter), like in Server.update
+        """
+        self._update_pending(ready)
+        for match in list(self.matches.values()):
+            self._update_match(match, ready)
+
+        for i in range(len(self.rejected) - 1, -1, -1):
+            conn = self.rejected[i]
+            conn.update()
+            if conn.disconnected() or not conn.has_pending(read=False):
+                self._close(conn)
+                self.rejected.pop(i)
+
+        if ready is None or self.listen_sock in ready:
+            self._accept()
+
+    def connections(self) -> typing.List[Connection]:
+        """Returns every connection, whether or not it has been routed to a match yet"""
+        res = [conn for conn, _ in self.pending] + self.rejected
+        for match in self.matches.values():
+            res.extend(match.connections())
+        return res
+
+    def time_until_tick(self) -> typing.Optional[float]:
+        """Returns the seconds until the next tick of any match can happen, or None if
+        every match is waiting on its players"""
+        res = None
+        for match in self.matches.values():
+            if match.server is None or match.result is not None:
+                continue
+            until = match.server.time_until_tick()
+            if until is not None and (res is None or until < res):
+                res = until
+        return res
+
+    def running(self) -> int:
+        """Returns how many matches have started and not yet ended"""
+        return sum(1 for match in self.matches.values()
+                   if match.server is not None and match.result is None)
+
+    def _accept(self) -> None:
+        with suppress(BlockingIOError):
+            while True:
+                conn, addr = self.listen_sock.accept()
+                conn.setblocking(0)
+                self.pending.append((Connection(conn, addr), time.time()))
+
+    def _update_pending(self, ready: typing.Optional[typing.Set[socket.socket]]) -> None:
+        now = time.time()
+        for i in range(len(self.pending) - 1, -1, -1):
+            conn, since = self.pending[i]
+            if ready is None or conn.connection in ready or conn.has_pending(read=False):
+                conn.update()
+            if conn.disconnected():
+                self.pending.pop(i)
+                continue
+
+            packet = conn.read()
+            if packet is None:
+                if now - since > IDENTIFY_TIMEOUT:
+                    print(f'[host] {conn.address} did not identify in time', file=self.outf)
+                    self._close(conn)
+                    self.pending.pop(i)
+                continue
+
+            self.pending.pop(i)
+            if isinstance(packet, IdentifyPacket):
+                self._route(conn, packet)
+            else:
+                print(f'[host] {conn.address} sent {packet} (type={type(packet)}) instead of '
+                      + 'identifying', file=self.outf)
+                self._close(conn)
+
+    def _route(self, conn: Connection, packet: IdentifyPacket) -> None:
+        """Hands the connection to the lobby or game it identified for"""
+        lobby = packet.lobby
+        if lobby is None and packet.secret:
+            lobby = self.by_secret.get(packet.secret)
+            if lobby is None:
+                if self.max_matches is not None and len(self.matches) >= self.max_matches:
+                    self._reject(conn, packet, f'we are already hosting {len(self.matches)} matches')
+                    return
+                lobby = self.open_lobby()
+
+        match = self.matches.get(lobby) if lobby is not None else None
+        if match is None or match.result is not None:
+            self._reject(conn, packet, f'there is no lobby {lobby}')
+            return
+        if match.server is None:
+            match.pregame.join(conn, packet)
+        else:
+            print(f'[host] spectator from {conn.address} joined game {lobby}', file=self.outf)
+            match.server.audience.join(conn, packet, lobby)
+
+    def _reject(self, conn: Connection, packet: IdentifyPacket, reason: str) -> None:
+        print(f'[host] rejecting {conn.address}: {reason}', file=self.outf)
+        handshake.respond(conn, packet, None)
+        self.rejected.append(conn)
+
+    def _update_match(self, match: Match, ready: typing.Optional[typing.Set[socket.socket]]) -> None:
+        if match.server is None:
+            result, server = match.pregame.update()
+            if result == PregameUpdateResult.InProgress:
+                return
+            if result != PregameUpdateResult.Ready:
+                print(f'[host] lobby {match.lobby} ended with result {result}', file=self.outf)
+                self._forget(match)
+                return
+            print(f'[host] game {match.lobby} started', file=self.outf)
+            server.outf = self.outf
+            match.server = server
+            return
+
+        if match.result is None:
+            match.server.game_state.on_tick()
+            result = match.server.update(ready)
+            if result != UpdateResult.InProgress:
+                print(f'[host] game {match.lobby} ended with result {result}', file=self.outf)
+                match.result = result
+            return
+
+        match.server.update_queues(ready)
+        if not match.server.has_pending():
+            for conn in match.server.connections():
+                self._close(conn)
+            self._forget(match)
+
+    def _forget(self, match: Match) -> None:
+        del self.matches[match.lobby]
+        for secret in (match.pregame.player1_secret, match.pregame.player2_secret):
+            if self.by_secret.get(secret) == match.lobby:
+                del self.by_secret[secret]
+
+    def _close(self, conn: Connection) -> None:
+        if conn.disconnected():
+            return
+        with suppress(OSError):
+            conn.connection.close()
+        conn.connection = None
@@ -1,25 +1,70 @@
 """Main entry into spawning a server. This is passed the secrets for players 1 and 2
-(so they can identify themselves), and optionally the port to listen on"""
+(so they can identify themselves), and optionally the port to listen on. The same
+arguments can be passed to run() to host a game from an existing process (see
+server.orchestrator).
+
+Either player can instead be a bot which is played inside the server, in which case
+their secret is ignored:
+
+python -m optimax_rogue.server.main - secret2 --bot1 optimax_rogue_bots.randombot.RandomBot
+"""
 
 import argparse
-import socket
+import asyncio
+import contextlib
 import sys
 import traceback
 import time
+import typing
 import importlib
 from optimax_rogue.logic.worldgen import EmptyDungeonGenerator, GameStartGenerator
 from optimax_rogue.server.pregame import ServerPregame, PregameUpdateResult
 from optimax_rogue.logic.updater import UpdateResult, DungeonDespawningStrategy
-from optimax_rogue.networking.server import Server
-from optimax_rogue.utils.ticker import Ticker
+from optimax_rogue.networking.server import Server, SPECTATOR_MAX_QUEUED_BYTES, SPECTATOR_MAX_LAG
+from optimax_rogue.networking.waiter import SocketWaiter
+import optimax_rogue.networking.shared as nshared
+import optimax_rogue.networking.aio as aio
+import optimax_rogue.networking.serializer as ser
+
+MAX_WAIT = 1.0
+"""The most seconds we wait for something to happen, so that we still log regularly"""
 
 def main():
     """Main entry function"""
+    run(sys.argv[1:])
+
+def run(argv: typing.List[str],
+        on_bound: typing.Optional[typing.Callable[[str, int], None]] = None
+        ) -> typing.Optional[UpdateResult]:
+    """Runs the server with the given command line arguments until the game ends
+
+    Args:
+        argv (list[str]): the arguments, as they would be passed on the command line
+        on_bound (callable, optional): called with the host and port as soon as we are
+            listening, so that whoever started us can tell the players where to connect.
+            With --unix these are the path of the socket and None
+
+    Returns:
+        the result of the game, or None if the lobby failed
+    """
     parser = argparse.ArgumentParser(description='Launch an OptiMAX Rogue Server')
-    parser.add_argument('secret1', metavar='S1', type=str, help='player 1 secret')
-    parser.add_argument('secret2', metavar='S2', type=str, help='player 2 secret')
+    parser.add_argument('secret1', metavar='S1', type=str,
+                        help='player 1 secret, which is ignored if --bot1 is given')
+    parser.add_argument('secret2', metavar='S2', type=str,
+                        help='player 2 secret, which is ignored if --bot2 is given')
+    parser.add_argument('--bot1', type=str,
+                        help='module + class for a bot to play as player 1 inside the server')
+    parser.add_argument('--bot2', type=str,
+                        help='module + class for a bot to play as player 2 inside the server')
+    parser.add_argument('--bot1-settings', type=str,
+                        help='optional path to the settings file for the bot of player 1')
+    parser.add_argument('--bot2-settings', type=str,
+                        help='optional path to the settings file for the bot of player 2')
     parser.add_argument('-hn', '--host', '--hostname', type=str, help='specify the host to use')
     parser.add_argument('-p', '--port', type=int, help='specify port to listen on')
+    parser.add_argument('--unix', type=str, metavar='PATH',
+                        help='listen on the unix domain socket at this path rather than on a '
+                        + 'host and port')
     parser.add_argument('-l', '--log', type=str,
                         help='if specified, rerout stdout and stderr to this file')
     parser.add_argument('-t', '--tickrate', type=float, help='minimum seconds between ticks',
@@ -32,34 +77,48 @@ def main():
     parser.add_argument('-mt', '--maxticks', type=int,
                         help='maximum number of ticks before a tie is declared', default=None)
     parser.add_argument('--aggressive', action='store_true',
-                        help='go as fast as possible regardless of cpu usage')
+                        help='poll rather than waiting for sockets to be ready, regardless '
+                        + 'of cpu usage')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='run the lobby and the game on an asyncio event loop')
     parser.add_argument('--gamestart', type=str,
                         default='optimax_rogue.logic.worldgen.TogetherGameStartGenerator',
                         help='The path to the callable which returns an instance of the '
                         + 'GameStartGenerator to use')
-    args = parser.parse_args()
+    parser.add_argument('--spec-max-queued', type=int, default=SPECTATOR_MAX_QUEUED_BYTES,
+                        help='bytes a spectator may have waiting to be sent before its queued '
+                        + 'ticks are dropped and it is resynced once it catches up')
+    parser.add_argument('--spec-max-lag', type=float, default=SPECTATOR_MAX_LAG,
+                        help='seconds a spectator may take to catch up before it is '
+                        + 'disconnected, or 0 to disconnect rather than resync it')
+    parser.add_argument('--serializer', type=str, choices=tuple(ser.SERIALIZERS.keys()),
+                        default='json', help='the serializer to use for packets we send')
+    args = parser.parse_args(argv)
 
     if args.log:
         with open(args.log, 'w') as fh:
             try:
                 print('[server.main] starting', file=fh)
-                _run(args, fh)
+                result = _run(args, fh, on_bound)
             except:
                 traceback.print_exc(file=fh)
                 fh.flush()
                 raise
             fh.flush()
-    else:
-        _run(args, sys.stdout)
+            return result
+    return _run(args, sys.stdout, on_bound)
 
 
-def _run(args, fh):
+def _run(args, fh, on_bound):
     secret1 = args.secret1.encode('ASCII', 'strict')
     secret2 = args.secret2.encode('ASCII', 'strict')
     tickrate = args.tickrate
-    if secret1 == secret2:
+    ser.set_serializer(args.serializer)
+    if secret1 == secret2 and not args.bot1 and not args.bot2:
         print('secret1 cannot be the same as secret2', file=fh)
-        return
+        return None
+    player1_bot = _bot_maker(args.bot1, args.bot1_settings) if args.bot1 else None
+    player2_bot = _bot_maker(args.bot2, args.bot2_settings) if args.bot2 else None
 
     host = args.host or 'localhost'
     port = args.port or 0
@@ -75,6 +134,11 @@ def _run(args, fh):
     if args.maxticks:
         updater_kwargs['max_ticks'] = args.maxticks
 
+    server_kwargs = {
+        'spec_max_queued_bytes': args.spec_max_queued,
+        'spec_max_lag': args.spec_max_lag
+    }
+
     igamestart_spl = args.gamestart.split('.')
     igamestart_mod = importlib.import_module('.'.join(igamestart_spl[:-1]))
     igamestart = getattr(igamestart_mod, igamestart_spl[-1])()
@@ -82,35 +146,52 @@ def _run(args, fh):
         raise ValueError(f'gamestart {args.gamestart} corresponds with {igamestart} '
                          + '(not a GameStartGenerator)')
     dgen = EmptyDungeonGenerator(args.width, args.height)
-    ticker = Ticker(0 if args.aggressive else 0.016)
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listen_sock:
-        listen_sock.bind((host, port))
-        listen_sock.setblocking(0)
-        listen_sock.listen()
-        host, port = listen_sock.getsockname()
-        print(f'[main] bound on host {host}, port {port}', file=fh)
+    if args.asyncio:
+        return asyncio.run(_run_async(host, port, args.unix, secret1, secret2, dgen, igamestart,
+                                      tickrate, updater_kwargs, server_kwargs, fh, on_bound,
+                                      player1_bot, player2_bot))
+
+    # run() may be called again in the same process (see server.orchestrator), so
+    # everything is closed here rather than left to the process exiting
+    with nshared.listening(host, port, args.unix) as listen_sock, \
+            contextlib.closing(SocketWaiter()) as waiter:
+        host, port = nshared.bound_address(listen_sock)
+        print(f'[main] bound on {nshared.describe_address(host, port)}', file=fh)
+        if on_bound is not None:
+            on_bound(host, port)
 
         pregame = ServerPregame(listen_sock, secret1, secret2, dgen, igamestart, tickrate,
-                                updater_kwargs)
+                                updater_kwargs, server_kwargs,
+                                player1_bot=player1_bot, player2_bot=player2_bot)
         result = PregameUpdateResult.InProgress
         server = None
         while result == PregameUpdateResult.InProgress:
             result, server = pregame.update()
-            ticker()
+            if result == PregameUpdateResult.InProgress:
+                waiter.wait(pregame.connections(), listen_sock, 0 if args.aggressive else MAX_WAIT)
 
         if result != PregameUpdateResult.Ready:
             print(f'[main] ending due to non-ready pregame result {result}', file=fh)
-            return
+            nshared.close_all(pregame.connections())
+            return None
 
         server.outf = fh
         result = UpdateResult.InProgress
         last_printed_ticks = time.time()
         last_tick = 0
+        ready = None
         while result == UpdateResult.InProgress:
             server.game_state.on_tick()
-            result = server.update()
-            ticker()
+            result = server.update(ready)
+            if result != UpdateResult.InProgress:
+                break
+
+            timeout = server.time_until_tick()
+            if args.aggressive:
+                timeout = 0
+            elif timeout is None or timeout > MAX_WAIT:
+                timeout = MAX_WAIT
+            ready = waiter.wait(server.connections(), listen_sock, timeout)
 
             dtime = time.time() - last_printed_ticks
             if dtime > 30:
@@ -122,11 +203,35 @@ def _run(args, fh):
 
         while server.has_pending():
             server.update_queues()
-            ticker()
+            waiter.wait(server.connections(), None, 0 if args.aggressive else MAX_WAIT)
 
-        listen_sock.close()
+        nshared.close_all(server.connections())
         print(f'[main] game ended with result {result}', file=fh)
-
+        return result
+
+async def _run_async(host, port, unix_path, secret1, secret2, dgen, igamestart, tickrate,
+                     updater_kwargs, server_kwargs, fh, on_bound, player1_bot, player2_bot):
+    activity = asyncio.Event()
+    listener = await aio.listen(host, port, activity, unix_path)
+    host, port = nshared.bound_address(listener.server.sockets[0])
+    print(f'[main] bound on {nshared.describe_address(host, port)}', file=fh)
+    if on_bound is not None:
+        on_bound(host, port)
+
+    pregame = ServerPregame(listener, secret1, secret2, dgen, igamestart, tickrate,
+                            updater_kwargs, server_kwargs,
+                            player1_bot=player1_bot, player2_bot=player2_bot)
+    return await aio.run_game(listener, activity, pregame, fh)
+
+def _bot_maker(path: str, settings: typing.Optional[str]) -> typing.Callable[[int], typing.Any]:
+    """Gets what makes the bot at the given module + class path given the iden of the
+    entity it controls, the same way optimax_rogue_bots.main does"""
+    bot_spl = path.split('.')
+    bot_mod = importlib.import_module('.'.join(bot_spl[:-1]))
+    constr = getattr(bot_mod, bot_spl[-1])
+    if settings:
+        return lambda iden: constr(iden, settings)
+    return constr
 
 
 if __name__ == '__main__':
@@ -0,0 +1,199 @@
+"""Starts matches in a pool of worker processes which have already imported the game, so
+that a match is listening as soon as it is asked for rather than after a new interpreter
+has started up. Each worker hosts one match at a time, the same way server.main would,
+and then waits for the next one:
+
+    orch = Orchestrator(workers=2)
+    match = orch.start_match(['secret1', 'secret2', '--tickrate', '0.1'])
+    # connect the players to match.host, match.port
+    result = match.wait()
+    orch.close()
+
+Workers are forked where the platform supports it, so they share the imports of the
+process which made the orchestrator, and are otherwise spawned once up front.
+"""
+import multiprocessing
+import traceback
+import typing
+
+import optimax_rogue.server.main as server_main
+from optimax_rogue.logic.updater import UpdateResult
+
+BIND_TIMEOUT = 10.0
+"""How many seconds a worker has to start listening before we give up on it"""
+
+def _work(conn) -> None:
+    """The main loop of a worker process. Receives the arguments for server.main, hosts
+    the match, and reports back ('bound', host, port) once listening and then
+    ('done', result) once the match is over, or ('failed', reason) if it couldn't be
+    hosted. None means there are no more matches"""
+    while True:
+        try:
+            argv = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if argv is None:
+            return
+        try:
+            result = server_main.run(argv, lambda host, port: conn.send(('bound', host, port)))
+        except BaseException as exc: # pylint: disable=broad-except
+            # argparse exits when given bad arguments, which must not end the worker
+            traceback.print_exc()
+            conn.send(('failed', repr(exc)))
+            if isinstance(exc, KeyboardInterrupt):
+                return
+            continue
+        conn.send(('done', None if result is None else int(result)))
+
+class Worker:
+    """A process which hosts matches
+
+    Attributes:
+        process (multiprocessing.Process): the worker process
+        conn (multiprocessing.connection.Connection): our end of the pipe to the worker
+        match (Match, optional): the match the worker is hosting, if it is
+    """
+    def __init__(self, context) -> None:
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_work, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.match: typing.Optional['Match'] = None
+
+    def close(self) -> None:
+        """Tells the worker to stop once it isn't hosting a match anymore"""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+
+class Match:
+    """A match being hosted by a worker
+
+    Attributes:
+        host (str): the host the match is listening on, or the path of its unix domain
+            socket if it was started with --unix
+        port (int, optional): the port the match is listening on, or None for a unix
+            domain socket
+        worker (Worker, optional): the worker hosting the match, until it has ended
+        done (bool): True once the match has ended
+        result (UpdateResult, optional): once done, how the game ended, or None if the
+            lobby failed or the worker did
+    """
+    def __init__(self, host: str, port: typing.Optional[int], worker: Worker) -> None:
+        self.host = host
+        self.port = port
+        self.worker = worker
+        self.done = False
+        self.result: typing.Optional[UpdateResult] = None
+
+    def poll(self) -> bool:
+        """Checks if the match has ended without waiting. Returns done"""
+        if not self.done and self.worker.conn.poll():
+            self._finish()
+        return self.done
+
+    def wait(self, timeout: typing.Optional[float] = None) -> typing.Optional[UpdateResult]:
+        """Waits until the match has ended or the timeout passes and returns result"""
+        if not self.done and self.worker.conn.poll(timeout):
+            self._finish()
+        return self.result
+
+    def _finish(self) -> None:
+        try:
+            msg = self.worker.conn.recv()
+        except (EOFError, OSError):
+            msg = ('failed', 'worker died')
+        if msg[0] == 'done' and msg[1] is not None:
+            self.result = UpdateResult(msg[1])
+        self.done = True
+        self.worker.match = None
+        self.worker = None
+
+class Orchestrator:
+    """Keeps a pool of worker processes to host matches in
+
+    Attributes:
+        context (multiprocessing.context.BaseContext): what we start workers with
+        workers (list[Worker]): the workers, whether hosting a match or not
+        min_idle (int): how many workers we keep ready for new matches
+    """
+    def __init__(self, workers: int = 2, start_method: typing.Optional[str] = None) -> None:
+        if start_method is None:
+            methods = multiprocessing.get_all_start_methods()
+            start_method = 'fork' if 'fork' in methods else methods[0]
+        self.context = multiprocessing.get_context(start_method)
+        self.min_idle = workers
+        self.workers: typing.List[Worker] = []
+        self._refill()
+
+    def start_match(self, argv: typing.List[str]) -> Match:
+        """Starts hosting a match on an idle worker, returning once it is listening
+
+        Args:
+            argv (list[str]): the arguments for server.main, as they would be passed on
+                the command line. Use port 0 (the default) to have the worker pick a
+                free port, which is reported in the match
+
+        Returns:
+            the match, which tells where to connect
+        """
+        worker = self._idle_worker()
+        worker.conn.send(list(argv))
+        if not worker.conn.poll(BIND_TIMEOUT):
+            self._discard(worker)
+            self._refill()
+            raise TimeoutError(f'worker did not start listening within {BIND_TIMEOUT}s')
+        try:
+            msg = worker.conn.recv()
+        except EOFError:
+            self._discard(worker)
+            msg = ('failed', 'worker died')
+        if msg[0] != 'bound':
+            # the worker reported the failure (such as bad arguments) or the match ended
+            # without listening (such as equal secrets), and is ready for another match
+            if msg[0] != 'failed':
+                msg = ('failed', f'match ended with {msg[1]} before listening')
+            self._refill()
+            raise ValueError(f'could not start match: {msg[1]}')
+
+        match = Match(msg[1], msg[2], worker)
+        worker.match = match
+        self._refill()
+        return match
+
+    def close(self) -> None:
+        """Stops every worker once its match, if any, has ended"""
+        for worker in self.workers:
+            worker.close()
+        for worker in self.workers:
+            worker.process.join()
+        self.workers = []
+
+    def _idle_worker(self) -> Worker:
+        for worker in list(self.workers):
+            if worker.match is not None:
+                worker.match.poll()
+            if not worker.process.is_alive():
+                self._discard(worker)
+        for worker in self.workers:
+            if worker.match is None:
+                return worker
+        worker = Worker(self.context)
+        self.workers.append(worker)
+        return worker
+
+    def _refill(self) -> None:
+        """Starts workers until at least min_idle aren't hosting a match"""
+        idle = sum(1 for worker in self.workers if worker.match is None)
+        for _ in range(self.min_idle - idle):
+            self.workers.append(Worker(self.context))
+
+    def _discard(self, worker: Worker) -> None:
+        if worker in self.workers:
+            self.workers.remove(worker)
+        worker.conn.close()
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.process.join()
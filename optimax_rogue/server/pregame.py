@@ -4,18 +4,21 @@ that allows them to identify themself.
 import enum
 import typing
 import socket
-import io
+import traceback
 from contextlib import suppress
 
-import optimax_rogue.networking.serializer as ser
 import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.shared as nshared
+import optimax_rogue.networking.handshake as handshake
+from optimax_rogue.networking.handshake import IdentifyPacket, IdentifyResultPacket # pylint: disable=unused-import
 import optimax_rogue.game.state as state
 import optimax_rogue.game.world as world
 import optimax_rogue.game.entities as entities
 from optimax_rogue.logic.updater import Updater
 from optimax_rogue.networking.shared import Connection
 from optimax_rogue.logic.worldgen import DungeonGenerator, GameStartGenerator
-from optimax_rogue.networking.server import Server, PlayerConnection, SpectatorConnection
+from optimax_rogue.networking.server import (
+    Server, PlayerConnection, SpectatorConnection, BotPlayerConnection)
 
 class PregameUpdateResult(enum.IntEnum):
     """The update results from the pregame stage"""
@@ -23,56 +26,6 @@ class PregameUpdateResult(enum.IntEnum):
     SetupFailed = 2 # not everyone connected
     Ready = 3       # we're ready to start the match
 
-class IdentifyPacket(packets.Packet):
-    """Sent by a spectator in the lobby to identify themself
-
-    Attributes:
-        secret (bytes): the secret identification
-    """
-    def __init__(self, secret: bytes):
-        self.secret = secret
-
-    @classmethod
-    def has_custom_serializer(cls):
-        return True
-
-    def to_prims(self):
-        res = io.BytesIO()
-        res.write(len(self.secret).to_bytes(4, 'big', signed=False))
-        res.write(self.secret)
-        return res.getvalue()
-
-    @classmethod
-    def from_prims(cls, prims) -> 'IdentifyPacket':
-        res = io.BytesIO(prims)
-        res.seek(0, 0)
-        secret_len = int.from_bytes(res.read(4), 'big', signed=False)
-        secret = res.read(secret_len)
-        return cls(secret)
-
-    def __str__(self):
-        return f'IdentifyPacket[secret={self.secret}]'
-
-    def __eq__(self, other):
-        if not isinstance(other, IdentifyPacket):
-            return False
-        return self.secret == other.secret
-
-packets.register_packet(IdentifyPacket)
-
-class IdentifyResultPacket(packets.Packet):
-    """Sent from the server back to a spectator to tell them about the result of
-    their IdentifyPacket
-
-    Attributes:
-        player_id (int, optional): if specified, the id that the spectator
-            successfully identified as. Either 1 or 2
-    """
-    def __init__(self, player_id: typing.Optional[int]):
-        self.player_id = player_id
-
-packets.register_packet(IdentifyResultPacket)
-
 class LobbyChangePacket(packets.Packet):
     """Correspons to the pregame lobby closing either due to failure or
     because the real server is spawning
@@ -90,21 +43,29 @@ class LobbyChangePacket(packets.Packet):
     def from_prims(cls, prims):
         return cls(PregameUpdateResult(prims['result']))
 
-packets.register_packet(LobbyChangePacket)
+packets.register_packet(LobbyChangePacket, (('result', ('B', PregameUpdateResult)),))
 
 class ServerPregame:
     """This controls the server prior to the game starting; it spawns the first dungeon,
     sets up initial modifiers and spawns the initial players. Once all players are
     connected this is ready to convert to a Server
 
+    Either player may instead be a bot which runs inside the server (see
+    BotPlayerConnection), made by player1_bot or player2_bot given the iden of the entity
+    it controls. That player's secret is then unused.
+
     Attributes:
-        listen_sock (socket.socket): the socket we are listening to connections on
+        listen_sock (socket.socket, optional): the socket we are listening to connections
+            on. If None, connections are only given to us with join (see server.lobbies)
         player1_conn (Connection, optional): if the first player is connected, this is
-            their connection
-        player1_secret (bytes): the bytes that player1 identifies themself with
+            their connection. If their bot runs inside the server, this is always its
+            BotPlayerConnection
+        player1_secret (bytes, optional): the bytes that player1 identifies themself with.
+            If None, the first to identify with a secret that isn't player 2's is player 1
         player2_conn (Connection, optional): if the second player is connected, this is
             their connection
-        player2_secret (bytes): the bytes that player2 identifies themself with
+        player2_secret (bytes, optional): the bytes that player2 identifies themself with,
+            or None to let whoever identifies first be player 2 (like player1_secret)
 
         spectators [list[Connection]]: a list of people who want to spectate the game once
             it starts
@@ -114,12 +75,19 @@ class ServerPregame:
         tickrate (float): the tickrate, passed to the server
 
         updater_kwargs (dict): the additional kwargs to pass to the updater
+        server_kwargs (dict): the additional kwargs to pass to the server
+
+        lobby (str, optional): the id of this lobby, if we are one of many
     """
-    def __init__(self, listen_sock: socket.socket, player1_secret: bytes, player2_secret: bytes,
-                 dgen: DungeonGenerator, igamestate: GameStartGenerator, tickrate: float, updater_kwargs: dict):
+    def __init__(self, listen_sock: typing.Optional[socket.socket],
+                 player1_secret: typing.Optional[bytes], player2_secret: typing.Optional[bytes],
+                 dgen: DungeonGenerator, igamestate: GameStartGenerator, tickrate: float, updater_kwargs: dict,
+                 server_kwargs: typing.Optional[dict] = None, lobby: typing.Optional[str] = None,
+                 player1_bot: typing.Optional[typing.Callable[[int], typing.Any]] = None,
+                 player2_bot: typing.Optional[typing.Callable[[int], typing.Any]] = None):
         self.listen_sock = listen_sock
-        self.player1_conn: Connection = None
-        self.player2_conn: Connection = None
+        self.player1_conn: Connection = BotPlayerConnection(player1_bot, 1) if player1_bot else None
+        self.player2_conn: Connection = BotPlayerConnection(player2_bot, 2) if player2_bot else None
         self.player1_secret = player1_secret
         self.player2_secret = player2_secret
         self.spectators: typing.List[Connection] = []
@@ -127,6 +95,8 @@ class ServerPregame:
         self.igamestate = igamestate
         self.tickrate = float(tickrate)
         self.updater_kwargs = updater_kwargs
+        self.server_kwargs = server_kwargs or dict()
+        self.lobby = lobby
 
     def update(self) -> typing.Tuple[PregameUpdateResult,
                                      typing.Optional[Server]]:
@@ -169,17 +139,7 @@ class ServerPregame:
             packet = spec.read()
             if packet is not None:
                 if isinstance(packet, IdentifyPacket):
-                    if self.player1_conn is None and self.player1_secret == packet.secret:
-                        print('[server_pregame] spectator successfully identified as player 1')
-                        self.player1_conn = self.spectators.pop(ind)
-                        self.player1_conn.send(IdentifyResultPacket(1))
-                    elif self.player2_conn is None and self.player2_secret == packet.secret:
-                        print('[server_pregame] spectator successfully identified as player 2')
-                        self.player2_conn = self.spectators.pop(ind)
-                        self.player2_conn.send(IdentifyResultPacket(2))
-                    else:
-                        print(f'[server_pregame] spectator unsuccessfully identified with secret {packet.secret}')
-                        spec.send(IdentifyResultPacket(None))
+                    self._identify(ind, packet)
                 else:
                     print('[server_pregame] spectator sent bad packet')
                     self.shutdown_if_alive(spec)
@@ -193,9 +153,50 @@ class ServerPregame:
         self._check_connections()
         return PregameUpdateResult.InProgress, None
 
+    def connections(self) -> typing.List[Connection]:
+        """Returns the connections of the players who connected, other than bots which
+        run inside the server, and every spectator"""
+        return [conn for conn in (self.player1_conn, self.player2_conn)
+                if conn is not None and not isinstance(conn, BotPlayerConnection)] + self.spectators
+
+    def join(self, conn: Connection, packet: IdentifyPacket) -> None:
+        """Adds a connection which already sent the given IdentifyPacket to someone else,
+        which then decided that it belongs in this lobby. It is handled as if it had
+        connected to us and sent the packet itself"""
+        self.spectators.append(conn)
+        self._identify(len(self.spectators) - 1, packet)
+
+    def _seat_matches(self, conn: typing.Optional[Connection], seat_secret: typing.Optional[bytes],
+                      other_secret: typing.Optional[bytes], secret: bytes) -> bool:
+        """Returns True if identifying with the secret takes the seat with the given
+        connection and secret"""
+        if conn is not None:
+            return False
+        if seat_secret is None:
+            return bool(secret) and secret != other_secret
+        return seat_secret == secret
+
+    def _identify(self, ind: int, packet: IdentifyPacket) -> None:
+        """Handles the IdentifyPacket sent by the spectator at the given index"""
+        if self._seat_matches(self.player1_conn, self.player1_secret, self.player2_secret, packet.secret):
+            print('[server_pregame] spectator successfully identified as player 1')
+            self.player1_secret = packet.secret
+            self.player1_conn = self.spectators.pop(ind)
+            handshake.respond(self.player1_conn, packet, 1, self.lobby)
+        elif self._seat_matches(self.player2_conn, self.player2_secret, self.player1_secret, packet.secret):
+            print('[server_pregame] spectator successfully identified as player 2')
+            self.player2_secret = packet.secret
+            self.player2_conn = self.spectators.pop(ind)
+            handshake.respond(self.player2_conn, packet, 2, self.lobby)
+        else:
+            print(f'[server_pregame] spectator unsuccessfully identified with secret {packet.secret}')
+            handshake.respond(self.spectators[ind], packet, None, self.lobby)
+
     def _check_connections(self):
         """Checks for incoming connections and adds them to the list of spectators
         """
+        if self.listen_sock is None:
+            return
         with suppress(BlockingIOError):
             conn, addr = self.listen_sock.accept()
             print(f'[server_pregame] got new connection from {addr}')
@@ -210,34 +211,41 @@ class ServerPregame:
         ent1 = game_state.iden_lookup[1]
         ent2 = game_state.iden_lookup[2]
 
-        self.player1_conn.send(packets.SyncPacket(game_state.view_for(ent1), 1))
-        self.player2_conn.send(packets.SyncPacket(game_state.view_for(ent2), 2))
-
-        for spec in self.spectators:
-            spec.send(packets.SyncPacket(game_state.view_spec(), None))
+        players = []
+        for conn, ent, iden in ((self.player1_conn, ent1, 1), (self.player2_conn, ent2, 2)):
+            if isinstance(conn, BotPlayerConnection):
+                try:
+                    conn.start(game_state)
+                except Exception: # pylint: disable=broad-except
+                    # the server ends the game for the other player on its first update
+                    print(f'[server_pregame] bot for player {iden} failed to start')
+                    traceback.print_exc()
+                    conn.closed = True
+                players.append(conn)
+            else:
+                conn.send(packets.SyncPacket(game_state.view_for(ent), iden))
+                players.append(PlayerConnection.copy_from(conn, iden))
+
+        nshared.broadcast(self.spectators, packets.SyncPacket(game_state.view_spec(), None))
 
         updater = Updater(self.dgen, **self.updater_kwargs)
         server = Server(game_state, updater, self.tickrate, self.listen_sock,
-                        PlayerConnection.copy_from(self.player1_conn, 1),
-                        PlayerConnection.copy_from(self.player2_conn, 2),
-                        [SpectatorConnection.copy_from(s) for s in self.spectators])
+                        players[0], players[1],
+                        [SpectatorConnection.copy_from(s) for s in self.spectators],
+                        **self.server_kwargs)
         return server
 
     def shutdown_if_alive(self, conn: Connection) -> None:
         """Shuts down the specified connection if it is currently alive"""
         if conn is None or conn.disconnected():
             return
+        if isinstance(conn, BotPlayerConnection):
+            conn.closed = True
+            return
 
         conn.connection.shutdown(socket.SHUT_RDWR)
         conn.connection = None
 
     def broadcast_packet(self, packet: packets.Packet) -> None:
         """Broadcasts the specified packet to all connections"""
-        serd = ser.serialize(packet)
-        if self.player1_conn:
-            self.player1_conn.send_serd(serd)
-        if self.player2_conn:
-            self.player2_conn.send_serd(serd)
-
-        for spec in self.spectators:
-            spec.send_serd(serd)
+        nshared.broadcast([self.player1_conn, self.player2_conn] + self.spectators, packet)
@@ -0,0 +1,95 @@
+"""Main entry into spawning a relay, which watches a game as one spectator and serves it
+to any number of spectators of its own (see networking.relay). This is passed where the
+game server, or another relay, is listening, and optionally the port to listen on:
+
+python -m optimax_rogue.server.relay localhost 1769 --port 1770
+"""
+
+import argparse
+import sys
+import traceback
+from optimax_rogue.networking.relay import Relay
+from optimax_rogue.networking.server import SPECTATOR_MAX_QUEUED_BYTES, SPECTATOR_MAX_LAG
+from optimax_rogue.networking.shared import Connection
+import optimax_rogue.networking.shared as nshared
+from optimax_rogue.networking.waiter import SocketWaiter
+import optimax_rogue.networking.serializer as ser
+
+MAX_WAIT = 1.0
+"""The most seconds we wait for something to happen"""
+
+def main():
+    """Main entry function"""
+    parser = argparse.ArgumentParser(description='Relay an OptiMAX Rogue game to spectators')
+    parser.add_argument('upstream_host', type=str,
+                        help='the host of the server or relay to watch')
+    parser.add_argument('upstream_port', type=int,
+                        help='the port of the server or relay to watch')
+    parser.add_argument('--lobby', type=str,
+                        help='the lobby to watch, if the upstream hosts many (see server.host)')
+    parser.add_argument('-hn', '--host', '--hostname', type=str, help='specify the host to use')
+    parser.add_argument('-p', '--port', type=int, help='specify port to listen on')
+    parser.add_argument('--unix', type=str, metavar='PATH',
+                        help='listen on the unix domain socket at this path rather than on a '
+                        + 'host and port')
+    parser.add_argument('--upstream-unix', type=str, metavar='PATH',
+                        help='watch the server or relay listening on the unix domain socket at '
+                        + 'this path, in which case upstream_host and upstream_port are ignored')
+    parser.add_argument('-l', '--log', type=str,
+                        help='if specified, rerout stdout and stderr to this file')
+    parser.add_argument('--spec-max-queued', type=int, default=SPECTATOR_MAX_QUEUED_BYTES,
+                        help='bytes a spectator may have waiting to be sent before its queued '
+                        + 'ticks are dropped and it is resynced once it catches up')
+    parser.add_argument('--spec-max-lag', type=float, default=SPECTATOR_MAX_LAG,
+                        help='seconds a spectator may take to catch up before it is '
+                        + 'disconnected, or 0 to disconnect rather than resync it')
+    parser.add_argument('--serializer', type=str, choices=tuple(ser.SERIALIZERS.keys()),
+                        default='json', help='the serializer to use for packets we send')
+    args = parser.parse_args()
+
+    if args.log:
+        with open(args.log, 'w') as fh:
+            try:
+                print('[relay.main] starting', file=fh)
+                _run(args, fh)
+            except:
+                traceback.print_exc(file=fh)
+                fh.flush()
+                raise
+            fh.flush()
+    else:
+        _run(args, sys.stdout)
+
+
+def _run(args, fh):
+    ser.set_serializer(args.serializer)
+    host = args.host or 'localhost'
+    port = args.port or 0
+
+    sock = nshared.connect(args.upstream_host, args.upstream_port, args.upstream_unix)
+    upstream = Connection(sock, args.upstream_unix or f'{args.upstream_host}:{args.upstream_port}')
+    waiter = SocketWaiter()
+
+    with nshared.listening(host, port, args.unix) as listen_sock:
+        host, port = nshared.bound_address(listen_sock)
+        print(f'[relay.main] bound on {nshared.describe_address(host, port)}', file=fh)
+
+        relay = Relay(upstream, listen_sock, args.spec_max_queued, args.spec_max_lag, fh)
+        relay.identify(args.lobby)
+        ready = None
+        while relay.update(ready):
+            ready = waiter.wait(relay.connections(),
+                                listen_sock if relay.accepting() else None, MAX_WAIT)
+
+        while relay.has_pending():
+            relay.update_queues()
+            waiter.wait(relay.connections(), None, MAX_WAIT)
+
+        waiter.close()
+        if not upstream.disconnected():
+            upstream.connection.close()
+        print(f'[relay.main] relay ended with result {relay.result}', file=fh)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Verifies that the numpy a85 encoder / decoder produce exactly the same results as
+the pure python encoder and base64.a85decode, across the size threshold where
+a85encode switches between them"""
+
+import base64
+import os
+import random
+
+import optimax_rogue.networking.a85encode as a85
+
+def _check_roundtrip(inp: bytes):
+    expected = a85.a85encode_python(inp)
+    got = a85.a85encode_numpy(inp)
+    if got != expected:
+        raise ValueError(f'encode mismatch for {len(inp)} bytes')
+    if a85.a85encode(inp) != expected:
+        raise ValueError(f'a85encode mismatch for {len(inp)} bytes')
+
+    expected_dec = base64.a85decode(expected)
+    got_dec = a85.a85decode_numpy(expected)
+    if got_dec != expected_dec:
+        raise ValueError(f'decode mismatch for {len(inp)} bytes')
+    if a85.a85decode(expected) != expected_dec:
+        raise ValueError(f'a85decode mismatch for {len(inp)} bytes')
+    if a85.a85decode(expected.decode('ascii')) != expected_dec:
+        raise ValueError(f'a85decode (str) mismatch for {len(inp)} bytes')
+
+def _check_fallbacks():
+    with_z = base64.a85encode(bytes(16) + os.urandom(16))
+    if b'z' not in with_z:
+        raise ValueError('expected z-alias in base64 output')
+    if a85.a85decode_numpy(with_z) is not None:
+        raise ValueError('numpy decoder should refuse the z-alias')
+
+    big = a85.a85encode_python(os.urandom(a85.NUMPY_THRESHOLD * 2))
+    spaced = big[:10] + b' \n' + big[10:]
+    if a85.a85decode(spaced) != base64.a85decode(spaced):
+        raise ValueError('a85decode should fall back to base64 for whitespace')
+
+    overflow = b'uuuuu' * (a85.NUMPY_THRESHOLD // 5 + 1)
+    for decoder in (a85.a85decode, base64.a85decode):
+        try:
+            decoder(overflow)
+        except ValueError:
+            continue
+        raise ValueError(f'{decoder} should raise on overflow')
+
+def main():
+    """Runs the equivalence checks"""
+    rand = random.Random(1769)
+    sizes = list(range(0, 64))
+    sizes.extend(range(a85.NUMPY_THRESHOLD - 8, a85.NUMPY_THRESHOLD + 8))
+    sizes.extend(rand.randint(1, 1 << 20) for _ in range(16))
+    for size in sizes:
+        _check_roundtrip(os.urandom(size))
+        _check_roundtrip(bytes(size))
+        _check_roundtrip(b'\xff' * size)
+    _check_fallbacks()
+    print(f'a85 numpy and python implementations match on {len(sizes)} sizes')
+
+if __name__ == '__main__':
+    main()
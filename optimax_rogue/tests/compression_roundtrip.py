@@ -0,0 +1,101 @@
+"""Verifies that a stream mixing compressed and uncompressed packets, including packets
+shorter than COMPRESSION_THRESHOLD and a SyncPacket several megabytes long, arrives
+intact and in order when sent between two Connections over a socketpair"""
+
+import socket
+import time
+
+import numpy as np
+
+import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.serializer as ser
+import optimax_rogue.networking.shared as nshared
+import optimax_rogue.logic.updates as updates
+from optimax_rogue.game.state import GameState
+from optimax_rogue.game.world import World, Dungeon
+from optimax_rogue.game.entities import Entity
+from optimax_rogue.logic.updater import UpdateResult
+from optimax_rogue.logic.moves import Move
+
+TIMEOUT = 60
+"""How many seconds we give each stream to arrive"""
+
+def _big_sync(width: int, height: int) -> packets.SyncPacket:
+    """A sync for a single random dungeon, so the compressed packet is still large"""
+    rand = np.random.RandomState(1769)
+    tiles = rand.randint(1, 4, size=(width, height)).astype('uint8')
+    ents = [Entity(1, 0, 1, 1, 10, 10, 2, 1, [], dict()),
+            Entity(2, 0, 2, 1, 10, 10, 2, 1, [], dict())]
+    return packets.SyncPacket(GameState(False, 1, 1, 2, World({0: Dungeon(tiles)}), ents), None)
+
+def _stream() -> list:
+    """The packets to send, alternating between tiny and larger ones"""
+    res = [packets.TickStartPacket()]
+    for tick in range(64):
+        res.append(packets.TickStartPacket())
+        res.append(packets.MovePacket(1, Move.Left, tick))
+        res.append(packets.UpdatePacket(updates.EntityPositionUpdate(tick, 1, 0, 0, tick, 4)))
+        res.append(packets.TickEndPacket(UpdateResult.InProgress))
+        if tick == 32:
+            res.append(_big_sync(2048, 1536))
+    res.append(packets.TickEndPacket(UpdateResult.Player1Win))
+    return res
+
+def _pair(features: frozenset):
+    """Returns a sending and a receiving connection over a socketpair"""
+    sock1, sock2 = socket.socketpair()
+    sock1.setblocking(False)
+    sock2.setblocking(False)
+    sender = nshared.Connection(sock1, 'sender')
+    receiver = nshared.Connection(sock2, 'receiver')
+    sender.features = features
+    receiver.features = features
+    return sender, receiver
+
+def _check_stream(features: frozenset, min_largest: int):
+    sender, receiver = _pair(features)
+    sent = _stream()
+    sizes = []
+    for pkt in sent:
+        serd = sender.serialize(pkt)
+        sizes.append(len(serd))
+        sender.send_serd(serd)
+
+    if min(sizes) >= nshared.COMPRESSION_THRESHOLD:
+        raise ValueError(f'expected some packets below the threshold, got {min(sizes)} bytes')
+    if max(sizes) < min_largest:
+        raise ValueError(f'expected a {min_largest} byte packet, got {max(sizes)} bytes')
+
+    got = []
+    deadline = time.time() + TIMEOUT
+    while len(got) < len(sent):
+        if time.time() > deadline:
+            raise ValueError(f'only {len(got)} of {len(sent)} packets arrived')
+        sender.update()
+        receiver.update()
+        if sender.disconnected() or receiver.disconnected():
+            raise ValueError('connection lost')
+        while True:
+            pkt = receiver.read()
+            if pkt is None:
+                break
+            got.append(pkt)
+
+    if receiver.decompressor is None:
+        raise ValueError('nothing was compressed')
+    for ind, (exp, act) in enumerate(zip(sent, got)):
+        if type(exp) is not type(act) or ser.serialize(exp) != ser.serialize(act):
+            raise ValueError(f'packet {ind} ({type(exp).__name__}) did not round trip')
+    nshared.close_all((sender, receiver))
+
+def main():
+    """Runs the compression checks"""
+    # the fast path is what makes tick start and end packets shorter than the threshold
+    _check_stream(frozenset((nshared.FEATURE_COMPRESSION, nshared.FEATURE_FAST_PATH)),
+                  2 * 1024 * 1024)
+    # compact dungeons pack four tiles to a byte
+    _check_stream(nshared.SUPPORTED_FEATURES, 512 * 1024)
+    print('compressed and uncompressed packets round trip over a socketpair')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Verifies that dungeons are sent as references exactly when the peer still holds them:
+the sender's DungeonCache is checked against a plain LRU model as dungeons are evicted,
+and after drop_queued forgets which dungeons the peer has. Every packet is read back on
+the other side of a socketpair, so a reference to a dungeon the receiver dropped fails"""
+
+import random
+import socket
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.shared as nshared
+import optimax_rogue.logic.updates as updates
+from optimax_rogue.game.world import Dungeon
+
+TIMEOUT = 30
+"""How many seconds we give the packets to arrive"""
+FULL_MIN_BYTES = 512
+"""Packets at least this long carry the whole dungeon, shorter ones a reference"""
+
+class _LRU:
+    """What we expect the sender to think the receiver holds
+
+    Attributes:
+        capacity (int): how many content hashes are kept
+        hashes (OrderedDict[bytes, None]): from least to most recently used
+    """
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.hashes = OrderedDict()
+
+    def use(self, content_hash: bytes) -> bool:
+        """Marks the hash as used, returning True if it was already held"""
+        hit = content_hash in self.hashes
+        self.hashes[content_hash] = None
+        self.hashes.move_to_end(content_hash)
+        while len(self.hashes) > self.capacity:
+            self.hashes.popitem(last=False)
+        return hit
+
+def _dungeons(num: int) -> list:
+    """Random dungeons large enough that a reference is much shorter"""
+    rand = np.random.RandomState(1769)
+    return [Dungeon(rand.randint(1, 4, size=(64, 64)).astype('uint8')) for _ in range(num)]
+
+def _pair():
+    """Returns a sending and a receiving connection over a socketpair"""
+    sock1, sock2 = socket.socketpair()
+    sock1.setblocking(False)
+    sock2.setblocking(False)
+    sender = nshared.Connection(sock1, 'sender')
+    receiver = nshared.Connection(sock2, 'receiver')
+    sender.features = nshared.SUPPORTED_FEATURES
+    receiver.features = nshared.SUPPORTED_FEATURES
+    return sender, receiver
+
+def _send(sender: nshared.Connection, model: _LRU, dung: Dungeon, order: int) -> bool:
+    """Sends the dungeon and checks it was a reference exactly when the model says the
+    receiver has it. Returns True if it was a reference"""
+    expect_ref = model.use(dung.content_hash)
+    serd = sender.serialize(packets.UpdatePacket(updates.DungeonCreatedUpdate(order, 0, dung)))
+    if (len(serd) < FULL_MIN_BYTES) != expect_ref:
+        raise ValueError(f'send {order}: expected {"a reference" if expect_ref else "the dungeon"}'
+                         + f', got {len(serd)} bytes')
+    sender.send_serd(serd)
+    return expect_ref
+
+def _receive(sender: nshared.Connection, receiver: nshared.Connection, expected: list):
+    """Reads packets until we have one for each of the expected dungeons, checking that
+    they are the same dungeons"""
+    got = 0
+    deadline = time.time() + TIMEOUT
+    while got < len(expected):
+        if time.time() > deadline:
+            raise ValueError(f'only {got} of {len(expected)} packets arrived')
+        sender.update()
+        receiver.update()
+        if sender.disconnected() or receiver.disconnected():
+            raise ValueError('connection lost')
+        while True:
+            pkt = receiver.read()
+            if pkt is None:
+                break
+            if pkt.update.dungeon.content_hash != expected[got].content_hash:
+                raise ValueError(f'packet {got} had the wrong dungeon')
+            got += 1
+
+def _check_eviction(sender, receiver, model, dungs) -> int:
+    rand = random.Random(1769)
+    hits = 0
+    sent = []
+    for order in range(400):
+        dung = dungs[rand.randrange(len(dungs))]
+        hits += _send(sender, model, dung, order)
+        sent.append(dung)
+    if hits in (0, len(sent)):
+        raise ValueError(f'expected both hits and misses, got {hits} hits of {len(sent)}')
+    _receive(sender, receiver, sent)
+    return len(sent)
+
+def _check_drop_queued(sender, receiver, model, dungs, order: int):
+    recent = [dung for dung in dungs if dung.content_hash in model.hashes]
+    if len(recent) < 4:
+        raise ValueError(f'expected the receiver to hold 4 dungeons, it holds {len(recent)}')
+    start = sender.queued_packets
+    for dung in recent[:4]:
+        if not _send(sender, model, dung, order):
+            raise ValueError('expected a reference before dropping')
+        order += 1
+    sender.mark_droppable(start)
+    dropped, _ = sender.drop_queued()
+    if dropped != 4:
+        raise ValueError(f'expected to drop 4 packets, dropped {dropped}')
+    if sender.sent_dungeons.dungeons:
+        raise ValueError('drop_queued should forget which dungeons the peer has')
+    model.hashes.clear()
+
+    sent = []
+    for dung in recent[:4] * 2:
+        hit = _send(sender, model, dung, order)
+        if hit != (len(sent) >= 4):
+            raise ValueError('expected the dungeon after dropping and a reference after that')
+        sent.append(dung)
+        order += 1
+    _receive(sender, receiver, sent)
+
+def main():
+    """Runs the dungeon cache checks"""
+    sender, receiver = _pair()
+    model = _LRU(nshared.DUNGEON_CACHE_SIZE)
+    dungs = _dungeons(nshared.DUNGEON_CACHE_SIZE + 16)
+    order = _check_eviction(sender, receiver, model, dungs)
+    _check_drop_queued(sender, receiver, model, dungs, order)
+    nshared.close_all((sender, receiver))
+    print('dungeon cache references match an LRU model across eviction and drops')
+
+if __name__ == '__main__':
+    main()
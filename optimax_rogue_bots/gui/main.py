@@ -104,8 +104,20 @@ def _run(args):
             in_update = True
             continue
 
-        if isinstance(pack, packets.TickEndPacket):
-            pack: packets.TickEndPacket
+        if isinstance(pack, packets.TickBundlePacket):
+            pack: packets.TickBundlePacket
+            if in_update:
+                sock.shutdown(socket.SHUT_RDWR)
+                print('[optimax_rogue_bots.gui.main] received TickBundlePacket while in a tick')
+                break
+            for bpack in pack.packets:
+                if isinstance(bpack, packets.SyncPacket):
+                    game_state = bpack.game_state
+                else:
+                    bpack.update.apply(game_state)
+            in_update = True # handled below like the TickEndPacket
+
+        if isinstance(pack, (packets.TickEndPacket, packets.TickBundlePacket)):
             if not in_update:
                 sock.shutdown(socket.SHUT_RDWR)
                 print('[optimax_rogue_bots.gui.main] received TickEndPacket while not in a tick')
@@ -160,7 +160,7 @@ class StateActionValuesResultPacket(packets.Packet):
 
     @classmethod
     def from_prims(cls, prims) -> 'StateActionValuesResultPacket':
-        return cls(dict((moves.Move(int(move)), value) for move, value in prims['values']),
+        return cls(dict((moves.Move(int(move)), value) for move, value in prims['values'].items()),
                    prims['tick'])
 
 packets.register_packet(StateActionValuesResultPacket)
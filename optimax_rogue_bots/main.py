@@ -8,7 +8,9 @@ import sys
 import traceback
 
 import optimax_rogue.networking.packets as packets
+import optimax_rogue.networking.serializer as ser
 import optimax_rogue.networking.shared as nshared
+import optimax_rogue.networking.handshake as handshake
 import optimax_rogue.server.pregame as pregame
 import optimax_rogue.game.state as state
 import optimax_rogue.logic.updates # pylint: disable=unused-import
@@ -24,6 +26,11 @@ def main():
     parser.add_argument('port', type=int, help='the port to connect on')
     parser.add_argument('bot', metavar='B', type=str, help='module + class for the bot')
     parser.add_argument('secret', metavar='S', type=str, help='the secret to identify with')
+    parser.add_argument('--lobby', type=str,
+                        help='the lobby to join, if the server hosts many (see server.host)')
+    parser.add_argument('--unix', type=str, metavar='PATH',
+                        help='connect to the unix domain socket at this path, in which case ip '
+                        + 'and port are ignored')
     parser.add_argument('-l', '--log', type=str,
                         help='if specified, rerout stdout and stderr to this file')
     parser.add_argument('-tr', '--tickrate', type=float, default=0.25,
@@ -31,6 +38,8 @@ def main():
     parser.add_argument('--aggressive', action='store_true',
                         help='try to go as fast as possible, regardless of cpu usage')
     parser.add_argument('--settings', type=str, help='optional path to the settings file for the bot')
+    parser.add_argument('--serializer', type=str, choices=tuple(ser.SERIALIZERS.keys()),
+                        default='json', help='the serializer to use for packets we send')
 
     args = parser.parse_args()
 
@@ -49,14 +58,14 @@ def main():
 def _run(args):
     bot_spl = args.bot.split('.')
     bot_mod = importlib.import_module('.'.join(bot_spl[:-1]))
+    ser.set_serializer(args.serializer)
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((args.ip, args.port))
-    sock.setblocking(False)
+    sock = nshared.connect(args.ip, args.port, args.unix)
 
-    conn = nshared.Connection(sock, args.ip)
+    conn = nshared.Connection(sock, args.unix or args.ip)
 
-    conn.send(pregame.IdentifyPacket(args.secret.encode('ASCII', 'strict')))
+    conn.send(pregame.IdentifyPacket(args.secret.encode('ASCII', 'strict'),
+                                     nshared.SUPPORTED_FEATURES, args.lobby))
     ticker = Ticker(0 if args.aggressive else 0.02)
     playid = None
     while True:
@@ -71,8 +80,11 @@ def _run(args):
             if not succ_pack.player_id:
                 sock.shutdown(socket.SHUT_RDWR)
                 raise ValueError(f'expected successful identify, but failed')
+            handshake.apply_result(conn, succ_pack)
             playid = succ_pack.player_id
             print(f'Successfully identified and received player id {playid}')
+            if succ_pack.lobby is not None:
+                print(f'Joined lobby {succ_pack.lobby}')
             break
         elif conn.disconnected():
             raise ValueError('server shutdown prematurely (in pregame phase)')
@@ -130,29 +142,34 @@ def _run(args):
                 print('[optimax_rogue_bots.main] connection ended abruptly')
                 break
             continue
-        if not in_update:
+        if not in_update and isinstance(pack, packets.TickBundlePacket):
+            pack: packets.TickBundlePacket
+            for bpack in pack.packets:
+                game_state = handle_packet(game_state, bpack)
+        elif not in_update:
             if not isinstance(pack, packets.TickStartPacket):
                 sock.shutdown(socket.SHUT_RDWR)
                 raise ValueError(f'bad packet: {pack} (type={type(pack)}) (expected TickStartPacket)')
             in_update = True
             continue
-        if isinstance(pack, packets.TickEndPacket):
-            pack: packets.TickEndPacket
-            if pack.result != UpdateResult.InProgress:
+        elif not isinstance(pack, packets.TickEndPacket):
+            game_state = handle_packet(game_state, pack)
+            if game_state is None:
+                print('game ended irregularly')
                 sock.shutdown(socket.SHUT_RDWR)
-                bot.finished(game_state, pack.result)
-                print(f'game ended with result {pack.result}')
                 break
-            game_state.tick += 1
-            in_update = False
-            need_move = True
-            game_state.on_tick()
             continue
-        game_state = handle_packet(game_state, pack)
-        if game_state is None:
-            print('game ended irregularly')
+
+        # the tick is over, either from a TickEndPacket or TickBundlePacket
+        if pack.result != UpdateResult.InProgress:
             sock.shutdown(socket.SHUT_RDWR)
+            bot.finished(game_state, pack.result)
+            print(f'game ended with result {pack.result}')
             break
+        game_state.tick += 1
+        in_update = False
+        need_move = True
+        game_state.on_tick()
 
 def handle_packet(game_state: state.GameState, pack: packets.Packet) -> state.GameState:
     """Handles the given packet and returns the new state, or none if the game ended"""
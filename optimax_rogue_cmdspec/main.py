@@ -14,6 +14,8 @@ import optimax_rogue.game.state as state
 import optimax_rogue.game.entities as entities
 import optimax_rogue.server.pregame as pregame
 import optimax_rogue.networking.shared as nshared
+import optimax_rogue.networking.handshake as handshake
+import optimax_rogue.networking.serializer as ser
 import optimax_rogue.logic.worldgen as worldgen
 import optimax_rogue.networking.packets as packets
 from optimax_rogue_cmdspec.map import TextMapView
@@ -24,7 +26,15 @@ def main(stdscr):
     parser = argparse.ArgumentParser(description='Spectate a game of OptiMAX Rogue')
     parser.add_argument('ip', type=str, help='the ip to connect to')
     parser.add_argument('port', type=int, help='the port to connect on')
+    parser.add_argument('--lobby', type=str,
+                        help='the lobby to watch, if the server hosts many (see server.host)')
+    parser.add_argument('--unix', type=str, metavar='PATH',
+                        help='connect to the unix domain socket at this path, in which case ip '
+                        + 'and port are ignored')
+    parser.add_argument('--serializer', type=str, choices=tuple(ser.SERIALIZERS.keys()),
+                        default='json', help='the serializer to use for packets we send')
     args = parser.parse_args()
+    ser.set_serializer(args.serializer)
     logger = logging.Logger(__name__)
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -35,11 +45,10 @@ def main(stdscr):
 
     logger.addHandler(fh)
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((args.ip, args.port))
-    sock.setblocking(False)
+    sock = nshared.connect(args.ip, args.port, args.unix)
 
-    conn = nshared.Connection(sock, args.ip)
+    conn = nshared.Connection(sock, args.unix or args.ip)
+    conn.send(handshake.IdentifyPacket(b'', nshared.SUPPORTED_FEATURES, args.lobby))
     game_state = init_empty_map()
 
     stdscr.clear()
@@ -79,6 +88,9 @@ def main(stdscr):
                     logger.info('connection ended abruptly')
                     break
                 continue
+            if isinstance(pack, handshake.IdentifyResultPacket):
+                handshake.apply_result(conn, pack)
+                continue
             need_update = True
             if not in_update:
                 if isinstance(pack, packets.SyncPacket):
@@ -87,13 +99,17 @@ def main(stdscr):
                     game_state.on_tick()
                     need_update = True
                     continue
-                if not isinstance(pack, packets.TickStartPacket):
+                if isinstance(pack, packets.TickBundlePacket):
+                    pack: packets.TickBundlePacket
+                    for bpack in pack.packets:
+                        game_state = handle_packet(game_state, bpack)
+                elif not isinstance(pack, packets.TickStartPacket):
                     sock.shutdown(socket.SHUT_RDWR)
                     raise ValueError(f'bad packet: {pack} (type={type(pack)}) (expected TickStartPacket)')
-                in_update = True
-                continue
-            if isinstance(pack, packets.TickEndPacket):
-                pack: packets.TickEndPacket
+                else:
+                    in_update = True
+                    continue
+            if isinstance(pack, (packets.TickEndPacket, packets.TickBundlePacket)):
                 if pack.result != UpdateResult.InProgress:
                     sock.shutdown(socket.SHUT_RDWR)
                     logger.info('game ended with result %s', str(pack.result))
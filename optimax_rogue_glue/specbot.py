@@ -4,13 +4,15 @@ import argparse
 import subprocess
 import secrets
 import time
+from optimax_rogue.server.orchestrator import Orchestrator
+import optimax_rogue.networking.serializer as ser
 
 def main():
     """Main entry"""
     parser = argparse.ArgumentParser(description='Watch two bots play OptiMAX Rogue')
     parser.add_argument('bot1', metavar='B1', type=str, help='module + class for first bot')
     parser.add_argument('bot2', metavar='B2', type=str, help='module + class for second bot')
-    parser.add_argument('--port', type=int, default=1769, help='port to use')
+    parser.add_argument('--port', type=int, default=1769, help='port to use, or 0 for any free port')
     parser.add_argument('--tickrate', type=float, default=1.0, help='seconds per tick for server')
     parser.add_argument('--headless', action='store_true', help='Use headless mode')
     parser.add_argument('--repeat', action='store_true', help='Keeps respawning server until stopped')
@@ -18,16 +20,24 @@ def main():
     parser.add_argument('--dsunused', action='store_true',
                         help='use unused dungeon despawn strat instead of unreachable')
     parser.add_argument('--maxticks', type=int, default=None, help='maximum ticks before tie')
+    parser.add_argument('--serializer', type=str, choices=tuple(ser.SERIALIZERS.keys()),
+                        default='json', help='the serializer the server and bots use')
     args = parser.parse_args()
 
-    _run(args)
-    if args.repeat:
-        while True:
-            _run(args)
-            time.sleep(0.5)
+    # the server runs in a worker which already imported the game, rather than in a new
+    # interpreter per game, and tells us as soon as it is listening
+    orch = Orchestrator(1)
+    try:
+        _run(args, orch)
+        if args.repeat:
+            while True:
+                _run(args, orch)
+                time.sleep(0.5)
+    finally:
+        orch.close()
 
 
-def _run(args):
+def _run(args, orch: Orchestrator):
     secret1 = secrets.token_hex()
     secret2 = secrets.token_hex()
     executable = 'python3' if args.py3 else 'python'
@@ -35,30 +45,27 @@ def _run(args):
     create_flags = 0 if args.headless else subprocess.CREATE_NEW_CONSOLE
 
     procs = []
-    servargs = [executable, '-u', '-m', 'optimax_rogue.server.main', secret1, secret2, '--port', str(args.port),
-         '--log', 'server_log.txt', '--tickrate', str(args.tickrate)]
+    servargs = [secret1, secret2, '--port', str(args.port),
+                '--log', 'server_log.txt', '--tickrate', str(args.tickrate)]
     if args.dsunused:
         servargs.append('--dsunused')
     if args.maxticks:
         servargs.append('--maxticks')
         servargs.append(str(args.maxticks))
-    procs.append(subprocess.Popen(
-        servargs,
-        creationflags=create_flags
-    ))
+    servargs.extend(('--serializer', args.serializer))
+    match = orch.start_match(servargs)
     del servargs
-
-    time.sleep(2)
+    port = str(match.port)
 
     procs.append(subprocess.Popen(
-        [executable, '-u', '-m', 'optimax_rogue_bots.main', 'localhost', str(args.port), args.bot1, secret1,
-         '--log', 'bot1_log.txt'],
+        [executable, '-u', '-m', 'optimax_rogue_bots.main', 'localhost', port, args.bot1, secret1,
+         '--log', 'bot1_log.txt', '--serializer', args.serializer],
         creationflags=create_flags
     ))
 
     procs.append(subprocess.Popen(
-        [executable, '-u', '-m', 'optimax_rogue_bots.main', 'localhost', str(args.port), args.bot2, secret2,
-         '--log', 'bot2_log.txt'],
+        [executable, '-u', '-m', 'optimax_rogue_bots.main', 'localhost', port, args.bot2, secret2,
+         '--log', 'bot2_log.txt', '--serializer', args.serializer],
         creationflags=create_flags
     ))
 
@@ -66,10 +73,12 @@ def _run(args):
 
     if not args.headless:
         procs.append(subprocess.Popen(
-            [executable, '-m', 'optimax_rogue_cmdspec.main', 'localhost', str(args.port)],
+            [executable, '-m', 'optimax_rogue_cmdspec.main', 'localhost', port,
+             '--serializer', args.serializer],
             creationflags=subprocess.CREATE_NEW_CONSOLE
         ))
 
+    print(f'[specbot] game ended with result {match.wait()}')
     for proc in procs:
         proc.wait()
         print('[specbot] process finished')